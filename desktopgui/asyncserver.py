@@ -0,0 +1,332 @@
+"""asyncio HTTP server for the device, with the same routes as server.py.
+
+One event loop handles every connection, reading request bodies as they
+arrive (plain or chunked). Calls into the device API block, so they run on
+a small thread pool and never hold up the loop. Live frames go through a
+gate that applies one at a time: a frame that arrives while another is
+waiting either replaces it (the waiting one gets a 503) or is turned away
+with a 503, depending on serverLiveOverload.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import http
+import json
+import pathlib
+import re
+import time
+import traceback
+import urllib.parse
+
+import frameformat
+import slotbatch
+from deviceapi import Mode
+
+with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
+    CONFIG = json.load(f)
+
+MAX_HEADER_BYTES = 64 * 1024
+BODY_READ_SIZE = 64 * 1024
+
+class _BadRequest(Exception):
+    def __init__(self, message : str, status : int = 400):
+        super().__init__(message)
+        self.status = status
+
+# Headers are keyed in lower case, query values are lists.
+_Request = collections.namedtuple("_Request", ["body", "headers", "query"])
+
+_SUPERSEDED = object()
+
+class _LiveGate:
+    """ Applies live frames one at a time, dropping frames under load.
+
+    When coalescing, a frame waiting its turn is replaced by a newer one, but
+    only by a keyframe: a delta is built on the frame before it, so it is
+    turned away with ResyncRequired instead and the client sends a keyframe.
+    """
+
+    def __init__(self, executor, coalesce : bool):
+        self._executor = executor
+        self._coalesce = coalesce
+        self._busy = False
+        self._pending = None
+        self.num_dropped = 0
+
+    async def submit(self, func, data, keyframe : bool = True):
+        """ Apply func(data) on the pool. Returns its result, or _SUPERSEDED
+        if the frame was dropped for a newer one. """
+        loop = asyncio.get_running_loop()
+        if self._busy and not self._coalesce:
+            self.num_dropped += 1
+            return _SUPERSEDED
+        if self._pending is not None:
+            self.num_dropped += 1
+            if not keyframe:
+                raise frameformat.ResyncRequired("Delta frame arrived while another frame was waiting")
+            self._pending[2].set_result(_SUPERSEDED)
+        future = loop.create_future()
+        self._pending = (func, data, future)
+        if not self._busy:
+            self._busy = True
+            loop.create_task(self._drain())
+        return await future
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending is not None:
+                func, data, future = self._pending
+                self._pending = None
+                try:
+                    future.set_result(await loop.run_in_executor(self._executor, func, data))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            self._busy = False
+
+async def _read_body(reader, headers : dict, max_bytes : int) -> bytes:
+    """ Read a request body, plain or chunked. """
+    body = bytearray()
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size_line = await reader.readline()
+            try:
+                size = int(size_line.split(b";")[0], 16)
+            except ValueError:
+                raise _BadRequest("Bad chunk size")
+            if size == 0:
+                # Skip any trailers.
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return bytes(body)
+            if len(body) + size > max_bytes:
+                raise _BadRequest("Request body too large", 413)
+            body += await reader.readexactly(size)
+            await reader.readline()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise _BadRequest("Bad Content-Length")
+    if length > max_bytes:
+        raise _BadRequest("Request body too large", 413)
+    while len(body) < length:
+        body += await reader.readexactly(min(BODY_READ_SIZE, length - len(body)))
+    return bytes(body)
+
+def _encode_response(result, keep_alive : bool) -> bytes:
+    """ Turn a handler result, in Flask's (body, status[, headers]) style,
+    into bytes. """
+    if not isinstance(result, tuple):
+        result = (result, 200)
+    body, status, headers = result if len(result) == 3 else (*result, {})
+    if isinstance(body, dict):
+        content_type = "application/json"
+        body = json.dumps(body).encode("utf-8")
+    elif isinstance(body, str):
+        content_type = "text/html; charset=utf-8"
+        body = body.encode("utf-8")
+    else:
+        content_type = "application/octet-stream"
+    head = (
+        f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        + "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        + "\r\n")
+    return head.encode("latin-1") + body
+
+def matrix_async_server(api):
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=CONFIG['serverWorkerThreads'])
+    live_gate = _LiveGate(executor, CONFIG['serverLiveOverload'] == "coalesce")
+    routes = []
+
+    def route(method : str, pattern : str):
+        def decorator(handler):
+            routes.append((method, re.compile(f"{pattern}$"), handler))
+            return handler
+        return decorator
+
+    async def call(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    def parse_int(value : str) -> int:
+        try:
+            return int(value)
+        except ValueError:
+            raise _BadRequest(f"{value} provided couldn't be cast to int.")
+
+    @route("DELETE", r"/slot/([^/]+)")
+    async def clear_slot(request, slot_index):
+        slot = parse_int(slot_index)
+        return ("", 200) if await call(api.clear_slot, slot) else ("", 500)
+
+    @route("POST", r"/slot/([^/]+)")
+    async def set_slot(request, slot_index):
+        slot = parse_int(slot_index)
+        return ("", 201) if await call(api.set_slot, slot, request.body) else ("", 500)
+
+    @route("GET", r"/slot/([^/]+)")
+    async def get_slot(request, slot_index):
+        slot = parse_int(slot_index)
+        info = await call(api.get_slot_info, slot)
+        headers = {} if info is None else {"ETag": slotbatch.etag(info["hash"])}
+        if info is not None and info["hash"] in slotbatch.parse_etags(request.headers.get("if-none-match")):
+            return "", 304, headers
+        res, gif_data = await call(api.get_slot, slot)
+        return (gif_data, 200, headers) if res else ("", 204)
+
+    @route("POST", r"/slot/([^/]+)/assign")
+    async def assign_slot(request, slot_index):
+        slot = parse_int(slot_index)
+        try:
+            content_hash = json.loads(request.body)["hash"]
+            if not isinstance(content_hash, str):
+                raise TypeError()
+        except (TypeError, KeyError, ValueError):
+            raise _BadRequest(f"{request.body!r} isn't a valid assign request.")
+        if await call(api.assign_slot, slot, content_hash):
+            return "", 201
+        return f"No GIF with hash {content_hash}", 404
+
+    @route("GET", r"/slots")
+    async def get_slots(request):
+        return {"slots": await call(api.get_slots)}, 200
+
+    @route("POST", r"/slots/batch")
+    async def set_slots_batch(request):
+        try:
+            entries = slotbatch.decode_batch(request.body, api.num_slots)
+        except Exception as e:
+            raise _BadRequest(str(e))
+        # Unchanged slots are left alone; only empty ones are cleared.
+        slot_data = {slot: data for slot, (state, data) in entries.items() if state != slotbatch.SLOT_UNCHANGED}
+        return ("", 201) if await call(api.set_slots, slot_data) else ("", 500)
+
+    @route("GET", r"/slots/batch")
+    async def get_slots_batch(request):
+        slots = request.query.get("slots", [""])[0]
+        try:
+            slots = [int(slot) for slot in slots.split(",") if slot]
+        except ValueError:
+            raise _BadRequest(f"{slots} isn't a list of slots.")
+        known_hashes = slotbatch.parse_etags(request.headers.get("if-none-match"))
+        entries = await call(api.get_slots_batch, slots or None, known_hashes)
+        return slotbatch.encode_batch(entries), 200
+
+    @route("POST", r"/live")
+    async def set_live(request):
+        res = await live_gate.submit(api.set_live, request.body)
+        if res is _SUPERSEDED:
+            return "Dropped for a newer frame.", 503
+        return ("", 201) if res else ("", 500)
+
+    @route("POST", r"/live/frame")
+    async def set_live_frame(request):
+        try:
+            keyframe = not frameformat.decode_header(request.body).flags & frameformat.FLAG_DELTA
+        except RuntimeError as e:
+            raise _BadRequest(str(e))
+        try:
+            res = await live_gate.submit(api.set_live_frame, request.body, keyframe)
+        except frameformat.ResyncRequired as e:
+            return str(e), 409
+        if res is _SUPERSEDED:
+            return "Dropped for a newer frame.", 503
+        return ("", 201) if res else ("", 500)
+
+    @route("POST", r"/mode")
+    async def set_mode(request):
+        try:
+            data = json.loads(request.body)
+            mode = Mode(data["mode"])
+            slot = data.get("slot")
+            slot = None if slot is None else int(slot)
+        except (TypeError, KeyError, ValueError):
+            raise _BadRequest(f"{request.body!r} isn't a valid mode request.")
+        return ("", 200) if await call(api.set_mode, mode, slot) else ("", 500)
+
+    @route("GET", r"/slotstats")
+    async def get_slot_stats(request):
+        return await call(api.get_slot_stats), 200
+
+    @route("GET", r"/livestats")
+    async def get_live_stats(request):
+        return await call(api.get_live_stats), 200
+
+    @route("GET", r"/metrics")
+    async def get_metrics(request):
+        return await call(api.get_metrics), 200
+
+    @route("GET", r"/ping/([^/]+)")
+    async def ping(request, ping_id):
+        # Cheap enough to answer on the loop.
+        return {"check_int": api.ping(parse_int(ping_id)), "device_time": time.time()}
+
+    async def dispatch(method : str, path : str, request : _Request):
+        allowed = False
+        for route_method, pattern, handler in routes:
+            match = pattern.match(path)
+            if match:
+                if route_method == method:
+                    return await handler(request, *match.groups())
+                allowed = True
+        return ("Method not allowed", 405) if allowed else ("Not found", 404)
+
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ")
+                except ValueError:
+                    writer.write(_encode_response(("Bad request line", 400), False))
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    if line:
+                        name, _, value = line.partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+                try:
+                    path, _, query = target.partition("?")
+                    receive_start = time.perf_counter()
+                    body = await _read_body(reader, headers, CONFIG['serverMaxBodyBytes'])
+                    if path.startswith("/live"):
+                        api.metrics.record("receive", 1000 * (time.perf_counter() - receive_start))
+                    result = await dispatch(method, path, _Request(body, headers, urllib.parse.parse_qs(query)))
+                except _BadRequest as e:
+                    # The rest of the body may still be unread.
+                    keep_alive = False
+                    result = str(e), e.status
+                except asyncio.IncompleteReadError:
+                    return
+                except Exception as e:
+                    traceback.print_exc()
+                    result = str(e), 500
+                writer.write(_encode_response(result, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(host, port):
+        server = await asyncio.start_server(handle_connection, host, port, limit=MAX_HEADER_BYTES)
+        async with server:
+            await server.serve_forever()
+
+    def run(host, port, debug=False):
+        asyncio.run(serve(host, port))
+
+    return run
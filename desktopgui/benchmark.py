@@ -0,0 +1,274 @@
+"""Benchmarks the client -> server -> device pipeline on one machine.
+
+The device runs in this process on a simdriver.NullDriver, behind the real
+HTTP and live stream servers on localhost, and is driven through the real
+ClientLogic. No panel or display is needed.
+
+Workloads:
+  live_snapshot   one live image at a time over HTTP
+  live_stream     live images as fast as the client can send them
+  static_slot     upload a still image to a slot and show it
+  animated_slot   upload an animation to a slot and play it back
+
+Each reports frames/s, p50/p99 latency, CPU per frame (the whole process:
+client, server and device) and bytes sent per frame. Results are printed as
+JSON, tagged with the git commit, so runs can be compared between commits:
+
+  python benchmark.py --output before.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import pathlib
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+import requests
+
+import asyncserver
+import clientapi
+import clientlogic
+import deviceapi
+import server
+import simdriver
+import streamserver
+
+with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
+    CONFIG = json.load(f)
+
+# Shortest delay a GIF frame can have.
+GIF_FRAME_MS = 20
+
+def make_frames(num_frames : int, size : (int, int), seed : int = 0) -> [Image.Image]:
+    """ Screen-like test frames: a scrolling gradient with a noisy sprite
+    moving over it, the same every run. """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    sprite = rng.integers(0, 256, size=(height // 4, width // 4, 3), dtype=np.uint8)
+    x = np.arange(width, dtype=np.uint16)
+    frames = []
+    for i in range(num_frames):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:, :, 0] = ((x + 2 * i) % 256)[None, :]
+        frame[:, :, 1] = (np.arange(height)[:, None] * 255 // max(height - 1, 1))
+        frame[:, :, 2] = 64
+        left = (3 * i) % (width - sprite.shape[1])
+        top = (2 * i) % (height - sprite.shape[0])
+        frame[top:top + sprite.shape[0], left:left + sprite.shape[1]] = sprite
+        frames.append(Image.fromarray(frame))
+    return frames
+
+def git_commit() -> dict:
+    """ The commit being benchmarked, and whether the tree has local changes. """
+    root = pathlib.Path(__file__).parents[0]
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain"], cwd=root, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": bool(status.strip())}
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _percentiles(samples_ms : [float]) -> dict:
+    if not samples_ms:
+        return {"p50": None, "p99": None, "mean": None}
+    samples_ms = np.asarray(samples_ms)
+    return {
+        "p50": float(np.percentile(samples_ms, 50)),
+        "p99": float(np.percentile(samples_ms, 99)),
+        "mean": float(samples_ms.mean()),
+    }
+
+class Bench:
+    """ A device on a simulated driver with a client connected to it. """
+
+    def __init__(self, server_backend : str, slot_data_dir):
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.driver = simdriver.NullDriver()
+        self.device_api = deviceapi.DeviceAPI(self.driver, slot_data_dir=slot_data_dir)
+        port = _free_port()
+        stream_port = _free_port()
+        if server_backend == "asyncio":
+            run_server = asyncserver.matrix_async_server(self.device_api)
+        else:
+            run_server = server.matrix_server(self.device_api)
+        threading.Thread(target=run_server, kwargs={"host": "127.0.0.1", "port": port, "debug": False}, daemon=True).start()
+        run_stream_server = streamserver.matrix_stream_server(self.device_api)
+        threading.Thread(target=run_stream_server, kwargs={"host": "127.0.0.1", "port": stream_port}, daemon=True).start()
+
+        self.client_api = clientapi.ClientAPI(f"http://127.0.0.1:{port}", stream_port=stream_port)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                self.client_api.get_device_time()
+                break
+            except requests.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Benchmark server didn't start")
+                time.sleep(0.05)
+        self.logic = clientlogic.ClientLogic(client_api=self.client_api)
+
+    def measure(self, run) -> dict:
+        """ Run a workload and add up the rate, CPU and bytes it used.
+
+        run() returns (frames, latencies in ms, seconds), where seconds is
+        how long the frames took if that isn't the whole run.
+        """
+        bytes_before = self.logic.get_transfer_stats()["bytes_sent"]
+        cpu_before = time.process_time()
+        start = time.perf_counter()
+        num_frames, latencies_ms, elapsed = run()
+        if elapsed is None:
+            elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_before
+        bytes_sent = self.logic.get_transfer_stats()["bytes_sent"] - bytes_before
+        return {
+            "frames": num_frames,
+            "seconds": elapsed,
+            "fps": num_frames / elapsed if elapsed else None,
+            "latency_ms": _percentiles(latencies_ms),
+            "cpu_ms_per_frame": 1000 * cpu / num_frames if num_frames else None,
+            "bytes_per_frame": bytes_sent / num_frames if num_frames else None,
+        }
+
+def bench_live_snapshot(bench : Bench, frames : [Image.Image]) -> dict:
+    """ Snapshots go over HTTP and are shown before the request returns, so
+    latency is from sending to the driver being handed the image. """
+    def run():
+        latencies_ms = []
+        for frame in frames:
+            shown = bench.driver.num_frames
+            start = time.perf_counter()
+            bench.logic.process_screen_image(frame)
+            bench.logic.process_go_live_screenshot()
+            if bench.driver.num_frames > shown:
+                latencies_ms.append(1000 * (bench.driver.frame_times[-1] - start))
+        return len(latencies_ms), latencies_ms, None
+    return bench.measure(run)
+
+def bench_live_stream(bench : Bench, frames : [Image.Image]) -> dict:
+    """ Frames are sent back to back, so frames/s counts those the device
+    showed. Latency is capture to display, using the frames' timestamps. """
+    def run():
+        bench.logic.process_go_live_stream()
+        bench.driver.metrics.reset()
+        shown = bench.driver.num_frames
+        start = time.perf_counter()
+        for frame in frames:
+            frame = frame.copy()
+            frame.info["capture_time"] = time.time()
+            bench.logic.process_screen_image(frame)
+        # Let frames still on their way arrive.
+        last_count = None
+        while last_count != bench.driver.num_frames:
+            last_count = bench.driver.num_frames
+            time.sleep(0.1)
+        # The driver timed these itself.
+        return bench.driver.num_frames - shown, [], bench.driver.frame_times[-1] - start
+    result = bench.measure(run)
+    latency = bench.driver.metrics.snapshot().get("capture_to_display")
+    # GIF frames carry no timestamp.
+    if latency is not None:
+        result["latency_ms"] = {"p50": latency["p50"], "p99": latency["p99"], "mean": latency["mean"]}
+    result["frames_sent"] = len(frames)
+    result["frames_dropped"] = bench.logic.get_transfer_stats()["live_frames_dropped"]
+    return result
+
+def bench_static_slot(bench : Bench, frames : [Image.Image]) -> dict:
+    """ Latency is from starting the upload to the slot being shown. """
+    def run():
+        latencies_ms = []
+        for i, frame in enumerate(frames):
+            slot = i % CONFIG['numSlots']
+            shown = bench.driver.num_frames
+            start = time.perf_counter()
+            bench.logic.process_set_slot(slot, frame)
+            bench.logic.process_show_slot(slot)
+            if bench.driver.wait_for_frames(shown + 1, timeout=5):
+                latencies_ms.append(1000 * (bench.driver.frame_times[-1] - start))
+        return len(latencies_ms), latencies_ms, None
+    return bench.measure(run)
+
+def bench_animated_slot(bench : Bench, frames : [Image.Image], loops : int = 2) -> dict:
+    """ Plays an animation of every frame at the shortest GIF frame delay.
+    Latency is how far each frame's display strayed from its due time. """
+    def run():
+        bench.logic.process_set_slot_vid(0, frames, [GIF_FRAME_MS] * len(frames))
+        shown = bench.driver.num_frames
+        bench.logic.process_show_slot(0)
+        bench.driver.wait_for_frames(shown + 1, timeout=10)
+        start_count = bench.driver.num_frames
+        time.sleep(loops * len(frames) * GIF_FRAME_MS / 1000)
+        num_frames = bench.driver.num_frames - start_count
+        times = np.array(list(bench.driver.frame_times)[-num_frames - 1:])
+        intervals_ms = np.diff(times) * 1000
+        bench.logic.process_go_black()
+        return num_frames, np.abs(intervals_ms - GIF_FRAME_MS).tolist(), intervals_ms.sum() / 1000
+    return bench.measure(run)
+
+WORKLOADS = {
+    "live_snapshot": bench_live_snapshot,
+    "live_stream": bench_live_stream,
+    "static_slot": bench_static_slot,
+    "animated_slot": bench_animated_slot,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("workloads", nargs="*", help=f"workloads to run, all by default: {', '.join(WORKLOADS)}")
+    parser.add_argument("--frames", type=int, default=300, help="frames per live workload")
+    parser.add_argument("--slot-frames", type=int, default=20, help="uploads for static_slot, frames for animated_slot")
+    parser.add_argument("--server", choices=["flask", "asyncio"], default=CONFIG['serverBackend'])
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"No workload {name}, choose from {', '.join(WORKLOADS)}")
+
+    size = (CONFIG['matrixWidth'], CONFIG['matrixHeight'])
+    live_frames = make_frames(args.frames, size)
+    slot_frames = make_frames(args.slot_frames, size, seed=1)
+    results = {
+        **git_commit(),
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "settings": {
+            "server": args.server,
+            "liveFrameFormat": CONFIG['liveFrameFormat'],
+            "liveTransport": CONFIG['liveTransport'],
+            "liveDelta": CONFIG['liveDelta'],
+            "frames": args.frames,
+            "slotFrames": args.slot_frames,
+        },
+        "workloads": {},
+    }
+    # Keep the device's chatter out of the JSON.
+    with tempfile.TemporaryDirectory() as slot_data_dir, contextlib.redirect_stdout(sys.stderr):
+        bench = Bench(args.server, slot_data_dir)
+        for name in args.workloads or WORKLOADS:
+            frames = slot_frames if name.endswith("_slot") else live_frames
+            print(f"Running {name}...", file=sys.stderr)
+            results["workloads"][name] = WORKLOADS[name](bench, frames)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Screen capture backends for the desktop client.
+
+A backend grabs an area of the screen into an (height, width, 3) uint8 RGB
+array. The X11 backend uses the MIT-SHM extension to copy just that area
+straight into a shared memory buffer that is reused for every grab. Pillow's
+ImageGrab works everywhere and is the fallback.
+"""
+import ctypes
+import ctypes.util
+import os
+import sys
+
+import numpy as np
+from PIL import ImageGrab
+
+class CaptureBackend:
+    name = None
+
+    def grab(self, bbox) -> np.ndarray:
+        """ Grab the (left, top, right, bottom) area of the screen.
+
+        The result may be a buffer the backend reuses, only valid until the
+        next grab.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class ImageGrabBackend(CaptureBackend):
+    name = "ImageGrab"
+
+    def grab(self, bbox) -> np.ndarray:
+        img = ImageGrab.grab(bbox=bbox)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        return np.asarray(img)
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ("shmseg", ctypes.c_ulong),
+        ("shmid", ctypes.c_int),
+        ("shmaddr", ctypes.c_void_p),
+        ("readOnly", ctypes.c_int),
+    ]
+
+class _XImage(ctypes.Structure):
+    # Only the leading fields we read; XImage is always allocated by Xlib.
+    _fields_ = [
+        ("width", ctypes.c_int),
+        ("height", ctypes.c_int),
+        ("xoffset", ctypes.c_int),
+        ("format", ctypes.c_int),
+        ("data", ctypes.c_void_p),
+        ("byte_order", ctypes.c_int),
+        ("bitmap_unit", ctypes.c_int),
+        ("bitmap_bit_order", ctypes.c_int),
+        ("bitmap_pad", ctypes.c_int),
+        ("depth", ctypes.c_int),
+        ("bytes_per_line", ctypes.c_int),
+        ("bits_per_pixel", ctypes.c_int),
+        ("red_mask", ctypes.c_ulong),
+        ("green_mask", ctypes.c_ulong),
+        ("blue_mask", ctypes.c_ulong),
+    ]
+
+_ZPIXMAP = 2
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+_ALL_PLANES = 0xFFFFFFFF
+
+_X_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+
+class XShmBackend(CaptureBackend):
+    name = "X11 MIT-SHM"
+
+    def __init__(self):
+        x11_path = ctypes.util.find_library("X11")
+        xext_path = ctypes.util.find_library("Xext")
+        if x11_path is None or xext_path is None:
+            raise RuntimeError("libX11 or libXext not found")
+        self._x11 = x11 = ctypes.CDLL(x11_path)
+        self._xext = xext = ctypes.CDLL(xext_path)
+        self._libc = libc = ctypes.CDLL(None, use_errno=True)
+
+        x11.XOpenDisplay.restype = ctypes.c_void_p
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        x11.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        x11.XRootWindow.restype = ctypes.c_ulong
+        x11.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultVisual.restype = ctypes.c_void_p
+        x11.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        x11.XDestroyImage.argtypes = [ctypes.POINTER(_XImage)]
+        x11.XSetErrorHandler.restype = ctypes.c_void_p
+        x11.XSetErrorHandler.argtypes = [_X_ERROR_HANDLER]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        xext.XShmCreateImage.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p,
+            ctypes.POINTER(_XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage), ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+        # Xlib's default error handler exits the process, so record errors instead.
+        self._x_error = False
+        def on_x_error(display, event):
+            self._x_error = True
+            return 0
+        self._error_handler = _X_ERROR_HANDLER(on_x_error)
+        x11.XSetErrorHandler(self._error_handler)
+
+        self._display = x11.XOpenDisplay(None)
+        if not self._display:
+            raise RuntimeError("Can't open X display")
+        if not xext.XShmQueryExtension(self._display):
+            x11.XCloseDisplay(self._display)
+            raise RuntimeError("X server has no MIT-SHM extension")
+        screen = x11.XDefaultScreen(self._display)
+        self._root = x11.XRootWindow(self._display, screen)
+        self._visual = x11.XDefaultVisual(self._display, screen)
+        self._depth = x11.XDefaultDepth(self._display, screen)
+        self._screen_size = (x11.XDisplayWidth(self._display, screen), x11.XDisplayHeight(self._display, screen))
+        self._image = None
+        self._shminfo = None
+        self._pixels = None
+        self._out = None
+        # Try shared memory out now, so create_backend can fall back if it
+        # doesn't work here.
+        try:
+            self._allocate(1, 1)
+        except (OSError, RuntimeError):
+            self.close()
+            raise
+
+    def _allocate(self, width : int, height : int):
+        """ Make a shared memory image of the given size. """
+        self._free()
+        shminfo = _XShmSegmentInfo()
+        image = self._xext.XShmCreateImage(self._display, self._visual, self._depth, _ZPIXMAP, None, ctypes.byref(shminfo), width, height)
+        if not image:
+            raise RuntimeError("XShmCreateImage failed")
+        if image.contents.bits_per_pixel != 32 or image.contents.red_mask != 0xFF0000 or image.contents.blue_mask != 0xFF:
+            self._x11.XDestroyImage(image)
+            raise RuntimeError("Only 32-bit BGRX screens are supported")
+        size = image.contents.bytes_per_line * height
+        shminfo.shmid = self._libc.shmget(_IPC_PRIVATE, size, _IPC_CREAT | 0o600)
+        if shminfo.shmid < 0:
+            self._x11.XDestroyImage(image)
+            raise OSError(ctypes.get_errno(), "shmget failed")
+        shminfo.shmaddr = self._libc.shmat(shminfo.shmid, None, 0)
+        # shmat returns (void *)-1 on failure.
+        if shminfo.shmaddr in (None, ctypes.c_void_p(-1).value):
+            errno = ctypes.get_errno()
+            self._libc.shmctl(shminfo.shmid, _IPC_RMID, None)
+            self._x11.XDestroyImage(image)
+            raise OSError(errno, "shmat failed")
+        image.contents.data = shminfo.shmaddr
+        shminfo.readOnly = 0
+        self._image = image
+        self._shminfo = shminfo
+        self._xext.XShmAttach(self._display, ctypes.byref(shminfo))
+        self._x11.XSync(self._display, 0)
+        # The segment goes away once both sides have detached.
+        self._libc.shmctl(shminfo.shmid, _IPC_RMID, None)
+
+        buffer = (ctypes.c_ubyte * size).from_address(shminfo.shmaddr)
+        bgrx = np.ctypeslib.as_array(buffer).reshape(height, image.contents.bytes_per_line // 4, 4)
+        self._pixels = bgrx[:, :width, 2::-1]
+        self._out = np.empty((height, width, 3), dtype=np.uint8)
+
+    def _free(self):
+        if self._image is not None:
+            self._xext.XShmDetach(self._display, ctypes.byref(self._shminfo))
+            self._x11.XSync(self._display, 0)
+            # The data is ours to free, not Xlib's.
+            self._image.contents.data = None
+            self._x11.XDestroyImage(self._image)
+            self._libc.shmdt(self._shminfo.shmaddr)
+            self._image = None
+            self._shminfo = None
+            self._pixels = None
+            self._out = None
+
+    def grab(self, bbox) -> np.ndarray:
+        width = bbox[2] - bbox[0]
+        height = bbox[3] - bbox[1]
+        if self._out is None or self._out.shape[:2] != (height, width):
+            self._allocate(width, height)
+        # Keep the area on the screen, X refuses to grab outside it.
+        left = max(0, min(bbox[0], self._screen_size[0] - width))
+        top = max(0, min(bbox[1], self._screen_size[1] - height))
+        self._x_error = False
+        if not self._xext.XShmGetImage(self._display, self._root, self._image, left, top, _ALL_PLANES) or self._x_error:
+            raise RuntimeError(f"XShmGetImage failed for {bbox}")
+        np.copyto(self._out, self._pixels)
+        return self._out
+
+    def close(self):
+        self._free()
+        if self._display:
+            self._x11.XCloseDisplay(self._display)
+            self._display = None
+
+BACKENDS = {
+    "xshm": XShmBackend,
+    "imagegrab": ImageGrabBackend,
+}
+
+def create_backend(name : str = "auto") -> CaptureBackend:
+    """ Create a capture backend by name. "auto" picks the fastest that works. """
+    if name != "auto":
+        return BACKENDS[name]()
+    if sys.platform.startswith("linux") and os.environ.get("DISPLAY"):
+        try:
+            return XShmBackend()
+        except (OSError, RuntimeError) as e:
+            print(f"Can't use {XShmBackend.name} capture, using {ImageGrabBackend.name}: {e}")
+    return ImageGrabBackend()
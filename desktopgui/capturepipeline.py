@@ -0,0 +1,194 @@
+"""Screen capture processing for the desktop client.
+
+Captured frames are kept as numpy arrays. Downscaling and sharpening write
+into buffers that are allocated once and reused for every frame, and each
+stage is timed.
+"""
+import collections
+import contextlib
+import time
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# Resize methods: how the captured area is fitted to the matrix.
+STRETCH = "stretch"
+CROP = "crop"
+PAD = "pad"
+
+# Resample method that uses the numpy area-average path. Any other value is
+# a Pillow resample filter and goes through Pillow instead.
+AREA = "area"
+
+PIL_RESIZE_FUNCTIONS = {
+    STRETCH: lambda im, size, resample: im.resize(size, resample=resample),
+    CROP: lambda im, size, resample: ImageOps.fit(im, size, method=resample),
+    PAD: lambda im, size, resample: ImageOps.pad(im, size, method=resample, color=(0,0,0)),
+}
+
+class StageTimer:
+    """ Smoothed per-stage timings, in ms. Each timing is also recorded in
+    metrics (a metrics.Metrics), if given. """
+    def __init__(self, smoothing : float = 0.1, metrics=None):
+        self._smoothing = smoothing
+        self._metrics = metrics
+        self.times = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def time(self, stage : str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, 1000 * (time.perf_counter() - start))
+
+    def record(self, stage : str, ms : float):
+        old = self.times.get(stage)
+        self.times[stage] = ms if old is None else old + self._smoothing * (ms - old)
+        if self._metrics is not None:
+            self._metrics.record(stage, ms)
+
+    def summary(self) -> str:
+        total = sum(self.times.values())
+        return " ".join(f"{stage} {ms:.1f}" for stage, ms in self.times.items()) + f" = {total:.1f} ms"
+
+def fit_boxes(src_size : (int, int), dst_size : (int, int), method : str):
+    """ Work out which part of the source maps onto which part of the output.
+
+    Returns (src_box, dst_box) as (left, top, right, bottom) tuples.
+    """
+    src_w, src_h = src_size
+    dst_w, dst_h = dst_size
+    if method == CROP:
+        # Centre the largest area with the output's aspect ratio.
+        if src_w * dst_h > src_h * dst_w:
+            w = src_h * dst_w // dst_h
+            return ((src_w - w) // 2, 0, (src_w - w) // 2 + w, src_h), (0, 0, dst_w, dst_h)
+        h = src_w * dst_h // dst_w
+        return (0, (src_h - h) // 2, src_w, (src_h - h) // 2 + h), (0, 0, dst_w, dst_h)
+    if method == PAD:
+        # Fit the whole source inside the output, centred. Rounded the same
+        # way as ImageOps.pad, so the resizers line up.
+        if src_w * dst_h > src_h * dst_w:
+            h = max(1, round(src_h / src_w * dst_w))
+            top = round((dst_h - h) * 0.5)
+            return (0, 0, src_w, src_h), (0, top, dst_w, top + h)
+        w = max(1, round(src_w / src_h * dst_h))
+        left = round((dst_w - w) * 0.5)
+        return (0, 0, src_w, src_h), (left, 0, left + w, dst_h)
+    return (0, 0, src_w, src_h), (0, 0, dst_w, dst_h)
+
+class AreaResizer:
+    """ Area-average resize from a fixed source size to a fixed output size.
+
+    Each output pixel is the mean of the source pixels that fall in it, so
+    the source must be at least as big as the output. Bin edges and scratch
+    buffers are worked out once.
+    """
+    def __init__(self, src_size : (int, int), dst_size : (int, int)):
+        src_w, src_h = src_size
+        dst_w, dst_h = dst_size
+        assert src_w >= dst_w and src_h >= dst_h, \
+          f"Can't area-average {src_w}x{src_h} up to {dst_w}x{dst_h}"
+        x_edges = np.arange(dst_w + 1) * src_w // dst_w
+        y_edges = np.arange(dst_h + 1) * src_h // dst_h
+        self._x_starts = x_edges[:-1]
+        self._y_starts = y_edges[:-1]
+        x_counts = np.diff(x_edges)
+        y_counts = np.diff(y_edges)
+        self._inv_counts = (1.0 / np.outer(y_counts, x_counts)).astype(np.float32)[:, :, np.newaxis]
+        self._rows = np.empty((dst_h, src_w, 3), dtype=np.uint32)
+        self._sums = np.empty((dst_h, dst_w, 3), dtype=np.uint32)
+        self._means = np.empty((dst_h, dst_w, 3), dtype=np.float32)
+
+    def resize(self, src : np.ndarray, out : np.ndarray) -> None:
+        """ Resize src (height, width, 3) into out (a view is fine). """
+        np.add.reduceat(src, self._y_starts, axis=0, dtype=np.uint32, out=self._rows)
+        np.add.reduceat(self._rows, self._x_starts, axis=1, dtype=np.uint32, out=self._sums)
+        np.multiply(self._sums, self._inv_counts, out=self._means)
+        self._means += 0.5
+        np.copyto(out, self._means, casting="unsafe")
+
+class Sharpener:
+    """ The same 3x3 kernel as ImageFilter.SHARPEN, vectorized.
+
+    Edge pixels are left as they are, like Pillow does.
+    """
+    def __init__(self, size : (int, int)):
+        w, h = size
+        self._acc = np.empty((h - 2, w - 2, 3), dtype=np.int16)
+
+    def sharpen(self, src : np.ndarray, out : np.ndarray) -> None:
+        h, w, _ = src.shape
+        acc = self._acc
+        # (32 * centre - 2 * neighbours) / 16 is (16 * centre - neighbours) / 8.
+        np.multiply(src[1:-1, 1:-1], 16, out=acc, dtype=np.int16)
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                if dy != 1 or dx != 1:
+                    acc -= src[dy:h-2+dy, dx:w-2+dx]
+        acc += 4
+        acc >>= 3
+        np.clip(acc, 0, 255, out=acc)
+        out[0, :] = src[0, :]
+        out[-1, :] = src[-1, :]
+        out[:, 0] = src[:, 0]
+        out[:, -1] = src[:, -1]
+        np.copyto(out[1:-1, 1:-1], acc, casting="unsafe")
+
+class CapturePipeline:
+    """ Turns captured screen areas into matrix-sized frames. """
+
+    def __init__(self, size : (int, int), metrics=None):
+        self.size = size
+        self.timer = StageTimer(metrics=metrics)
+        w, h = size
+        self._resized = np.zeros((h, w, 3), dtype=np.uint8)
+        self._sharpened = np.zeros((h, w, 3), dtype=np.uint8)
+        self._sharpener = Sharpener(size)
+        self._resizer = None
+        self._boxes = None
+
+    def process(self, src : np.ndarray, resize_method : str, resample, sharpen : bool) -> np.ndarray:
+        """ Resize and optionally sharpen a captured area, given as an
+        (height, width, 3) uint8 array.
+
+        The result is one of the pipeline's own buffers, only valid until the
+        next call.
+        """
+        with self.timer.time("resize"):
+            frame = self._resize(src, resize_method, resample)
+        if sharpen:
+            with self.timer.time("sharpen"):
+                self._sharpener.sharpen(frame, self._sharpened)
+                frame = self._sharpened
+        return frame
+
+    def _resize(self, src : np.ndarray, resize_method : str, resample) -> np.ndarray:
+        src_size = (src.shape[1], src.shape[0])
+        if src_size == self.size:
+            return src
+        boxes = fit_boxes(src_size, self.size, resize_method)
+        src_box, dst_box = boxes
+        if resample == AREA and (src_box[2] - src_box[0] < dst_box[2] - dst_box[0] or
+                                 src_box[3] - src_box[1] < dst_box[3] - dst_box[1]):
+            # Area-averaging can't upscale.
+            resample = Image.BOX
+        if resample != AREA:
+            im = PIL_RESIZE_FUNCTIONS[resize_method](Image.fromarray(src), self.size, resample)
+            np.copyto(self._resized, np.asarray(im))
+            self._boxes = None
+            return self._resized
+
+        if self._boxes != (src_size, boxes):
+            # New capture size or method, so new bins.
+            src_box, dst_box = boxes
+            self._boxes = (src_size, boxes)
+            self._resizer = AreaResizer(
+                (src_box[2] - src_box[0], src_box[3] - src_box[1]),
+                (dst_box[2] - dst_box[0], dst_box[3] - dst_box[1]))
+            self._resized[:] = 0
+        self._resizer.resize(
+            src[src_box[1]:src_box[3], src_box[0]:src_box[2]],
+            self._resized[dst_box[1]:dst_box[3], dst_box[0]:dst_box[2]])
+        return self._resized
@@ -5,11 +5,16 @@ import collections
 import json
 import pathlib
 import sys
+import threading
+import traceback
 
-from PIL import Image, ImageFilter, ImageGrab, ImageOps
+from PIL import Image
 
 from screengrab import main as screengrab
+import capturepipeline
+import clientworkers
 import gifgrabber
+import metrics
 
 from PyQt6 import QtCore, QtGui, QtWidgets, uic
 
@@ -21,13 +26,20 @@ with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
     MATRIX_HEIGHT = CONFIG['matrixHeight']
 
 
-def PIL_to_qimage(pil_img):
-    temp = pil_img.convert('RGBA')
+# Update the frame timings shown in the status bar every this many frames.
+STATUS_UPDATE_FRAMES = 30
+
+def numpy_to_qimage(arr):
+    """ Wrap an (height, width, 3) uint8 array in a QImage without copying.
+
+    The array must outlive the QImage and not change while it is in use.
+    """
     return QtGui.QImage(
-        temp.tobytes('raw', "RGBA"),
-        temp.size[0],
-        temp.size[1],
-        QtGui.QImage.Format.Format_RGBA8888
+        arr.data,
+        arr.shape[1],
+        arr.shape[0],
+        arr.strides[0],
+        QtGui.QImage.Format.Format_RGB888
     )
 
 class SlotWidget(QtWidgets.QWidget):
@@ -35,8 +47,66 @@ class SlotWidget(QtWidgets.QWidget):
     QtWidgets.QWidget.__init__(self)
     uic.loadUi(pathlib.Path(__file__).parents[0] / "slotwidget.ui", self)
 
+def format_stats(stats : dict) -> str:
+  """ Timings from ClientLogic.get_stats, for showing to people. """
+  live = ", ".join(f"{key} {value:.1f}" if isinstance(value, float) else f"{key} {value}" for key, value in stats["live"].items())
+  return (
+    f"Client\n{metrics.format_snapshot(stats['client'])}\n\n"
+    f"Device\n{metrics.format_snapshot(stats['device'])}\n\n"
+    f"Jitter buffer: {live or 'off'}\n"
+    f"Render frames dropped: {stats['render_dropped']}\n"
+    f"Clock offset {stats['clock_offset_ms']:.1f} ms, round trip {stats['round_trip_ms']:.1f} ms")
+
+class StatsPanel(QtWidgets.QWidget):
+  """ Shows client and device timings, refreshed while it is open. """
+  _stats_fetched = QtCore.pyqtSignal(str, name="statsFetched")
+
+  def __init__(self, client_handler):
+    QtWidgets.QWidget.__init__(self)
+    self._client_handler = client_handler
+    self._fetching = False
+    self.setWindowTitle("Timings")
+    self._text = QtWidgets.QPlainTextEdit(self)
+    self._text.setReadOnly(True)
+    self._text.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.SystemFont.FixedFont))
+    self._text.setMinimumSize(720, 400)
+    layout = QtWidgets.QVBoxLayout(self)
+    layout.addWidget(self._text)
+    self._stats_fetched.connect(self._text.setPlainText)
+    self._timer = QtCore.QTimer(self)
+    self._timer.timeout.connect(self._refresh)
+    self._timer.start(CONFIG['metricsRefreshMillis'])
+
+  def _refresh(self):
+    # Fetching talks to the device, so keep it off the GUI thread.
+    if self.isVisible() and not self._fetching:
+      self._fetching = True
+      threading.Thread(target=self._fetch, daemon=True).start()
+
+  def _fetch(self):
+    try:
+      stats = self._client_handler.get_stats()
+      if "devices" in stats:
+        # A device group: shared capture timings, then each device's own.
+        text = f"Capture\n{metrics.format_snapshot(stats['client'])}"
+        for name, device_stats in stats["devices"].items():
+          text += f"\n\n== {name} ==\n"
+          if "error" in device_stats:
+            text += f"Couldn't get timings: {device_stats['error']}\n"
+          else:
+            text += format_stats(device_stats) + "\n"
+          text += f"Frames dropped on the way: {device_stats['frames_dropped']}"
+      else:
+        text = format_stats(stats)
+    except Exception as e:
+      traceback.print_exc()
+      text = f"Couldn't get timings: {e}"
+    finally:
+      self._fetching = False
+    self._stats_fetched.emit(text)
+
 class ClientApp(QtWidgets.QMainWindow):
-  _screen_preview_thread_fired = QtCore.pyqtSignal(name="previewThreadFired")
+  _screen_preview_thread_fired = QtCore.pyqtSignal(object, object, name="previewThreadFired")
   _gif_grabber_done = QtCore.pyqtSignal(int, name="videoGrabberDone")
 
   def __init__(self, client_handler):
@@ -48,37 +118,54 @@ class ClientApp(QtWidgets.QMainWindow):
     self._is_streaming = False
     self._preview_img_unscaled = None
     self._preview_img = None
+    # A device group may want a bigger frame than one matrix.
+    frame_width, frame_height = self._client_handler.frame_size
+    self._pipeline = capturepipeline.CapturePipeline((frame_width, frame_height), metrics=self._client_handler.metrics)
+    self._num_frames = 0
+    self._gif_grabber = None
+    self._gif_upload = None
 
-    self._screen_preview_timer = QtCore.QTimer(self)
-    self._screen_preview_timer.timeout.connect(self._update_screen_preview)
+    # Frames are captured and sent on worker threads; the GUI only shows them.
+    self._screen_preview_thread_fired.connect(self._update_screen_preview)
+    self._send_worker = clientworkers.SendWorker(self._client_handler.process_screen_image, timer=self._pipeline.timer)
+    self._capture_worker = clientworkers.CaptureWorker(
+      self._pipeline, CONFIG['screenPreviewUpdateMillis'] / 1000, self._process_captured_frame,
+      backend=CONFIG['captureBackend'])
 
-    self._gif_grabber = None
     self._gif_grabber_done.connect(self._process_gif_grabber_done)
 
     self._window.combo_resample_method.addItem("Nearest", Image.NEAREST)
     self._window.combo_resample_method.addItem("Bilinear", Image.BILINEAR)
     self._window.combo_resample_method.addItem("Bicubic", Image.BICUBIC)
     self._window.combo_resample_method.addItem("Lanczos", Image.LANCZOS)
-    self._window.combo_resample_method.setCurrentIndex(1)
+    self._window.combo_resample_method.addItem("Area", capturepipeline.AREA)
+    self._window.combo_resample_method.setCurrentIndex(4)
 
-    self._window.combo_resize_method.addItem("Stretch", lambda im, size, resample: im.resize(size, resample=resample))
-    self._window.combo_resize_method.addItem("Crop", lambda im, size, resample: ImageOps.fit(im, size, method=resample))
-    self._window.combo_resize_method.addItem("Pad", lambda im, size, resample: ImageOps.pad(im, size, method=resample, color=(0,0,0)))
+    self._window.combo_resize_method.addItem("Stretch", capturepipeline.STRETCH)
+    self._window.combo_resize_method.addItem("Crop", capturepipeline.CROP)
+    self._window.combo_resize_method.addItem("Pad", capturepipeline.PAD)
     self._window.combo_resize_method.setCurrentIndex(1)
 
-    self._window.push_button_1_1.clicked.connect(lambda : self._set_screen_area(width=1*MATRIX_WIDTH, height=1*MATRIX_HEIGHT))
-    self._window.push_button_1_2.clicked.connect(lambda : self._set_screen_area(width=2*MATRIX_WIDTH, height=2*MATRIX_HEIGHT))
-    self._window.push_button_1_3.clicked.connect(lambda : self._set_screen_area(width=3*MATRIX_WIDTH, height=3*MATRIX_HEIGHT))
-    self._window.push_button_1_4.clicked.connect(lambda : self._set_screen_area(width=4*MATRIX_WIDTH, height=4*MATRIX_HEIGHT))
-    self._window.push_button_1_5.clicked.connect(lambda : self._set_screen_area(width=5*MATRIX_WIDTH, height=5*MATRIX_HEIGHT))
-    self._window.push_button_1_6.clicked.connect(lambda : self._set_screen_area(width=6*MATRIX_WIDTH, height=6*MATRIX_HEIGHT))
-    self._window.push_button_1_7.clicked.connect(lambda : self._set_screen_area(width=7*MATRIX_WIDTH, height=7*MATRIX_HEIGHT))
-    self._window.push_button_1_8.clicked.connect(lambda : self._set_screen_area(width=8*MATRIX_WIDTH, height=8*MATRIX_HEIGHT))
+    self._window.combo_resample_method.currentIndexChanged.connect(self._update_capture_settings)
+    self._window.combo_resize_method.currentIndexChanged.connect(self._update_capture_settings)
+    self._window.checkbox_sharpen.toggled.connect(self._update_capture_settings)
+    self._update_capture_settings()
+
+    self._window.push_button_1_1.clicked.connect(lambda : self._set_screen_area(width=1*frame_width, height=1*frame_height))
+    self._window.push_button_1_2.clicked.connect(lambda : self._set_screen_area(width=2*frame_width, height=2*frame_height))
+    self._window.push_button_1_3.clicked.connect(lambda : self._set_screen_area(width=3*frame_width, height=3*frame_height))
+    self._window.push_button_1_4.clicked.connect(lambda : self._set_screen_area(width=4*frame_width, height=4*frame_height))
+    self._window.push_button_1_5.clicked.connect(lambda : self._set_screen_area(width=5*frame_width, height=5*frame_height))
+    self._window.push_button_1_6.clicked.connect(lambda : self._set_screen_area(width=6*frame_width, height=6*frame_height))
+    self._window.push_button_1_7.clicked.connect(lambda : self._set_screen_area(width=7*frame_width, height=7*frame_height))
+    self._window.push_button_1_8.clicked.connect(lambda : self._set_screen_area(width=8*frame_width, height=8*frame_height))
     self._window.push_button_any_fixed_ratio.clicked.connect(lambda : self._set_screen_area(resizable=True, fixed_ratio=True))
     self._window.push_button_any.clicked.connect(lambda : self._set_screen_area(resizable=True, fixed_ratio=False))
 
     self._window.button_go_live_snapshot.clicked.connect(self._button_go_live_snapshot_clicked)
     self._window.button_go_live_stream.clicked.connect(self._button_go_live_stream_clicked)
+    self._window.button_go_round_robin.clicked.connect(self._button_go_round_robin_clicked)
+    self._window.button_go_black.clicked.connect(self._button_go_black_clicked)
     # self._window.button_take_image.clicked.connect(self._take_image)
     # self._window.button_live.clicked.connect(self._toggle_stream)
 
@@ -86,8 +173,13 @@ class ClientApp(QtWidgets.QMainWindow):
 
     # .setLayout(slot_layout)#
 
-    self._window.label_screen_preview.setMinimumSize(MATRIX_WIDTH, MATRIX_HEIGHT)
-    self._window.label_screen_preview.setMaximumSize(MATRIX_WIDTH, MATRIX_HEIGHT)
+    self._window.label_screen_preview.setMinimumSize(frame_width, frame_height)
+    self._window.label_screen_preview.setMaximumSize(frame_width, frame_height)
+    self._window.statusBar().showMessage("No frames yet.")
+    self._stats_panel = StatsPanel(self._client_handler)
+    stats_button = QtWidgets.QPushButton("Timings")
+    stats_button.clicked.connect(self._stats_panel.show)
+    self._window.statusBar().addPermanentWidget(stats_button)
     self._window.layout().activate()
 
     self._window.setWindowFlags(QtCore.Qt.WindowType.WindowStaysOnTopHint)
@@ -101,6 +193,7 @@ class ClientApp(QtWidgets.QMainWindow):
       self._slot_widgets[-1].button_clear.clicked.connect(lambda _,slot=slot: self._process_slot_clear_click(slot))
       self._slot_widgets[-1].button_get_img.clicked.connect(lambda _,slot=slot: self._process_slot_get_img_click(slot))
       self._slot_widgets[-1].button_get_vid.clicked.connect(lambda _,slot=slot: self._process_slot_get_vid_click(slot))
+      self._slot_widgets[-1].button_go.clicked.connect(lambda _,slot=slot: self._process_slot_go_click(slot))
       self._window.scroll_area_slots_contents.layout().addWidget(self._slot_widgets[-1])
 
     self._window.scroll_area_slots_contents.layout().addStretch()
@@ -109,9 +202,7 @@ class ClientApp(QtWidgets.QMainWindow):
     #self._window.layout().setSizeConstraint(QtWidgets.QLayout.SetFixedSize);
     self._window.show()
 
-    if self._grab_bbox is not None:
-      self._screen_preview_timer.stop()
-      self._screen_preview_timer.start(CONFIG['screenPreviewUpdateMillis'])
+    self._capture_worker.set_bbox(self._grab_bbox)
 
   def _set_screen_area(self, width=128, height=128, resizable=False, fixed_ratio=True):
     """ Launch screengrabber pygame window to select area of the screen. """
@@ -128,14 +219,13 @@ class ClientApp(QtWidgets.QMainWindow):
 
       self._client_handler.update_client_data({"bbox": self._grab_bbox})
       # Ensure we can see a preview image.
-      self._screen_preview_timer.stop()
-      self._screen_preview_timer.start(CONFIG['screenPreviewUpdateMillis'])
+      self._capture_worker.set_bbox(self._grab_bbox)
 
     except:
       # If something fails, deal with it.
       self._show()
       self._grab_bbox = None
-      self._screen_preview_timer.stop()
+      self._capture_worker.set_bbox(None)
       # self._kill_update_preview_thread()
 
   def _update_enabledness(self):
@@ -145,7 +235,8 @@ class ClientApp(QtWidgets.QMainWindow):
       have_slot = self._client_handler.have_slot(slot)
       self._slot_widgets[slot].button_clear.setEnabled(have_slot)
       self._slot_widgets[slot].button_get_img.setEnabled(self._grab_bbox is not None)
-      self._slot_widgets[slot].button_get_vid.setEnabled(self._grab_bbox is not None)
+      # One video at a time.
+      self._slot_widgets[slot].button_get_vid.setEnabled(self._grab_bbox is not None and self._gif_grabber is None)
       self._slot_widgets[slot].button_go.setEnabled(have_slot)
     # self._window.button_take_video.setEnabled(False)
     # self._window.button_live.setEnabled(self._grab_bbox is not None)
@@ -157,6 +248,15 @@ class ClientApp(QtWidgets.QMainWindow):
   def _button_go_live_stream_clicked(self):
     self._client_handler.process_go_live_stream()
 
+  def _button_go_round_robin_clicked(self):
+    self._client_handler.process_go_round_robin()
+
+  def _button_go_black_clicked(self):
+    self._client_handler.process_go_black()
+
+  def _process_slot_go_click(self, slot):
+    self._client_handler.process_show_slot(slot)
+
   def _process_slot_clear_click(self, slot):
     self._client_handler.process_clear_slot(slot)
     self._update_enabledness()
@@ -167,37 +267,53 @@ class ClientApp(QtWidgets.QMainWindow):
     self._update_enabledness()
 
   def _process_slot_get_vid_click(self, slot):
-    self._gif_grabber = gifgrabber.GIFGrabber(callback=lambda slot=slot:self._gif_grabber_done.emit(slot))
+    if self._gif_grabber is not None:
+      print(f"Not getting slot {slot} video, still getting another one.")
+      return
+    # Frames are encoded and uploaded as the grabber confirms them.
+    self._gif_upload = self._client_handler.process_start_slot_vid(slot)
+    self._gif_grabber = gifgrabber.GIFGrabber(
+      callback=lambda slot=slot:self._gif_grabber_done.emit(slot),
+      max_frames=CONFIG['gifGrabberMaxFrames'],
+      perceptual=CONFIG['gifGrabberPerceptualHash'],
+      on_frame=self._gif_upload.add_frame)
     print(f"Getting slot {slot} video.")
+    self._update_enabledness()
 
   def _process_gif_grabber_done(self, slot):
-    imgs = self._gif_grabber.imgs()
-    durs = self._gif_grabber.durations()  
-    self._client_handler.process_set_slot_vid(slot, imgs, durs)
+    self._client_handler.process_finish_slot_vid(slot, self._gif_upload)
     self._gif_grabber = None
+    self._gif_upload = None
     self._update_enabledness()
 
-  def _update_screen_preview(self):
-    # Take an image.
-    assert self._grab_bbox is not None
-    new_preview_img = ImageGrab.grab(bbox=self._grab_bbox)
-    if new_preview_img.width != MATRIX_WIDTH or new_preview_img.height != MATRIX_HEIGHT:
-      resample_method = self._window.combo_resample_method.itemData(self._window.combo_resample_method.currentIndex())
-      resize_function = self._window.combo_resize_method.itemData(self._window.combo_resize_method.currentIndex())
-      new_preview_img = resize_function(im=new_preview_img, size=(MATRIX_WIDTH, MATRIX_HEIGHT), resample=resample_method)
-    if self._window.checkbox_sharpen.isChecked():
-      new_preview_img = new_preview_img.filter(ImageFilter.SHARPEN)
-    self._preview_img = new_preview_img
-
-    # Call handler.
-    self._client_handler.process_screen_image(self._preview_img)
-    if self._gif_grabber is not None:
-      self._gif_grabber.feed_img(self._preview_img)
+  def _update_capture_settings(self):
+    self._capture_worker.set_settings(
+      self._window.combo_resize_method.itemData(self._window.combo_resize_method.currentIndex()),
+      self._window.combo_resample_method.itemData(self._window.combo_resample_method.currentIndex()),
+      self._window.checkbox_sharpen.isChecked())
+
+  def _process_captured_frame(self, frame, img):
+    """ Called on the capture thread with each new frame. """
+    self._send_worker.put(img)
+    gif_grabber = self._gif_grabber
+    if gif_grabber is not None:
+      gif_grabber.feed_img(img)
+    self._screen_preview_thread_fired.emit(frame, img)
+
+  def _update_screen_preview(self, frame, img):
+    self._preview_img = img
 
     # Update preview widget.
-    self._qt_img = PIL_to_qimage(self._preview_img)
-    self._qt_pix = QtGui.QPixmap.fromImage(self._qt_img, QtCore.Qt.ImageConversionFlag.AutoColor)
-    self._window.label_screen_preview.setPixmap(self._qt_pix)
+    with self._pipeline.timer.time("preview"):
+      self._qt_img = numpy_to_qimage(frame)
+      self._qt_pix = QtGui.QPixmap.fromImage(self._qt_img, QtCore.Qt.ImageConversionFlag.AutoColor)
+      self._window.label_screen_preview.setPixmap(self._qt_pix)
+
+    self._num_frames += 1
+    if self._num_frames % STATUS_UPDATE_FRAMES == 0:
+      self._window.statusBar().showMessage(
+        f"{self._capture_worker.backend.name}: {self._pipeline.timer.summary()}, "
+        f"{self._send_worker.num_dropped} frames dropped")
 
   def _hide(self):
     self._window.hide()
@@ -210,8 +326,12 @@ class ClientApp(QtWidgets.QMainWindow):
 
 def main(width=128, height=128):
   import clientlogic
+  import devicegroup
   app = QtWidgets.QApplication(sys.argv)
-  client_logic = clientlogic.ClientLogic()
+  if CONFIG['deviceGroup']:
+    client_logic = devicegroup.DeviceGroup.from_config()
+  else:
+    client_logic = clientlogic.ClientLogic()
   client_app = ClientApp(client_logic)
   app.exec()
 
@@ -2,8 +2,18 @@ from enum import IntEnum
 
 import pathlib
 import json
+import select
+import socket
+import threading
+import time
+import urllib.parse
 
 import requests
+import requests.adapters
+from urllib3.util import Retry
+
+import frameformat
+import slotbatch
 
 class Mode(IntEnum):
     OFF         = 0
@@ -16,41 +26,286 @@ with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
 
 SERVER_STRING = f"http://{CONFIG['connectToIP4Addr']}:{CONFIG['port']}"
 TIMEOUT = CONFIG['api_timeout']
+# How often the live stream's ack reader checks whether the stream was closed.
+ACK_POLL_SECONDS = 0.5
+
+class LiveStream:
+  """ Persistent TCP connection that pushes raw live frames to the device.
+
+  Frames are sent back-to-back and acks are read on a background thread. At
+  most max_in_flight frames may be unacknowledged; further frames are dropped
+  rather than queued so a slow device never builds up latency.
+  """
+  def __init__(self, host : str, port : int, max_in_flight : int, on_ack=None):
+    self._sock = socket.create_connection((host, port), timeout=TIMEOUT)
+    self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._max_in_flight = max_in_flight
+    self._on_ack = on_ack
+    self._lock = threading.Lock()
+    self._in_flight = 0
+    self._closed = False
+    self.last_acked_seq = None
+    self.num_dropped = 0
+    self.num_bytes_sent = 0
+    self._ack_thread = threading.Thread(target=self._read_acks, daemon=True)
+    self._ack_thread.start()
+
+  def is_open(self) -> bool:
+    return not self._closed
+
+  def send_frame(self, frame_data : bytes) -> bool:
+    """ Send a raw frame. Returns False if it was dropped. """
+    with self._lock:
+      if self._closed:
+        raise ConnectionError("Live stream is closed")
+      if self._in_flight >= self._max_in_flight:
+        self.num_dropped += 1
+        return False
+      self._in_flight += 1
+    try:
+      self._sock.sendall(frameformat.STREAM_LENGTH.pack(len(frame_data)) + frame_data)
+    except OSError:
+      self.close()
+      raise
+    self.num_bytes_sent += frameformat.STREAM_LENGTH.size + len(frame_data)
+    return True
+
+  def close(self):
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+    try:
+      self._sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    self._sock.close()
+
+  def _read_acks(self):
+    """ Read acks until the stream closes. The socket's timeout belongs to
+    the sender, so this waits on select instead, and gives up once frames
+    have gone unacknowledged for TIMEOUT. """
+    try:
+      buffer = b""
+      waiting_since = time.monotonic()
+      while not self._closed:
+        readable, _, _ = select.select([self._sock], [], [], ACK_POLL_SECONDS)
+        if not readable:
+          with self._lock:
+            waiting = self._in_flight > 0
+          if not waiting:
+            waiting_since = time.monotonic()
+          elif time.monotonic() - waiting_since > TIMEOUT:
+            print(f"Live stream: no ack for {TIMEOUT}s, closing it")
+            break
+          continue
+        data = self._sock.recv(4096)
+        if not data:
+          break
+        waiting_since = time.monotonic()
+        buffer += data
+        while len(buffer) >= frameformat.STREAM_ACK.size:
+          seq, status = frameformat.STREAM_ACK.unpack_from(buffer)
+          buffer = buffer[frameformat.STREAM_ACK.size:]
+          with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+            self.last_acked_seq = seq
+          if self._on_ack is not None:
+            self._on_ack(seq, status)
+    except (OSError, ValueError):
+      # ValueError: the socket was closed under select.
+      pass
+    self.close()
+
+class CallStats:
+  """ Latency of one kind of API call, in ms. """
+  def __init__(self):
+    self.count = 0
+    self.errors = 0
+    self.bytes_sent = 0
+    self.total_ms = 0.0
+    self.max_ms = 0.0
+    self.last_ms = 0.0
+
+  def record(self, ms : float, ok : bool, bytes_sent : int = 0):
+    self.count += 1
+    self.errors += 0 if ok else 1
+    self.bytes_sent += bytes_sent
+    self.total_ms += ms
+    self.max_ms = max(self.max_ms, ms)
+    self.last_ms = ms
+
+  def as_dict(self) -> dict:
+    return {
+      "count": self.count,
+      "errors": self.errors,
+      "bytes_sent": self.bytes_sent,
+      "mean_ms": self.total_ms / self.count if self.count else 0.0,
+      "max_ms": self.max_ms,
+      "last_ms": self.last_ms,
+    }
 
 class ClientAPI:
-  def __init__(self, base_url=SERVER_STRING):
+  def __init__(self, base_url=SERVER_STRING, stream_port=CONFIG['streamPort']):
     self.base_url = base_url
+    self.stream_port = stream_port
     self.matrix_driver = None
+    # One keep-alive session for every call. Only idempotent methods are
+    # retried, so a live frame or slot upload is never sent twice.
+    retry = Retry(
+      total=CONFIG['apiRetries'],
+      backoff_factor=CONFIG['apiRetryBackoff'],
+      status_forcelist=(502, 503, 504),
+      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS)
+    adapter = requests.adapters.HTTPAdapter(
+      pool_connections=1, pool_maxsize=CONFIG['apiPoolSize'], max_retries=retry)
+    self._session = requests.Session()
+    self._session.mount("http://", adapter)
+    self._stats_lock = threading.Lock()
+    self._call_stats = {}
+
+  def _request(self, name : str, method : str, path : str, ok_status=(200, 201, 204), **kwargs) -> requests.Response:
+    """ Make a request through the session, recording how long it took under name. """
+    start = time.perf_counter()
+    ok = False
+    try:
+      res = self._session.request(method, f"{self.base_url}{path}", timeout=TIMEOUT, **kwargs)
+      ok = res.status_code in ok_status
+      return res
+    finally:
+      ms = 1000 * (time.perf_counter() - start)
+      data = kwargs.get("data")
+      bytes_sent = len(data) if isinstance(data, (bytes, bytearray)) else 0
+      with self._stats_lock:
+        self._call_stats.setdefault(name, CallStats()).record(ms, ok, bytes_sent)
+
+  def get_call_stats(self) -> dict:
+    """ Latency stats for each kind of call made so far. """
+    with self._stats_lock:
+      return {name: stats.as_dict() for name, stats in self._call_stats.items()}
 
   def clear_slot(self, slot_index : int) -> bool:
-    res = requests.delete(f"{self.base_url}/slot/{slot_index}", timeout=TIMEOUT)
+    res = self._request("clear_slot", "DELETE", f"/slot/{slot_index}")
     if res.status_code != 200:
       print(res.content)
     return res.status_code == 200
 
   def set_slot(self, slot_index : int, gif_data : bytes | None) -> bool:
-    res = requests.post(f"{self.base_url}/slot/{slot_index}", data=gif_data, timeout=TIMEOUT)
-    if res.status_code != 200:
+    res = self._request("set_slot", "POST", f"/slot/{slot_index}", data=gif_data)
+    if res.status_code != 201:
+      print(res.content)
+    return res.status_code == 201
+
+  def set_slot_stream(self, slot_index : int, chunks) -> bool:
+    """ Set a slot from an iterator of GIF bytes, sent as they come. """
+    res = self._request("set_slot_stream", "POST", f"/slot/{slot_index}", data=chunks)
+    if res.status_code != 201:
       print(res.content)
+    return res.status_code == 201
+
+  def assign_slot(self, slot_index : int, content_hash : str) -> bool:
+    """ Point a slot at a GIF the device already has, without sending it.
+    Returns False if the device doesn't have it. """
+    res = self._request("assign_slot", "POST", f"/slot/{slot_index}/assign", json={"hash": content_hash})
+    if res.status_code not in (201, 404):
+      print(res.content)
+    return res.status_code == 201
 
   def get_slot(self, slot_index : int) -> bytes | None:
-    res = requests.get(f"{self.base_url}/slot/{slot_index}", timeout=TIMEOUT)
+    res = self._request("get_slot", "GET", f"/slot/{slot_index}")
     if res.status_code == 200:
       return res.content
     if res.status_code == 204:
       return None
     raise RuntimeError(f"Server gave HTTP{res.status_code}: {res.content.decode('utf-8')}")
 
+  def get_slots(self) -> [dict | None]:
+    """ Get the size and hash of every slot, None for empty slots. """
+    res = self._request("get_slots", "GET", "/slots")
+    if res.status_code == 200:
+      return res.json()["slots"]
+    raise RuntimeError(f"Server gave HTTP{res.status_code}: {res.content.decode('utf-8')}")
+
+  def set_slots(self, slot_data : {int: bytes | None}) -> bool:
+    """ Set several slots in one request. None clears a slot. """
+    batch = slotbatch.encode_batch({
+      slot_index: (slotbatch.SLOT_EMPTY, None) if gif_data is None else (slotbatch.SLOT_DATA, gif_data)
+      for slot_index, gif_data in slot_data.items()})
+    res = self._request("set_slots", "POST", "/slots/batch", data=batch,
+                        headers={"Content-Type": "application/octet-stream"})
+    if res.status_code != 201:
+      print(res.content)
+    return res.status_code == 201
+
+  def get_slots_batch(self, slot_indices : list[int] | None = None, known_hashes : [str] = ()) -> {int: bytes | None}:
+    """ Get several slots (all if slot_indices is None) in one request.
+
+    Slots whose content hash is in known_hashes are left out of the result,
+    so data the caller already has is never sent again. Empty slots map to
+    None.
+    """
+    params = {} if slot_indices is None else {"slots": ",".join(str(i) for i in slot_indices)}
+    headers = {"If-None-Match": ", ".join(slotbatch.etag(h) for h in known_hashes)} if known_hashes else {}
+    res = self._request("get_slots_batch", "GET", "/slots/batch", params=params, headers=headers)
+    if res.status_code != 200:
+      raise RuntimeError(f"Server gave HTTP{res.status_code}: {res.content.decode('utf-8')}")
+    return {slot_index: data for slot_index, (state, data) in slotbatch.decode_batch(res.content).items()
+            if state != slotbatch.SLOT_UNCHANGED}
+
   def set_live(self, gif_data : bytes) -> bool:
     """ Set a live image. """
-    res = requests.post(f"{self.base_url}/live", data=gif_data, timeout=TIMEOUT)
+    res = self._request("set_live", "POST", "/live", data=gif_data)
+    if res.status_code != 201:
+      print(res.content)
+    return res.status_code == 201
+
+  def set_live_frame(self, frame_data : bytes) -> bool:
+    """ Set a live image from a raw frame (see frameformat.py). """
+    res = self._request("set_live_frame", "POST", "/live/frame", data=frame_data,
+                        headers={"Content-Type": "application/octet-stream"})
     if res.status_code != 201:
       print(res.content)
+    return res.status_code == 201
+
+  def open_live_stream(self, on_ack=None) -> LiveStream:
+    """ Open a persistent live frame stream to the device. """
+    host = urllib.parse.urlsplit(self.base_url).hostname
+    return LiveStream(host, self.stream_port, CONFIG['streamMaxInFlight'], on_ack=on_ack)
 
   def set_mode(self, mode : Mode, slot : int | None) -> bool:
-    res = requests.get(f"{self.base_url}/slot/{slot}", json={"mode": int(mode)}, timeout=TIMEOUT)
+    res = self._request("set_mode", "POST", "/mode", json={"mode": int(mode), "slot": slot})
+    if res.status_code != 200:
+      print(res.content)
     return res.status_code == 200
 
+  def get_slot_stats(self) -> dict:
+    """ Get the device's slot playback timing stats. """
+    res = self._request("get_slot_stats", "GET", "/slotstats")
+    if res.status_code == 200:
+      return res.json()
+    raise RuntimeError(f"Server gave HTTP{res.status_code}: {res.content.decode('utf-8')}")
+
+  def get_live_stats(self) -> dict:
+    """ Get the device's jitter buffer stats for live frames. """
+    res = self._request("get_live_stats", "GET", "/livestats")
+    if res.status_code == 200:
+      return res.json()
+    raise RuntimeError(f"Server gave HTTP{res.status_code}: {res.content.decode('utf-8')}")
+
   def ping(self, ping_id : int) -> int:
-    res = requests.get(f"{self.base_url}/ping/{ping_id}", json={"ping_id": int(ping_id)}, timeout=TIMEOUT)
+    res = self._request("ping", "GET", f"/ping/{ping_id}", json={"ping_id": int(ping_id)})
     return res.json()["check_int"]
+
+  def get_device_time(self) -> float:
+    """ The device's time.time(), read during a ping. """
+    res = self._request("ping", "GET", "/ping/0")
+    if res.status_code == 200:
+      return res.json()["device_time"]
+    raise RuntimeError(f"Server gave HTTP{res.status_code}: {res.content.decode('utf-8')}")
+
+  def get_metrics(self) -> dict:
+    """ Get the device's stage timings (see DeviceAPI.get_metrics). """
+    res = self._request("get_metrics", "GET", "/metrics")
+    if res.status_code == 200:
+      return res.json()
+    raise RuntimeError(f"Server gave HTTP{res.status_code}: {res.content.decode('utf-8')}")
@@ -1,13 +1,20 @@
 from enum import Enum
+import hashlib
 import io
 import json
 import os
 import pathlib
+import threading
+import time
 from typing import Any
 
 from PIL import Image, ImageChops
 
 import clientapi
+import frameformat
+import gifstream
+import metrics
+import quantize
 
 with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
     CONFIG = json.load(f)
@@ -19,76 +26,281 @@ class Mode(Enum):
    SLOT_ROUND_ROBIN = 3
    DARK = 4
 
+# Live image encodings, keyed by their name in config.json. None means GIF.
+LIVE_FORMATS = {
+    "gif": None,
+    "rgb888": frameformat.FrameFormat.RGB888,
+    "rgb565": frameformat.FrameFormat.RGB565,
+}
+
 class ClientLogic:
 
-    def __init__(self):
-        """ Constructor for client logic class. """
-        self._client_api = clientapi.ClientAPI()
+    def __init__(self, client_api : clientapi.ClientAPI | None = None):
+        """ Constructor for client logic class. Talks to the configured
+        device unless given a client_api. """
+        self._client_api = clientapi.ClientAPI() if client_api is None else client_api
         self._mode = Mode.DARK
         self._last_screen_img = None
+        self._live_format = LIVE_FORMATS[CONFIG['liveFrameFormat']]
+        self._live_seq = 0
+        self._live_stream = None
+        # Last live image sent to the device. Cleared when the device rejects
+        # a frame, so the next capture goes out even if nothing changed.
+        self._live_sent_img = None
+        # Last raw live image the device was sent, which delta frames build on.
+        self._live_base_img = None
+        self._live_keyframe_seq = 0
+        self._live_need_keyframe = True
+        # Live GIFs share a palette so colours hold steady between frames.
+        self._live_quantizer = quantize.Quantizer()
+        # Client-side stage timings, in ms.
+        self.metrics = metrics.Metrics()
+        # Size of the screen images to capture for the device.
+        self.frame_size = (CONFIG['matrixWidth'], CONFIG['matrixHeight'])
+        # Screen images arrive on a worker thread, button clicks on the GUI
+        # thread. _lock guards the mode and latest image and is never held
+        # over a network call, so a stalled send can't hold up the GUI.
+        self._lock = threading.Lock()
+        # Live images go out one at a time, in order, as each builds on the last.
+        self._live_lock = threading.Lock()
         self._location = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
         self._have_slot = [False] * CONFIG['numSlots']
+        # Content hash of each slot's GIF, where we know it.
+        self._slot_hashes = [None] * CONFIG['numSlots']
 
         # Check if we got slots.
-        for i in range(CONFIG['numSlots']):
-            if self._client_api.get_slot(i) is not None:
-                self._have_slot[i] = True
+        for i, slot_info in enumerate(self._client_api.get_slots()):
+            self._have_slot[i] = slot_info is not None
+            self._slot_hashes[i] = None if slot_info is None else slot_info["hash"]
 
     def have_slot(self, slot : int) -> bool:
         """ Check if we have a slot. """
         return self._have_slot[slot]
 
+    def set_live_format(self, name : str):
+        """ Choose how live images are encoded ("gif", "rgb888" or "rgb565"). """
+        self._live_format = LIVE_FORMATS[name]
+
     def process_screen_image(self, screen_img):
         """ Process a fresh image captured from the screen. """
-        if self._mode == Mode.LIVE_STREAM:
-            # Keep blasting if it's on stream mode.
-            diff = ImageChops.difference(self._last_screen_img, screen_img)
-            if diff.getbbox() is not None:
-              self._send_live_img(screen_img)
-
-        self._last_screen_img = screen_img
+        with self._lock:
+            self._last_screen_img = screen_img
+            streaming = self._mode == Mode.LIVE_STREAM
+        if streaming:
+            # Keep blasting if it's on stream mode. Compare with what was
+            # last sent, so a frame the stream dropped goes again even if
+            # the screen has stopped changing.
+            with self._live_lock:
+                if self._live_sent_img is None or \
+                   ImageChops.difference(self._live_sent_img, screen_img).getbbox() is not None:
+                    self._send_live_img(screen_img)
 
     def process_go_live_screenshot(self):
         """ We're going live with a snapshot. """
-        if self._last_screen_img is not None:
-            self._send_live_img(self._last_screen_img)
-        self._mode = Mode.LIVE_SNAPSHOT
+        self._send_last_screen_img()
+        with self._lock:
+            self._mode = Mode.LIVE_SNAPSHOT
 
     def process_go_live_stream(self):
         """ We're going live with a stream."""
-        if self._last_screen_img is not None:
-            self._send_live_img(self._last_screen_img)
-        self._mode = Mode.LIVE_STREAM
+        self._send_last_screen_img()
+        with self._lock:
+            self._mode = Mode.LIVE_STREAM
+
+    def process_show_slot(self, slot : int) -> bool:
+        """ Show one slot on the matrix. """
+        return self._set_mode(clientapi.Mode.SHOW_SLOT, slot, Mode.SLOT_SPECIFIC)
+
+    def process_go_round_robin(self) -> bool:
+        """ Cycle through all slots on the matrix. """
+        return self._set_mode(clientapi.Mode.ROUND_ROBIN, None, Mode.SLOT_ROUND_ROBIN)
+
+    def process_go_black(self) -> bool:
+        """ Turn the matrix off. """
+        return self._set_mode(clientapi.Mode.OFF, None, Mode.DARK)
 
-    def process_clear_slot(self, slot : int):
+    def _set_mode(self, device_mode : clientapi.Mode, slot : int | None, mode : Mode) -> bool:
+        """ Switch the device to a mode that isn't live. Returns whether the
+        device did. """
+        # Stop streaming first so no new live frame follows the switch. One
+        # already being sent isn't waited for.
+        with self._lock:
+            previous_mode, self._mode = self._mode, mode
+        if not self._client_api.set_mode(device_mode, slot):
+            with self._lock:
+                if self._mode == mode:
+                    self._mode = previous_mode
+            return False
+        return True
+
+    def _send_last_screen_img(self):
+        """ Send the latest screen image as a live image. If the capture
+        thread is sending one right now, that one stands in for it rather
+        than keeping the caller waiting. """
+        with self._lock:
+            img = self._last_screen_img
+        if img is None or not self._live_lock.acquire(blocking=False):
+            return
+        try:
+            self._send_live_img(img)
+        finally:
+            self._live_lock.release()
+
+    def process_clear_slot(self, slot : int) -> bool:
         """ Clear a slot. """
-        if self._client_api.clear_slot(slot):
-            self._have_slot[slot] = False
+        if not self._client_api.clear_slot(slot):
+            return False
+        self._have_slot[slot] = False
+        self._slot_hashes[slot] = None
+        return True
 
-    def process_set_slot(self, slot : int, img : Image.Image | None):
+    def process_set_slot(self, slot : int, img : Image.Image | None) -> bool:
         """ Set a slot for an image. """
         if img is None:
-            self._client_api.set_slot(slot, None)
+            if not self._client_api.set_slot(slot, None):
+                return False
             self._have_slot[slot] = False
+            self._slot_hashes[slot] = None
+            return True
+        buffer = io.BytesIO()
+        quantize.Quantizer().quantize(img).save(buffer, format="gif")
+        return self._set_slot_data(slot, buffer.getvalue())
+
+    def process_set_slot_vid(self, slot : int, imgs : [Image], durations : [int]) -> bool:
+        """ Set a slot for a video. """
+        return self._set_slot_data(slot, gifstream.encode_gif(imgs, durations))
+
+    def _set_slot_data(self, slot : int, gif_data : bytes) -> bool:
+        content_hash = hashlib.sha1(gif_data).hexdigest()
+        # If another slot already has this GIF the device has it too, so
+        # just point this slot at it.
+        if content_hash in self._slot_hashes and self._client_api.assign_slot(slot, content_hash):
+            ok = True
         else:
-            buffer = io.BytesIO()
-            img.save(buffer, format="gif")
-            self._client_api.set_slot(slot, buffer.getvalue())
+            ok = self._client_api.set_slot(slot, gif_data)
+        if ok:
             self._have_slot[slot] = True
+            self._slot_hashes[slot] = content_hash
+        return ok
 
+    def process_start_slot_vid(self, slot : int) -> gifstream.GIFStreamUpload:
+        """ Start uploading a video to a slot while it is being recorded.
+        Add frames to the returned upload as they are confirmed. """
+        return gifstream.GIFStreamUpload(lambda chunks: self._client_api.set_slot_stream(slot, chunks))
 
-    def process_set_slot_vid(self, slot : int, imgs : [Image], durations : [int]):
-        """ Set a slot for a video. """
-        buffer = io.BytesIO()
-        imgs[0].save(buffer, format="gif", save_all=True, append_images=imgs[1:], duration=durations, loop=0)
-        self._client_api.set_slot(slot, buffer.getvalue())
+    def process_finish_slot_vid(self, slot : int, upload : gifstream.GIFStreamUpload) -> bool:
+        """ Finish a video upload started with process_start_slot_vid. """
+        if not upload.finish():
+            return False
         self._have_slot[slot] = True
+        self._slot_hashes[slot] = None
+        return True
 
     def _send_live_img(self, img):
-        buffer = io.BytesIO()
-        img.save(buffer, format="gif")
-        # TODO: update to better API.
-        self._client_api.set_live(buffer.getvalue())
+        """ Encode and send a live image. Call with _live_lock held. """
+        if self._live_format is None:
+            with self.metrics.time("encode"):
+                buffer = io.BytesIO()
+                self._live_quantizer.quantize(img).save(buffer, format="gif")
+            with self.metrics.time("upload"):
+                sent = self._client_api.set_live(buffer.getvalue())
+            if sent:
+                self._live_sent_img = img
+            self._live_base_img = None
+            return
+
+        seq = (self._live_seq + 1) & 0xFFFFFFFF
+        with self.metrics.time("encode"):
+            frame_data, is_keyframe = self._encode_live_frame(img, seq)
+        if frame_data is None:
+            return
+        with self.metrics.time("upload"):
+            sent = self._send_live_frame(frame_data)
+        if sent:
+            self._live_seq = seq
+            self._live_sent_img = img
+            self._live_base_img = img
+            if is_keyframe:
+                self._live_keyframe_seq = seq
+                self._live_need_keyframe = False
+
+    def _encode_live_frame(self, img, seq : int) -> (bytes | None, bool):
+        """ Encode a live image as a delta frame if possible, else a keyframe. """
+        capture_time = img.info.get("capture_time", time.time())
+        if CONFIG['liveDelta'] and self._mode == Mode.LIVE_STREAM and not self._live_need_keyframe and \
+           self._live_base_img is not None and self._live_base_img.size == img.size and \
+           seq - self._live_keyframe_seq < CONFIG['liveKeyframeInterval']:
+            boxes = frameformat.find_dirty_boxes(self._live_base_img, img, CONFIG['liveDeltaTileSize'])
+            if not boxes:
+                return None, False
+            frame_data = frameformat.encode_delta_frame(img, boxes, self._live_format, seq, timestamp=capture_time)
+            # Big changes are cheaper to send whole.
+            full_size = img.width * img.height * frameformat.BYTES_PER_PIXEL[self._live_format]
+            if len(frame_data) < full_size:
+                return frame_data, False
+        return frameformat.encode_frame(img, self._live_format, seq, timestamp=capture_time), True
+
+    def _send_live_frame(self, frame_data : bytes) -> bool:
+        """ Send a raw live frame. Returns False if it didn't go out. """
+        if CONFIG['liveTransport'] == "stream" and self._mode == Mode.LIVE_STREAM:
+            try:
+                if self._live_stream is None or not self._live_stream.is_open():
+                    self._live_stream = self._client_api.open_live_stream(on_ack=self._process_live_ack)
+                return self._live_stream.send_frame(frame_data)
+            except OSError as e:
+                # Fall back to a plain HTTP post for this frame.
+                print(f"Live stream unavailable: {e}")
+                self._live_stream = None
+        if not self._client_api.set_live_frame(frame_data):
+            self._live_need_keyframe = True
+            return False
+        return True
+
+    def _process_live_ack(self, seq : int, status : int):
+        """ Called from the live stream's ack thread. """
+        if status == frameformat.ACK_OK:
+            return
+        # Wait for the send the ack may have overtaken to record its frame,
+        # so that doesn't undo this.
+        with self._live_lock:
+            if seq >= self._live_keyframe_seq:
+                # The device lost track of our frames, start again from a
+                # keyframe and don't trust that it shows what we last sent.
+                self._live_need_keyframe = True
+                self._live_sent_img = None
+                self._live_base_img = None
+
+    def get_transfer_stats(self) -> dict:
+        """ Bytes sent to the device so far, and live frames the stream
+        dropped because the device was behind. """
+        bytes_sent = sum(stats["bytes_sent"] for stats in self._client_api.get_call_stats().values())
+        live_stream = self._live_stream
+        if live_stream is None:
+            return {"bytes_sent": bytes_sent, "live_frames_dropped": 0}
+        return {
+            "bytes_sent": bytes_sent + live_stream.num_bytes_sent,
+            "live_frames_dropped": live_stream.num_dropped,
+        }
+
+    def get_stats(self) -> dict:
+        """ Client and device stage timings in ms, with the device's
+        capture-to-display latency corrected for the clock offset. """
+        clock_offset, round_trip = metrics.estimate_clock_offset(self._client_api.get_device_time)
+        device = self._client_api.get_metrics()
+        stages = dict(device["stages"])
+        latency = stages.pop("capture_to_display", None)
+        if latency is not None:
+            stages["glass_to_led"] = {
+                key: value - 1000 * clock_offset if key != "count" else value
+                for key, value in latency.items()}
+        return {
+            "client": self.metrics.snapshot(),
+            "device": stages,
+            "live": device["live"],
+            "render_dropped": device["render_dropped"],
+            "clock_offset_ms": 1000 * clock_offset,
+            "round_trip_ms": 1000 * round_trip,
+        }
 
     def update_client_data(self, tochange: {str: Any}):
         """Update client's local data.
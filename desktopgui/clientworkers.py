@@ -0,0 +1,126 @@
+"""Background threads for the desktop client.
+
+Screen capture and sending frames to the device both block, so neither runs
+on the Qt GUI thread. The capture worker grabs and processes frames at a
+fixed rate and hands them to callbacks; the send worker uploads the newest
+frame it has been given and drops any it didn't get to in time.
+"""
+import collections
+import threading
+import time
+import traceback
+
+from PIL import Image
+
+import capturebackend
+
+class CaptureWorker:
+
+    def __init__(self, pipeline, interval : float, on_frame, backend : str = "auto"):
+        """ Constructor.
+
+        Captures every interval seconds through pipeline (a
+        capturepipeline.CapturePipeline) and calls on_frame(frame, img) on the
+        capture thread with a copy of the frame as an array and as a PIL image.
+        backend names the capture backend, see capturebackend.create_backend.
+        """
+        self._pipeline = pipeline
+        self._backend_name = backend
+        self.backend = None
+        self._interval = interval
+        self._on_frame = on_frame
+        self._cv = threading.Condition()
+        self._bbox = None
+        self._settings = None
+        self._stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def set_bbox(self, bbox) -> None:
+        """ Set the screen area to capture, or None to pause. """
+        with self._cv:
+            self._bbox = bbox
+            self._cv.notify()
+
+    def set_settings(self, resize_method : str, resample, sharpen : bool) -> None:
+        with self._cv:
+            self._settings = (resize_method, resample, sharpen)
+
+    def stop(self) -> None:
+        with self._cv:
+            self._stopped = True
+            self._cv.notify()
+        self.thread.join()
+
+    def _run(self):
+        """ Code for the capture thread. """
+        # X connections belong to the thread that opens them.
+        self.backend = capturebackend.create_backend(self._backend_name)
+        try:
+            self._capture_loop()
+        finally:
+            self.backend.close()
+
+    def _capture_loop(self):
+        timer = self._pipeline.timer
+        deadline = time.monotonic()
+        while True:
+            with self._cv:
+                while not self._stopped and (self._bbox is None or self._settings is None):
+                    self._cv.wait()
+                    deadline = time.monotonic()
+                if self._stopped:
+                    return
+                bbox = self._bbox
+                resize_method, resample, sharpen = self._settings
+
+            try:
+                with timer.time("capture"):
+                    capture_time = time.time()
+                    grab = self.backend.grab(bbox)
+                frame = self._pipeline.process(grab, resize_method, resample, sharpen).copy()
+                img = Image.fromarray(frame)
+                # Lets the device pace live frames (see jitterbuffer.py).
+                img.info["capture_time"] = capture_time
+                self._on_frame(frame, img)
+            except Exception:
+                traceback.print_exc()
+
+            # Keep to a fixed rate, but don't try to catch up on missed frames.
+            deadline = max(deadline + self._interval, time.monotonic())
+            with self._cv:
+                self._cv.wait(max(0.0, deadline - time.monotonic()))
+
+class SendWorker:
+    """ Passes frames to a handler on its own thread, newest frame wins. """
+
+    def __init__(self, handler, timer=None):
+        self._handler = handler
+        self._timer = timer
+        self._frames = collections.deque(maxlen=1)
+        self._cv = threading.Condition()
+        self.num_dropped = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, img) -> None:
+        with self._cv:
+            if self._frames:
+                self.num_dropped += 1
+            self._frames.append(img)
+            self._cv.notify()
+
+    def _run(self):
+        """ Code for the send thread. """
+        while True:
+            with self._cv:
+                while not self._frames:
+                    self._cv.wait()
+                img = self._frames.popleft()
+            start = time.perf_counter()
+            try:
+                self._handler(img)
+            except Exception:
+                traceback.print_exc()
+            if self._timer is not None:
+                self._timer.record("send", 1000 * (time.perf_counter() - start))
@@ -6,15 +6,24 @@ import pathlib
 import sys
 import threading
 
+import asyncserver
 import deviceapi
 import matrixdriver
 import server
+import streamserver
 
 from PIL import Image
 
 with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
     CONFIG = json.load(f)
 
+def set_thread_affinity(thread, cpu, name):
+  if cpu is not None:
+    old_affinity = os.sched_getaffinity(thread.native_id)
+    new_affinity = [cpu]
+    print(f'Changing {name} thread ({thread.native_id}) affinity from {old_affinity} to {new_affinity}')
+    os.sched_setaffinity(thread.native_id, new_affinity)
+
 
 if __name__ == "__main__":
   # Need to initialise Pillow here to avoid bug.
@@ -23,20 +32,32 @@ if __name__ == "__main__":
 
   matrix_driver = matrixdriver.MatrixDriver()
   device_api = deviceapi.DeviceAPI(matrix_driver)
-  matrix_server = server.matrix_server(device_api)
+  if CONFIG['serverBackend'] == "asyncio":
+    matrix_server = asyncserver.matrix_async_server(device_api)
+  else:
+    matrix_server = server.matrix_server(device_api)
   server_thread = threading.Thread(target=matrix_server, kwargs={
      "host": CONFIG['listenIP4Addr'],
      "port": CONFIG['port'],
      "debug": False
   })
 
+  stream_server = streamserver.matrix_stream_server(device_api)
+  stream_thread = threading.Thread(target=stream_server, kwargs={
+     "host": CONFIG['listenIP4Addr'],
+     "port": CONFIG['streamPort']
+  }, daemon=True)
+
   server_thread.start()
+  stream_thread.start()
 
-  if CONFIG['flaskThreadCpuAffinity'] is not None:
-    old_affinity = os.sched_getaffinity(server_thread.native_id)
-    new_affinity = [CONFIG['flaskThreadCpuAffinity']]
-    print(f'Changing flask thread ({server_thread.native_id}) affinity from {old_affinity} to {new_affinity}')
-    os.sched_setaffinity(server_thread.native_id, new_affinity)
+  set_thread_affinity(server_thread, CONFIG['flaskThreadCpuAffinity'], "server")
+  set_thread_affinity(stream_thread, CONFIG['streamThreadCpuAffinity'], "stream")
+  set_thread_affinity(matrix_driver.render_thread, CONFIG['renderThreadCpuAffinity'], "render")
+  set_thread_affinity(device_api.slot_player.thread, CONFIG['slotThreadCpuAffinity'], "slot")
+  if device_api.jitter_buffer is not None:
+    # It only hands frames to the render thread, so keep it beside it.
+    set_thread_affinity(device_api.jitter_buffer.thread, CONFIG['renderThreadCpuAffinity'], "jitter")
 
 
 
@@ -2,12 +2,26 @@ import io
 import json
 import os
 import pathlib
+import queue
 import shutil
 import sys
+import threading
+import time
+import traceback
 from enum import IntEnum
 
 from PIL import Image
 
+import frameformat
+import jitterbuffer
+import metrics
+import slotbatch
+import slotcache
+import slotfile
+import slotplayer
+import slotstore
+import slots
+
 class Mode(IntEnum):
     OFF         = 0
     ROUND_ROBIN = 1
@@ -17,66 +31,254 @@ class Mode(IntEnum):
 with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
     CONFIG = json.load(f)
     SLOT_DATA_DIR = pathlib.Path(CONFIG['slotDataDir'])
-    SLOT_DATA_DIR.mkdir(parents=True, exist_ok=True)
-    shutil.chown(SLOT_DATA_DIR, user=CONFIG['user'], group=CONFIG['group'])
-    os.chmod(SLOT_DATA_DIR, 0o777)
+
+def prepare_slot_data_dir(slot_data_dir) -> None:
+  """ Create the slot directory and hand it to the matrix user. Ownership
+  is best effort, so this also works unprivileged, e.g. on a CI machine. """
+  slot_data_dir = pathlib.Path(slot_data_dir)
+  slot_data_dir.mkdir(parents=True, exist_ok=True)
+  try:
+    shutil.chown(slot_data_dir, user=CONFIG['user'], group=CONFIG['group'])
+    os.chmod(slot_data_dir, 0o777)
+  except (LookupError, OSError) as e:
+    print(f"Leaving ownership of {slot_data_dir} as it is: {e}")
 
 class DeviceAPI:
-  def __init__(self, matrix_driver):
+  def __init__(self, matrix_driver, slot_data_dir=None):
     #self._device_gui = device_gui
     self.matrix_driver = matrix_driver
+    self.num_slots = CONFIG['numSlots']
+    # Shared with the driver, if it keeps any, so one snapshot covers both.
+    self.metrics = getattr(matrix_driver, "metrics", None) or metrics.Metrics()
+    self._live_lock = threading.Lock()
+    self._live_img = None
+    self._live_seq = None
+    # Paces timestamped live frames, if enabled.
+    self.jitter_buffer = None
+    if CONFIG['jitterBufferEnabled']:
+      self.jitter_buffer = jitterbuffer.JitterBuffer(
+        matrix_driver.set_image,
+        tick_hz=CONFIG['jitterBufferTickHz'],
+        min_delay=CONFIG['jitterBufferMinMillis'] / 1000,
+        max_delay=CONFIG['jitterBufferMaxMillis'] / 1000,
+        window=CONFIG['jitterBufferWindow'])
+    self._mode = Mode.OFF
+    slot_data_dir = SLOT_DATA_DIR if slot_data_dir is None else slot_data_dir
+    prepare_slot_data_dir(slot_data_dir)
+    self.slot_store = slotstore.SlotStore(slot_data_dir, CONFIG['numSlots'])
+    self.slot_cache = slotcache.SlotCache(matrix_driver, CONFIG['slotCacheBytes'], load_frames=self._load_slot_frames)
+    self.slot_player = slotplayer.SlotPlayer(
+      matrix_driver,
+      self.slot_store.get,
+      num_slots=CONFIG['numSlots'],
+      minimum_slot_time=CONFIG['minimumSlotTime'],
+      late_threshold=CONFIG['slotLateThresholdMillis'] / 1000,
+      cache=self.slot_cache,
+      has_slot=lambda index: self.slot_store.info(index) is not None)
+    # Slow work on uploaded slots happens on this thread.
+    self._slot_jobs = queue.SimpleQueue()
+    self.slot_worker = threading.Thread(target=self._run_slot_jobs, daemon=True)
+    self.slot_worker.start()
 
   def clear_slot(self, slot_index : int) -> bool:
-    filename = SLOT_DATA_DIR / f'{slot_index}.gif'
     try:
-      filename.unlink()
-      return True
+      return self.slot_store.clear(slot_index)
     except:
       return False
+    finally:
+      self._slots_changed([slot_index])
 
   def set_slot(self, slot_index : int, gif_data : bytes | None) -> bool:
-    filename = SLOT_DATA_DIR / f'{slot_index}.gif'
-    if gif_data is None:
-      # Clear it if it exists.
-      print(f"Removing {filename} [set_slot({slot_index}, None)]")
-      raise RuntimeError(f"TODO: Deal with None data in set_slow")
-    else:
-      # Write it to a file.
-      print(f"Writing new data to {filename} [set_slot({slot_index}, <bytes>)]")
-      with open(filename, 'wb') as f:
-          f.write(gif_data)
+    """ Set one slot. None clears it. """
+    return self.set_slots({slot_index: gif_data})
+
+  def set_slots(self, slot_data : {int: bytes | None}) -> bool:
+    """ Set several slots at once. None clears a slot.
+
+    New GIFs are written atomically, and all of them are on disk before
+    any slot points at them.
+    """
+    print(f"Writing new data to slots {sorted(slot_data)} [set_slots(<{len(slot_data)} GIFs>)]")
+    hashes = self.slot_store.set_slots(slot_data)
+    for slot_index, gif_data in slot_data.items():
+      if gif_data is not None:
+        self._prepare_slot(hashes[slot_index], gif_data)
+    self._slots_changed(slot_data)
+    return True
+
+  def assign_slot(self, slot_index : int, content_hash : str) -> bool:
+    """ Point a slot at a GIF the device already has, by its hash. Returns
+    False if the device doesn't have it. """
+    if not self.slot_store.assign(slot_index, content_hash):
+      return False
+    self._slots_changed([slot_index])
     return True
 
   def get_slot(self, slot_index : int) -> bytes | None:
-    try:
-      filename = SLOT_DATA_DIR / f'{slot_index}.gif'
-      with open(filename, 'rb') as f:
-        return True, f.read()
-    except:
+    slot_data = self.slot_store.get(slot_index)
+    if slot_data is None:
       return False, None
+    return True, slot_data[1]
+
+  def get_slots(self) -> [dict | None]:
+    """ Get the size and SHA-1 of every slot's GIF, None for empty slots. """
+    return [self.get_slot_info(slot_index) for slot_index in range(CONFIG['numSlots'])]
+
+  def get_slot_info(self, slot_index : int) -> dict | None:
+    """ Get the size and SHA-1 of a slot's GIF, None if it is empty. """
+    return self.slot_store.info(slot_index)
+
+  def get_slots_batch(self, slot_indices : list[int] | None, known_hashes : set) -> {int: (int, bytes | None)}:
+    """ Get several slots (all if slot_indices is None) as batch entries (see
+    slotbatch.py). Slots whose hash is in known_hashes are marked unchanged
+    rather than sent. """
+    if slot_indices is None:
+      slot_indices = range(CONFIG['numSlots'])
+    entries = {}
+    for slot_index in slot_indices:
+      info = self.get_slot_info(slot_index)
+      if info is None:
+        entries[slot_index] = (slotbatch.SLOT_EMPTY, None)
+      elif info["hash"] in known_hashes:
+        entries[slot_index] = (slotbatch.SLOT_UNCHANGED, None)
+      else:
+        res, gif_data = self.get_slot(slot_index)
+        entries[slot_index] = (slotbatch.SLOT_DATA, gif_data) if res else (slotbatch.SLOT_EMPTY, None)
+    return entries
+
+  def _slots_changed(self, slot_indices):
+    for slot_index in slot_indices:
+      self.slot_player.slot_changed(slot_index)
+    # Drop GIFs no slot shows any more. On the slot worker so it never races
+    # a conversion.
+    self._slot_jobs.put(self._collect_garbage)
+
+  def _collect_garbage(self):
+    for content_hash in self.slot_store.gc():
+      self.slot_cache.discard(content_hash)
+
+  def _prepare_slot(self, content_hash : str, gif_data : bytes):
+    """ Get new slot data ready to show. """
+    if CONFIG['slotCompactFormat'] and not self.slot_store.frames_path(content_hash).exists():
+      self._slot_jobs.put(lambda: self._convert_slot(content_hash, gif_data))
+    else:
+      self.slot_cache.warm(content_hash, gif_data)
+
+  def _convert_slot(self, content_hash : str, gif_data : bytes):
+    """ Write the compact version of slot data, then decode it into the cache. """
+    filename = self.slot_store.frames_path(content_hash)
+    print(f"Converting {content_hash} to {filename}")
+    slotfile.write_slot_file(filename, gif_data)
+    self.slot_cache.warm(content_hash, gif_data)
+
+  def _load_slot_frames(self, content_hash : str, gif_data : bytes, spare_canvases):
+    """ Load slot data's frames from its compact file if there is one, else from the GIF. """
+    try:
+      with slotfile.SlotFile(self.slot_store.frames_path(content_hash)) as slot_file:
+        if slot_file.source_hash == slotfile.source_hash(gif_data):
+          return slots.render_frames(slot_file, self.matrix_driver, spare_canvases=spare_canvases)
+    except (OSError, ValueError, RuntimeError):
+      pass
+    return slots.decode_frames(gif_data, self.matrix_driver, spare_canvases=spare_canvases)
+
+  def _run_slot_jobs(self):
+    """ Code for the slot worker thread. """
+    while True:
+      job = self._slot_jobs.get()
+      try:
+        job()
+      except Exception:
+        traceback.print_exc()
 
   def set_mode(self, mode : Mode, slot : int | None) -> bool:
-    pass
+    if mode == Mode.SHOW_SLOT:
+      if slot is None:
+        raise RuntimeError(f"Mode {mode.name} needs a slot")
+      self.slot_player.show_slot(slot)
+    elif mode == Mode.ROUND_ROBIN:
+      self.slot_player.round_robin()
+    else:
+      self.slot_player.stop()
+    if mode != Mode.LIVE and self.jitter_buffer is not None:
+      # Don't let buffered live frames draw over the new mode.
+      self.jitter_buffer.clear()
+    if mode == Mode.OFF:
+      self.matrix_driver.set_image(Image.new("RGB", (CONFIG['matrixWidth'], CONFIG['matrixHeight'])))
+    self._mode = mode
+    return True
 
-  def set_live(self, gif_data : bytes) -> bool:
+  def get_slot_stats(self) -> dict:
+    return self.slot_player.stats()
+
+  def set_live(self, gif_data : bytes | None) -> bool:
+    """ Show a GIF live. Only its first frame is shown; None blanks the matrix. """
     if gif_data is None:
-        raise RuntimeError(f"TODO: Deal with None data in set_live")
+      im = Image.new("RGB", (CONFIG['matrixWidth'], CONFIG['matrixHeight']))
     else:
-        Image._initialized = 0
-        print(gif_data, flush=True)
-        print(Image.__version__)
-        print(type(gif_data), type(type(gif_data)), flush=True)
-        fp = io.BytesIO(gif_data)
-        fp.seek(0)
-        with Image.open(fp) as im:#, formats=["GIF"]
-            if im.n_frames < 1 or im.n_frames > 1:
-              raise RuntimeError(f"TODO: Deal with .gif that has {im.n_frames} frames")
-
-            im.seek(0)  # skip to the first frame
-
-            # self._device_gui.set_preview(im)
-            self.matrix_driver.set_image(im.convert('RGB'))
+      Image._initialized = 0
+      fp = io.BytesIO(gif_data)
+      fp.seek(0)
+      with self.metrics.time("decode"), Image.open(fp) as im:#, formats=["GIF"]
+        im.seek(0)  # skip to the first frame
+        im = im.convert('RGB')
+
+    # self._device_gui.set_preview(im)
+    self._enter_live_mode()
+    with self._live_lock:
+      self._live_img = None
+      self.matrix_driver.set_image(im)
+    return True
+
+  def set_live_frame(self, frame_data : bytes) -> bool:
+    """ Set a live image from a raw frame (see frameformat.py). """
+    header = frameformat.decode_header(frame_data)
+    self._enter_live_mode()
+    with self._live_lock:
+      decode_start = time.perf_counter()
+      if header.flags & frameformat.FLAG_DELTA:
+        # Patch a copy of the current live image, never one the driver holds.
+        if self._live_img is None or self._live_seq is None or \
+           header.seq != (self._live_seq + 1) & 0xFFFFFFFF or \
+           self._live_img.size != (header.width, header.height):
+          raise frameformat.ResyncRequired(f"Can't apply delta frame {header.seq} after frame {self._live_seq}")
+        im = self._live_img.copy()
+        for position, patch in frameformat.decode_delta_rects(frame_data, header):
+          im.paste(patch, position)
+      else:
+        _, im = frameformat.decode_frame(frame_data)
+      self._live_img = im
+      self._live_seq = header.seq
+      timestamp = frameformat.decode_timestamp(frame_data, header)
+      # The driver times capture to display from this.
+      if timestamp is None:
+        im.info.pop("capture_time", None)
+      else:
+        im.info["capture_time"] = timestamp
+      self.metrics.record("decode", 1000 * (time.perf_counter() - decode_start))
+      if self.jitter_buffer is not None and timestamp is not None:
+        self.jitter_buffer.put(im, timestamp)
+      else:
+        self.matrix_driver.set_image(im)
     return True
-  
+
+  def get_live_stats(self) -> dict:
+    """ Jitter buffer figures for live frames, or {} if it is off. """
+    return {} if self.jitter_buffer is None else self.jitter_buffer.stats()
+
+  def get_metrics(self) -> dict:
+    """ Stage timings in ms, plus the device's clock so they can be lined
+    up with the client's. """
+    return {
+      "device_time": time.time(),
+      "stages": self.metrics.snapshot(),
+      "live": self.get_live_stats(),
+      "render_dropped": getattr(self.matrix_driver, "num_dropped_frames", 0),
+    }
+
+  def _enter_live_mode(self):
+    # Live images replace whatever slot was playing.
+    if self._mode != Mode.LIVE:
+      self.set_mode(Mode.LIVE, None)
+
   def ping(self, data : int) -> int:
     return -data
@@ -0,0 +1,193 @@
+"""Driving several matrices from one capture stream.
+
+A device group stands in for ClientLogic when config.json lists devices under
+deviceGroup. Each device shows a rectangle of the captured frame, so the
+frame can be tiled across the devices or mirrored on all of them:
+
+  "deviceGroup" : [
+    {"name": "left", "host": "192.168.0.37", "rect": [0, 0, 128, 128]},
+    {"name": "right", "host": "192.168.0.38", "rect": [128, 0, 128, 128]}
+  ]
+
+port and streamPort default to the ones in config.json. The captured frame
+is as big as the rectangles need; a rectangle that isn't the matrix's size
+is scaled to fit.
+
+Every device has its own ClientLogic, connection and sending thread, and
+keeps only the newest frame it hasn't sent yet. A slow device drops its own
+frames rather than holding up the others. Commands (modes, slots) go to all
+devices at once, each device running its own in order on a thread of its
+own. The caller waits at most deviceGroupCommandSeconds for them; a device
+that takes longer finishes in the background and reports its own failure.
+"""
+import collections
+import concurrent.futures
+import json
+import pathlib
+import threading
+import traceback
+
+from PIL import Image
+
+import clientapi
+import clientlogic
+import clientworkers
+import gifstream
+import metrics
+
+with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
+    CONFIG = json.load(f)
+
+_Member = collections.namedtuple("_Member", ["name", "box", "logic", "sender", "commands"])
+
+class GroupUpload:
+    """ A video upload to the same slot of every device in a group. """
+
+    def __init__(self, group, uploads : {str: gifstream.GIFStreamUpload}):
+        self._group = group
+        self.uploads = uploads
+
+    def add_frame(self, img : Image.Image, duration : int) -> None:
+        for member in self._group._members:
+            self.uploads[member.name].add_frame(self._group._crop(member, img), duration)
+
+class DeviceGroup:
+
+    def __init__(self, endpoints : [dict]):
+        """ Constructor. Devices that can't be reached are left out. """
+        self.metrics = metrics.Metrics()
+        self._matrix_size = (CONFIG['matrixWidth'], CONFIG['matrixHeight'])
+        self._members = []
+        for endpoint in endpoints:
+            name = endpoint.get("name", endpoint["host"])
+            x, y, w, h = endpoint.get("rect", (0, 0, *self._matrix_size))
+            try:
+                client_api = clientapi.ClientAPI(
+                    f"http://{endpoint['host']}:{endpoint.get('port', CONFIG['port'])}",
+                    stream_port=endpoint.get("streamPort", CONFIG['streamPort']))
+                logic = clientlogic.ClientLogic(client_api=client_api)
+            except Exception as e:
+                print(f"Leaving {name} out of the device group: {e}")
+                continue
+            sender = clientworkers.SendWorker(logic.process_screen_image, timer=logic.metrics)
+            commands = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"group-{name}")
+            self._members.append(_Member(name, (x, y, x + w, y + h), logic, sender, commands))
+        if not self._members:
+            raise RuntimeError("None of the devices in the group could be reached")
+        self.frame_size = (max(member.box[2] for member in self._members), max(member.box[3] for member in self._members))
+        self._command_timeout = CONFIG['deviceGroupCommandSeconds']
+        self._failures_lock = threading.Lock()
+        self._failures = collections.Counter()
+
+    @classmethod
+    def from_config(cls) -> "DeviceGroup":
+        return cls(CONFIG['deviceGroup'])
+
+    def _crop(self, member : _Member, img : Image.Image) -> Image.Image:
+        """ The part of a captured image a device shows. """
+        if member.box == (0, 0, *img.size) and img.size == self._matrix_size:
+            return img
+        part = img.crop(member.box)
+        if part.size != self._matrix_size:
+            part = part.resize(self._matrix_size, Image.BOX)
+        return part
+
+    def _broadcast(self, func) -> bool:
+        """ Call func(member) for every device at once and wait for them,
+        but no longer than the command deadline. Returns False if any of
+        them failed or is still busy. Each failure is reported with the
+        device's name, including those that come after the deadline. """
+        futures = {}
+        for member in self._members:
+            future = member.commands.submit(func, member)
+            future.add_done_callback(lambda future, member=member: self._report(member, future))
+            futures[future] = member
+        done, not_done = concurrent.futures.wait(futures, timeout=self._command_timeout)
+        for future in not_done:
+            print(f"Device {futures[future].name} is still busy after {self._command_timeout}s, carrying on without it")
+        return not not_done and all(not future.exception() and future.result() is not False for future in done)
+
+    def _report(self, member : _Member, future : concurrent.futures.Future):
+        """ Print why a device's command failed, on the thread it ran on. """
+        error = future.exception()
+        if error is None and future.result() is not False:
+            return
+        with self._failures_lock:
+            self._failures[member.name] += 1
+        if error is None:
+            print(f"Device {member.name} failed")
+        else:
+            print(f"Device {member.name} failed:")
+            traceback.print_exception(error)
+
+    def have_slot(self, slot : int) -> bool:
+        return all(member.logic.have_slot(slot) for member in self._members)
+
+    def set_live_format(self, name : str):
+        for member in self._members:
+            member.logic.set_live_format(name)
+
+    def process_screen_image(self, screen_img):
+        """ Hand each device its part of a fresh image. Never blocks. """
+        for member in self._members:
+            member.sender.put(self._crop(member, screen_img))
+
+    def process_go_live_screenshot(self):
+        self._broadcast(lambda member: member.logic.process_go_live_screenshot())
+
+    def process_go_live_stream(self):
+        self._broadcast(lambda member: member.logic.process_go_live_stream())
+
+    def process_show_slot(self, slot : int):
+        self._broadcast(lambda member: member.logic.process_show_slot(slot))
+
+    def process_go_round_robin(self):
+        self._broadcast(lambda member: member.logic.process_go_round_robin())
+
+    def process_go_black(self):
+        self._broadcast(lambda member: member.logic.process_go_black())
+
+    def process_clear_slot(self, slot : int):
+        self._broadcast(lambda member: member.logic.process_clear_slot(slot))
+
+    def process_set_slot(self, slot : int, img : Image.Image | None):
+        self._broadcast(lambda member: member.logic.process_set_slot(slot, None if img is None else self._crop(member, img)))
+
+    def process_set_slot_vid(self, slot : int, imgs : [Image], durations : [int]):
+        self._broadcast(lambda member: member.logic.process_set_slot_vid(slot, [self._crop(member, img) for img in imgs], durations))
+
+    def process_start_slot_vid(self, slot : int) -> GroupUpload:
+        return GroupUpload(self, {member.name: member.logic.process_start_slot_vid(slot) for member in self._members})
+
+    def process_finish_slot_vid(self, slot : int, upload : GroupUpload):
+        self._broadcast(lambda member: member.logic.process_finish_slot_vid(slot, upload.uploads[member.name]))
+
+    def get_stats(self) -> dict:
+        """ Capture timings, plus each device's stats as ClientLogic.get_stats
+        gives them, with the frames it dropped and commands that failed. A
+        device that doesn't answer by the command deadline gets an error. """
+        def member_stats(member):
+            try:
+                stats = member.logic.get_stats()
+            except Exception as e:
+                stats = {"error": str(e)}
+            stats["frames_dropped"] = member.sender.num_dropped + member.logic.get_transfer_stats()["live_frames_dropped"]
+            return stats
+        futures = {member.name: member.commands.submit(member_stats, member) for member in self._members}
+        concurrent.futures.wait(futures.values(), timeout=self._command_timeout)
+        devices = {}
+        for name, future in futures.items():
+            devices[name] = future.result() if future.done() else {"error": "No answer in time"}
+            with self._failures_lock:
+                devices[name]["commands_failed"] = self._failures[name]
+        return {
+            "client": self.metrics.snapshot(),
+            "devices": devices,
+        }
+
+    def update_client_data(self, tochange : dict):
+        # Client data is kept locally, not on the devices.
+        self._members[0].logic.update_client_data(tochange)
+
+    def get_client_data(self, key : str, default):
+        return self._members[0].logic.get_client_data(key, default)
@@ -13,19 +13,11 @@ def square():
 
     matrix.send_to_matrix()
 
-def moving_square():
-    x_move = 0
-    y_move = 0
-    while True:
-        matrix.reset()
-        for x in range(0, 63):
-            for y in range(0, 63):
-                matrix.set_pixel(x + x_move, y + y_move, (255,255,255))
-        x_move += 10
-        y_move += 12
-        x_move %= 64
-        y_move %= 64
-        matrix.send_to_matrix()
-        time.sleep(1)
+def moving_square(t, dt):
+    # 10 and 12 pixels a second, wrapping every 64.
+    x_move = int(10 * t) % 64
+    y_move = int(12 * t) % 64
+    matrix.frame.clear()
+    matrix.frame.fill_rect(x_move, y_move, 63, 63, (255,255,255))
 
-matrix.run(moving_square)
\ No newline at end of file
+matrix.run(moving_square, fps=60)
\ No newline at end of file
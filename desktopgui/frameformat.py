@@ -0,0 +1,200 @@
+"""Raw frame format used to send live images to the device.
+
+A frame is a small fixed-size header followed by uncompressed pixel data, so
+the device can turn it into an image without running a GIF decoder.
+"""
+import collections
+import struct
+from enum import IntEnum
+
+from PIL import Image, ImageChops
+
+class FrameFormat(IntEnum):
+    RGB888 = 0
+    RGB565 = 1
+
+FRAME_MAGIC = b"MF"
+# Magic, format, flags, width, height, sequence number.
+FRAME_HEADER = struct.Struct("<2sBBHHI")
+
+FrameHeader = collections.namedtuple("FrameHeader", ["format", "flags", "width", "height", "seq"])
+
+# The frame only holds the rectangles that changed since frame seq - 1.
+FLAG_DELTA = 0x01
+# The header is followed by the time the frame was captured, in seconds
+# since the epoch on the client's clock.
+FLAG_TIMESTAMP = 0x02
+
+FRAME_TIMESTAMP = struct.Struct("<d")
+
+# Rectangle count of a delta frame, then x, y, width, height of each
+# rectangle followed by its pixels.
+DELTA_COUNT = struct.Struct("<H")
+DELTA_RECT = struct.Struct("<HHHH")
+
+class ResyncRequired(RuntimeError):
+    """ A delta frame can't be applied, the client must send a keyframe. """
+
+BYTES_PER_PIXEL = {
+    FrameFormat.RGB888: 3,
+    FrameFormat.RGB565: 2,
+}
+
+# Pillow raw codec names for each format. "BGR;16" is little-endian RGB565
+# with red in the top five bits.
+RAW_MODES = {
+    FrameFormat.RGB888: "RGB",
+    FrameFormat.RGB565: "BGR;16",
+}
+
+def pack_pixels(img : Image.Image, fmt : FrameFormat) -> bytes:
+    """ Pack an RGB image into raw pixel data of the given format. """
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if fmt == FrameFormat.RGB888:
+        return img.tobytes()
+    if fmt == FrameFormat.RGB565:
+        # Pillow has no RGB565 packer, so build the two bytes of each pixel
+        # as separate bands. The bit fields don't overlap, so add is an OR.
+        r, g, b = img.split()
+        hi = ImageChops.add(r.point(lambda v: v & 0xF8), g.point(lambda v: v >> 5))
+        lo = ImageChops.add(g.point(lambda v: (v << 3) & 0xE0), b.point(lambda v: v >> 3))
+        return Image.merge("LA", (lo, hi)).tobytes()
+    raise RuntimeError(f"Unsupported frame format {fmt}")
+
+def unpack_pixels(data, size : (int, int), fmt : FrameFormat) -> Image.Image:
+    """ Turn raw pixel data of the given format into an RGB image. """
+    expected = size[0] * size[1] * BYTES_PER_PIXEL[fmt]
+    if len(data) != expected:
+        raise RuntimeError(f"Expected {expected} bytes of pixel data but got {len(data)}")
+    return Image.frombuffer("RGB", size, data, "raw", RAW_MODES[fmt], 0, 1)
+
+def _encode_header(img : Image.Image, fmt : FrameFormat, seq : int, flags : int, timestamp : float | None) -> bytes:
+    if timestamp is None:
+        return FRAME_HEADER.pack(FRAME_MAGIC, int(fmt), flags, img.width, img.height, seq & 0xFFFFFFFF)
+    return FRAME_HEADER.pack(FRAME_MAGIC, int(fmt), flags | FLAG_TIMESTAMP, img.width, img.height, seq & 0xFFFFFFFF) + \
+        FRAME_TIMESTAMP.pack(timestamp)
+
+def encode_frame(img : Image.Image, fmt : FrameFormat, seq : int, flags : int = 0, timestamp : float = None) -> bytes:
+    """ Encode an image as a raw frame, with its capture time if given. """
+    return _encode_header(img, fmt, seq, flags, timestamp) + pack_pixels(img, fmt)
+
+def encode_delta_frame(img : Image.Image, boxes : [(int, int, int, int)], fmt : FrameFormat, seq : int, timestamp : float = None) -> bytes:
+    """ Encode the given boxes (left, top, right, bottom) of an image as a delta frame. """
+    parts = [
+        _encode_header(img, fmt, seq, FLAG_DELTA, timestamp),
+        DELTA_COUNT.pack(len(boxes)),
+    ]
+    for box in boxes:
+        parts.append(DELTA_RECT.pack(box[0], box[1], box[2] - box[0], box[3] - box[1]))
+        parts.append(pack_pixels(img.crop(box), fmt))
+    return b"".join(parts)
+
+def decode_delta_rects(data : bytes, header : FrameHeader) -> [((int, int), Image.Image)]:
+    """ Decode the rectangles of a delta frame into (position, image) pairs. """
+    view = memoryview(data)
+    offset = payload_offset(header)
+    (count,) = DELTA_COUNT.unpack_from(view, offset)
+    offset += DELTA_COUNT.size
+    rects = []
+    for _ in range(count):
+        x, y, width, height = DELTA_RECT.unpack_from(view, offset)
+        offset += DELTA_RECT.size
+        if x + width > header.width or y + height > header.height:
+            raise RuntimeError(f"Delta rectangle {width}x{height}+{x}+{y} is outside the frame")
+        size = width * height * BYTES_PER_PIXEL[header.format]
+        rects.append(((x, y), unpack_pixels(view[offset:offset+size], (width, height), header.format)))
+        offset += size
+    if offset != len(data):
+        raise RuntimeError(f"Delta frame has {len(data) - offset} trailing bytes")
+    return rects
+
+def find_dirty_boxes(old : Image.Image, new : Image.Image, tile : int) -> [(int, int, int, int)]:
+    """ Find the tiles of a fixed grid that differ between two images.
+
+    Adjacent dirty tiles are merged into larger boxes (left, top, right,
+    bottom), first along rows and then down columns of identical runs.
+    """
+    diff = ImageChops.difference(old, new)
+    bbox = diff.getbbox()
+    if bbox is None:
+        return []
+    r, g, b = diff.split()
+    mask = ImageChops.lighter(ImageChops.lighter(r, g), b)
+
+    runs = {}
+    for top in range(bbox[1] // tile * tile, bbox[3], tile):
+        bottom = min(top + tile, new.height)
+        run_left = None
+        for left in range(bbox[0] // tile * tile, bbox[2], tile):
+            right = min(left + tile, new.width)
+            if mask.crop((left, top, right, bottom)).getbbox() is not None:
+                if run_left is None:
+                    run_left = left
+                run_right = right
+            elif run_left is not None:
+                runs.setdefault(top, []).append((run_left, run_right))
+                run_left = None
+        if run_left is not None:
+            runs.setdefault(top, []).append((run_left, run_right))
+
+    # Grow boxes downwards while the next tile row has the same run.
+    boxes = []
+    open_boxes = {}
+    for top in sorted(runs):
+        bottom = min(top + tile, new.height)
+        next_open = {}
+        for span in runs[top]:
+            box = open_boxes.pop(span, None)
+            if box is not None and box[3] == top:
+                next_open[span] = (box[0], box[1], box[2], bottom)
+            else:
+                if box is not None:
+                    boxes.append(box)
+                next_open[span] = (span[0], top, span[1], bottom)
+        boxes.extend(open_boxes.values())
+        open_boxes = next_open
+    boxes.extend(open_boxes.values())
+    return boxes
+
+def decode_header(data : bytes) -> FrameHeader:
+    """ Parse and validate the header of a raw frame. """
+    if len(data) < FRAME_HEADER.size:
+        raise RuntimeError(f"Frame of {len(data)} bytes is too short for a header")
+    magic, fmt, flags, width, height, seq = FRAME_HEADER.unpack_from(data)
+    if magic != FRAME_MAGIC:
+        raise RuntimeError(f"Bad frame magic {magic!r}")
+    try:
+        fmt = FrameFormat(fmt)
+    except ValueError:
+        raise RuntimeError(f"Unsupported frame format {fmt}")
+    if flags & FLAG_TIMESTAMP and len(data) < FRAME_HEADER.size + FRAME_TIMESTAMP.size:
+        raise RuntimeError(f"Frame of {len(data)} bytes is too short for a timestamp")
+    return FrameHeader(fmt, flags, width, height, seq)
+
+def payload_offset(header : FrameHeader) -> int:
+    """ Where a frame's pixels (or delta rectangles) start. """
+    return FRAME_HEADER.size + (FRAME_TIMESTAMP.size if header.flags & FLAG_TIMESTAMP else 0)
+
+def decode_timestamp(data : bytes, header : FrameHeader) -> float | None:
+    """ The frame's capture time, or None if it doesn't have one. """
+    if not header.flags & FLAG_TIMESTAMP:
+        return None
+    (timestamp,) = FRAME_TIMESTAMP.unpack_from(data, FRAME_HEADER.size)
+    return timestamp
+
+def decode_frame(data : bytes) -> (FrameHeader, Image.Image):
+    """ Decode a raw frame into its header and an RGB image. """
+    header = decode_header(data)
+    pixels = memoryview(data)[payload_offset(header):]
+    return header, unpack_pixels(pixels, (header.width, header.height), header.format)
+
+# Live stream framing (see streamserver.py). The client sends each frame
+# prefixed by its length and the device answers with an ack per frame.
+STREAM_LENGTH = struct.Struct("<I")
+STREAM_ACK = struct.Struct("<IB")
+STREAM_MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+ACK_OK = 0
+ACK_ERROR = 1
+ACK_RESYNC = 2
@@ -1,76 +1,108 @@
+import hashlib
 import threading
 import time
 
-from PIL import ImageChops
+from PIL import Image
+
+# Size and bits per pixel of the thumbnail used for perceptual hashing.
+PERCEPTUAL_HASH_SIZE = (8, 8)
+PERCEPTUAL_HASH_BITS = 4
+
+def exact_hash(img) -> bytes:
+    """ Hash of a frame's exact pixels. """
+    return hashlib.blake2b(img.tobytes(), digest_size=16).digest()
+
+def perceptual_hash(img) -> bytes:
+    """ Hash of a coarse greyscale thumbnail of a frame, so frames that differ
+    only by a little noise usually hash the same. """
+    thumb = img.convert("L").resize(PERCEPTUAL_HASH_SIZE, resample=Image.BOX)
+    shift = 8 - PERCEPTUAL_HASH_BITS
+    return bytes(v >> shift for v in thumb.getdata())
 
 class GIFGrabber:
 
-    def __init__(self, callback):
-        """ Constructor. """
+    def __init__(self, callback, max_frames : int = None, perceptual : bool = False, on_frame=None):
+        """ Constructor.
+
+        Records frames until the first frame comes round again (or max_frames
+        distinct frames are held) and then calls callback. A frame that
+        repeats an earlier one is dropped. With perceptual set, frames count
+        as repeats when they look the same rather than only when they are
+        identical. on_frame(img, duration) is called with each frame that is
+        kept once its duration is known, in order.
+        """
         self._callback = callback
+        self._max_frames = max_frames
+        self._hash = perceptual_hash if perceptual else exact_hash
+        self._on_frame = on_frame
+        self._lock = threading.Lock()
+        # Held while calling on_frame, so frames go out in order without
+        # holding _lock.
+        self._on_frame_lock = threading.Lock()
         self._imgs = []
-        self._img_timestamps = []
-        self._valid_frame_indices = []
         self._durations = []
-        self._processing_index = -1
-        self._processing_semaphore = threading.Semaphore(0)
-        self._processing_thread = threading.Thread(target=self._process)
-        self._processing_thread.start()
+        self._frame_indices = {}
+        self._last_timestamp = None
+        self._done = False
+        self.num_dropped = 0
 
     def feed_img(self, img):
-        """ Feed an new frame to the image grabber. """
-        self._imgs.append(img)
-        self._img_timestamps.append(time.perf_counter())
-        self._processing_semaphore.release()
-
-    def _process(self):
-        """ Code for internal processing thread. """
-        not_done = True
-
-        while (not_done):
-            self._processing_semaphore.acquire()
-            self._processing_index += 1
-
-            # Work out if the frame is new.
-            first_repeat = None
-            for i in range(self._processing_index):
-                diff = ImageChops.difference(self._imgs[i], self._imgs[self._processing_index])
-                if diff.getbbox() is None:
-                    first_repeat = i
-                    break
-
+        """ Feed an new frame to the image grabber. Safe to call from any thread. """
+        timestamp = time.perf_counter()
+        key = self._hash(img)
+        done = False
+        confirmed = None
+        with self._lock:
+            if self._done:
+                return
+            first_repeat = self._frame_indices.get(key)
+            if first_repeat is None and self._max_frames is not None and len(self._imgs) >= self._max_frames:
+                # Out of room, finish with what we have.
+                first_repeat = 0
             if first_repeat is None:
                 # The frame is new, should be part of the .gif.
-                self._valid_frame_indices.append(self._processing_index)
-                if self._processing_index > 0:
-                    # Store duration for previous valid frame.
-                    self._durations.append(int(1000*(self._img_timestamps[self._processing_index] - self._img_timestamps[self._valid_frame_indices[-2]])))
+                if self._imgs:
+                    # Store duration for previous frame.
+                    confirmed = self._confirm_frame(int(1000*(timestamp - self._last_timestamp)))
+                self._frame_indices[key] = len(self._imgs)
+                self._imgs.append(img)
+                self._last_timestamp = timestamp
             else:
-                # If the frame is not new, and the frame we are repeating is
-                # the starting frame, but we do have more than one frame then we're done.
-                if first_repeat == 0 and len(self._valid_frame_indices) > 1:
+                self.num_dropped += 1
+                # If the frame is repeating the starting frame, but we do have
+                # more than one frame then we're done.
+                if first_repeat == 0 and len(self._imgs) > 1:
                     # Store duration for last frame.
-                    self._durations.append(int(1000*(self._img_timestamps[self._processing_index] - self._img_timestamps[self._valid_frame_indices[-1]])))
-                    not_done = False
-                    self._callback()
+                    confirmed = self._confirm_frame(int(1000*(timestamp - self._last_timestamp)))
+                    self._done = True
+                    done = True
+            if confirmed is not None and self._on_frame is not None:
+                # Take our place in line before letting the next frame in.
+                self._on_frame_lock.acquire()
+
+        if confirmed is not None and self._on_frame is not None:
+            try:
+                self._on_frame(*confirmed)
+            finally:
+                self._on_frame_lock.release()
+
+        if done:
+            self._callback()
+
+    def _confirm_frame(self, duration : int) -> tuple:
+        """ Store the duration of the latest frame. Call with _lock held.
+        Returns the (img, duration) to hand to on_frame. """
+        self._durations.append(duration)
+        return self._imgs[len(self._durations) - 1], duration
 
     def imgs(self):
         """ Return frames. """
-        assert len(self._valid_frame_indices)>0
-        return [self._imgs[i] for i in self._valid_frame_indices]
+        with self._lock:
+            assert len(self._imgs)>0
+            return list(self._imgs)
 
     def durations(self):
         """ Return durations. """
-        assert len(self._valid_frame_indices)>0
-        return self._durations
-
-
-
-
-
-
-
-
-
-
-
+        with self._lock:
+            assert len(self._imgs)>0
+            return list(self._durations)
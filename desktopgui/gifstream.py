@@ -0,0 +1,126 @@
+"""Streaming GIF encoding for slot uploads.
+
+Frames are encoded one at a time as they are recorded, so the GIF can be
+uploaded while it is still being made. The global palette comes from the
+first frame; later frames only carry a palette of their own if they bring
+colours the quantizer had to add. Identical consecutive frames are merged
+into one longer frame.
+"""
+import queue
+import threading
+import traceback
+
+from PIL import GifImagePlugin, Image
+
+import quantize
+
+GIF_TRAILER = b";"
+
+class GIFStreamEncoder:
+
+    def __init__(self, quantizer : quantize.Quantizer = None, loop : int = 0):
+        """ Constructor. Frames are mapped to colours by quantizer. """
+        self._quantizer = quantizer or quantize.Quantizer()
+        self._loop = loop
+        self._global_version = None
+        self._pending = None
+        self._pending_version = None
+        self._pending_duration = 0
+
+    def add_frame(self, img : Image.Image, duration : int) -> bytes:
+        """ Add a frame shown for duration ms. Returns the bytes of the GIF
+        that are ready to send, which may be none. """
+        chunks = []
+        frame = self._quantizer.quantize(img)
+        version = self._quantizer.version
+        if self._global_version is None:
+            header, _ = GifImagePlugin.getheader(frame, info={"loop": self._loop})
+            chunks.extend(header)
+            self._global_version = version
+
+        if self._pending is not None and self._pending_version == version and \
+           self._pending.tobytes() == frame.tobytes():
+            # Same as the last frame, just show that for longer.
+            self._pending_duration += duration
+        else:
+            chunks.extend(self._flush())
+            self._pending = frame
+            self._pending_version = version
+            self._pending_duration = duration
+        return b"".join(chunks)
+
+    def finish(self) -> bytes:
+        """ Returns the rest of the GIF. """
+        assert self._global_version is not None, "No frames added"
+        return b"".join(self._flush()) + GIF_TRAILER
+
+    def _flush(self) -> [bytes]:
+        if self._pending is None:
+            return []
+        # The frame's duration goes in its header, so a frame can only be
+        # written once the next different one turns up.
+        chunks = GifImagePlugin.getdata(self._pending, duration=self._pending_duration,
+                                        include_color_table=self._pending_version != self._global_version)
+        self._pending = None
+        return chunks
+
+def encode_gif(imgs : [Image.Image], durations : [int], quantizer : quantize.Quantizer = None) -> bytes:
+    """ Encode a whole animation in one go. """
+    encoder = GIFStreamEncoder(quantizer)
+    chunks = [encoder.add_frame(img, duration) for img, duration in zip(imgs, durations)]
+    chunks.append(encoder.finish())
+    return b"".join(chunks)
+
+class ChunkStream:
+    """ Bytes produced on one thread, consumed as an iterator on another.
+
+    requests sends an iterator body with chunked transfer encoding.
+    """
+
+    def __init__(self):
+        self._chunks = queue.SimpleQueue()
+
+    def put(self, chunk : bytes) -> None:
+        if chunk:
+            self._chunks.put(chunk)
+
+    def close(self) -> None:
+        self._chunks.put(None)
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+class GIFStreamUpload:
+    """ Encodes frames and sends them as they come, on its own thread. """
+
+    def __init__(self, send, quantizer : quantize.Quantizer = None):
+        """ Constructor. send(chunks) uploads an iterator of bytes and
+        returns whether it worked. """
+        self._encoder = GIFStreamEncoder(quantizer)
+        self._stream = ChunkStream()
+        self._result = False
+        self._thread = threading.Thread(target=self._send, args=(send,), daemon=True)
+        self._thread.start()
+
+    def add_frame(self, img : Image.Image, duration : int) -> None:
+        self._stream.put(self._encoder.add_frame(img, duration))
+
+    def finish(self) -> bool:
+        """ End the GIF and wait for the upload. Returns whether it worked. """
+        self._stream.put(self._encoder.finish())
+        self._stream.close()
+        self._thread.join()
+        return self._result
+
+    def _send(self, send):
+        try:
+            self._result = send(iter(self._stream))
+        except Exception:
+            traceback.print_exc()
+            # Keep draining so frames still being added don't pile up.
+            for _ in self._stream:
+                pass
@@ -0,0 +1,111 @@
+"""Jitter buffer for live frames.
+
+Live frames carry the time the client captured them. Rather than showing
+each frame the moment it arrives, the buffer holds it until its capture time
+plus a delay, so frames come out with the spacing they were captured with
+even when the network delivers them in bursts. The delay adapts to how much
+the transit time of recent frames has varied. Frames are handed to the
+driver on a steady tick matched to the panel's refresh rate; a frame that
+turns up after its time has passed is dropped rather than shown late.
+
+The client and device clocks needn't agree: the delay is measured from the
+fastest transit seen recently, not from the capture time itself.
+"""
+import bisect
+import collections
+import itertools
+import threading
+import time
+
+class JitterBuffer:
+
+    def __init__(self, present, tick_hz : float, min_delay : float, max_delay : float, window : int = 120):
+        """ Constructor.
+
+        present(img) shows a frame. Frames are shown on ticks tick_hz times a
+        second. The buffering delay stays between min_delay and max_delay
+        seconds and is worked out from the last window frames.
+        """
+        self._present = present
+        self._tick = 1 / tick_hz
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._cv = threading.Condition()
+        # (present time, order, image, capture time), sorted by present time.
+        self._frames = []
+        self._order = itertools.count()
+        self._transits = collections.deque(maxlen=window)
+        self._delay = min_delay
+        self._latency_total = 0.0
+        self.num_presented = 0
+        self.num_late = 0
+        self.num_skipped = 0
+        self.last_latency = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, img, capture_time : float) -> bool:
+        """ Add a frame captured at capture_time (client clock, seconds since
+        the epoch). Returns False if it arrived too late to show. """
+        arrival = time.time()
+        with self._cv:
+            self._transits.append(arrival - capture_time)
+            fastest = min(self._transits)
+            # Cover all but the slowest few percent of recent frames.
+            spreads = sorted(transit - fastest for transit in self._transits)
+            jitter = spreads[int(0.95 * (len(spreads) - 1))]
+            self._delay = min(max(jitter + self._tick, self._min_delay), self._max_delay)
+
+            present_at = capture_time + fastest + self._delay
+            if present_at < arrival - self._tick:
+                self.num_late += 1
+                return False
+            bisect.insort(self._frames, (present_at, next(self._order), img, capture_time))
+            self._cv.notify()
+        return True
+
+    def clear(self) -> None:
+        """ Drop any frames waiting to be shown. """
+        with self._cv:
+            self._frames.clear()
+
+    def stats(self) -> dict:
+        with self._cv:
+            return {
+                "depth": len(self._frames),
+                "delay_ms": 1000 * self._delay,
+                "presented": self.num_presented,
+                "dropped_late": self.num_late,
+                "dropped_skipped": self.num_skipped,
+                "latency_ms": None if self.last_latency is None else 1000 * self.last_latency,
+                "mean_latency_ms": 1000 * self._latency_total / self.num_presented if self.num_presented else None,
+            }
+
+    def _run(self):
+        """ Code for the presenting thread. """
+        next_tick = time.monotonic()
+        while True:
+            with self._cv:
+                while not self._frames:
+                    self._cv.wait()
+                    next_tick = time.monotonic()
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    self._cv.wait(delay)
+                    continue
+                # Show the newest frame that is due, skip any older ones.
+                now = time.time()
+                due = bisect.bisect_right(self._frames, (now, float("inf")))
+                frame = None
+                if due:
+                    self.num_skipped += due - 1
+                    _, _, img, capture_time = self._frames[due - 1]
+                    del self._frames[:due]
+                    frame = img
+                    # Only meaningful if the two clocks agree.
+                    self.last_latency = now - capture_time
+                    self._latency_total += self.last_latency
+                    self.num_presented += 1
+            if frame is not None:
+                self._present(frame)
+            next_tick = max(next_tick + self._tick, time.monotonic() - self._tick)
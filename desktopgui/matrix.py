@@ -2,13 +2,20 @@ import pathlib
 import json
 import random
 import io
+import tempfile
 import threading
+import time
 
 import clientapi
+import clientworkers
 import deviceapi
+import frameformat
+import metrics
+import quantize
+import simdriver
 
+import numpy as np
 from PIL import Image, ImageSequence
-import pygame
 import requests
 
 with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
@@ -16,39 +23,229 @@ with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
 
 api = None
 img = Image.new("RGB", (128,128))
+# Sends presented frame buffers, see connect().
+_live_sender = None
+# Slots of a simulated device; deleted when Python exits.
+_slot_data_dir = None
 
-def scale2x(im):
-  return pygame.transform.scale(im, (im.get_width() * 2, im.get_height() * 2))
+class LiveSender:
+    """ Sends frame buffers to the device as raw live frames. Uses the live
+    stream if the device has one, else HTTP. Whole frames only, so nothing
+    depends on earlier frames arriving. """
 
-class PygameDriver:
-    def __init__(self):
-        self.game = pygame.display.set_mode((256,256))
-    
-    def set_image(self, image):
-        image_data = image.tobytes()
-        image_dimensions = image.size
-        pygame_surface = scale2x(pygame.image.fromstring(image_data, image_dimensions, "RGB"))
-        self.game.blit(pygame_surface, (0,0))
+    def __init__(self, api):
+        self._api = api
+        self._format = frameformat.FrameFormat.RGB565 if CONFIG['liveFrameFormat'] == "rgb565" else frameformat.FrameFormat.RGB888
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._stream = None
+        # Only a remote device has a live stream.
+        self._use_stream = isinstance(api, clientapi.ClientAPI) and CONFIG['liveTransport'] == "stream"
+        self.num_dropped = 0
+
+    def send(self, image : Image.Image) -> bool:
+        """ Send an image. Returns False if it was dropped. """
+        with self._lock:
+            self._seq = (self._seq + 1) & 0xFFFFFFFF
+            frame_data = frameformat.encode_frame(image, self._format, self._seq, timestamp=time.time())
+            if self._use_stream:
+                try:
+                    if self._stream is None or not self._stream.is_open():
+                        self._stream = self._api.open_live_stream()
+                    sent = self._stream.send_frame(frame_data)
+                    if not sent:
+                        # The device is behind, skip this frame.
+                        self.num_dropped += 1
+                    return sent
+                except OSError as e:
+                    print(f"Live stream unavailable, using HTTP: {e}")
+                    self._use_stream = False
+            return self._api.set_live_frame(frame_data)
+
+class FrameBuffer:
+    """ An image to draw on, kept as a (height, width, 3) numpy array.
+
+    Drawing works on whole areas at once, so animations can be redrawn every
+    frame. Anything drawn outside the buffer is clipped. Colours are
+    (r, g, b) tuples.
+    """
+
+    def __init__(self, width : int = CONFIG['matrixWidth'], height : int = CONFIG['matrixHeight']):
+        self.pixels = np.zeros((height, width, 3), dtype=np.uint8)
+
+    @property
+    def width(self) -> int:
+        return self.pixels.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.pixels.shape[0]
+
+    def _clip(self, x : int, y : int, w : int, h : int) -> tuple[slice, slice, int, int] | None:
+        """ The part of a w x h area at (x, y) inside the buffer, as buffer
+        slices plus where that part starts within the area. """
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + w, self.width), min(y + h, self.height)
+        if right <= left or bottom <= top:
+            return None
+        return slice(top, bottom), slice(left, right), left - x, top - y
+
+    def clear(self, color=(0, 0, 0)):
+        self.pixels[:, :] = color
+
+    def set_pixel(self, x : int, y : int, color):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.pixels[y, x] = color
+
+    def fill_rect(self, x : int, y : int, w : int, h : int, color):
+        clipped = self._clip(x, y, w, h)
+        if clipped is not None:
+            rows, cols, _, _ = clipped
+            self.pixels[rows, cols] = color
+
+    def draw_array(self, array, x : int = 0, y : int = 0, palette=None):
+        """ Draw an array with its top left corner at (x, y). It is either
+        (height, width, 3) RGB, or (height, width) of indices into palette
+        (a list of colours) or, with no palette, grey levels. """
+        array = np.asarray(array)
+        if array.ndim == 2:
+            array = np.asarray(palette, dtype=np.uint8)[array] if palette is not None else np.repeat(array[:, :, None], 3, axis=2)
+        clipped = self._clip(x, y, array.shape[1], array.shape[0])
+        if clipped is not None:
+            rows, cols, dx, dy = clipped
+            self.pixels[rows, cols] = array[dy:dy + rows.stop - rows.start, dx:dx + cols.stop - cols.start]
+
+    def blit(self, source, x : int = 0, y : int = 0):
+        """ Draw another FrameBuffer or a PIL image at (x, y). """
+        if isinstance(source, FrameBuffer):
+            self.draw_array(source.pixels, x, y)
+        else:
+            self.draw_array(np.asarray(source.convert("RGB")), x, y)
+
+    def line(self, x0 : int, y0 : int, x1 : int, y1 : int, color):
+        num_points = max(abs(x1 - x0), abs(y1 - y0)) + 1
+        xs = np.rint(np.linspace(x0, x1, num_points)).astype(np.intp)
+        ys = np.rint(np.linspace(y0, y1, num_points)).astype(np.intp)
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        self.pixels[ys[inside], xs[inside]] = color
+
+    def scroll(self, dx : int, dy : int, fill=(0, 0, 0)):
+        """ Move everything right by dx and down by dy (negative for left
+        or up), filling the uncovered area. """
+        moved = np.full_like(self.pixels, fill)
+        clipped = self._clip(dx, dy, self.width, self.height)
+        if clipped is not None:
+            rows, cols, sx, sy = clipped
+            moved[rows, cols] = self.pixels[sy:sy + rows.stop - rows.start, sx:sx + cols.stop - cols.start]
+        self.pixels = moved
+
+    def to_image(self) -> Image.Image:
+        return Image.fromarray(self.pixels)
+
+    def present(self) -> bool:
+        """ Show the buffer on the matrix now, as a live image. Returns False
+        if the frame was dropped because the device is behind. """
+        return _live_sender.send(self.to_image())
+
+# What run(update, fps=...) presents after each update.
+frame = FrameBuffer()
+
+class RenderLoop:
+    """ Calls update(t, dt) fps times a second, with t the seconds since the
+    loop started and dt since the last call, and presents frame after each
+    call. update can return False to stop the loop.
+
+    Frames are sent on their own thread, so the next frame is drawn while
+    the last one is on its way; if it is still going when the next is ready
+    the older frame is dropped. When update falls behind, missed ticks are
+    skipped rather than run late.
+    """
+
+    def __init__(self, update, fps : float, frame : FrameBuffer, send):
+        self._update = update
+        self._interval = 1 / fps
+        self._frame = frame
+        self._stopped = threading.Event()
+        self.metrics = metrics.Metrics()
+        self._sender = clientworkers.SendWorker(send, timer=self.metrics)
+        self.num_frames = 0
+        self.num_skipped = 0
+        self._start = None
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        """ Run until stopped, on the calling thread. """
+        self._start = last = deadline = time.monotonic()
+        report_at = self._start + CONFIG['renderLoopReportSeconds']
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            with self.metrics.time("update"):
+                keep_going = self._update(now - self._start, now - last)
+            last = now
+            self._sender.put(self._frame.to_image())
+            self.num_frames += 1
+            if keep_going is False:
+                break
+
+            deadline += self._interval
+            now = time.monotonic()
+            if now > deadline + self._interval:
+                # Too far behind to catch up, skip to the next tick.
+                missed = int((now - deadline) / self._interval)
+                self.num_skipped += missed
+                deadline += missed * self._interval
+            self.metrics.record("frame", 1000 * (now - last))
+            if CONFIG['renderLoopReportSeconds'] and now >= report_at:
+                report_at = now + CONFIG['renderLoopReportSeconds']
+                print(self.summary())
+            self._stopped.wait(max(0.0, deadline - now))
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self._start if self._start is not None else 0.0
+        return {
+            "fps": self.num_frames / elapsed if elapsed else 0.0,
+            "frames": self.num_frames,
+            "skipped": self.num_skipped,
+            "dropped": self._sender.num_dropped,
+            "stages": self.metrics.snapshot(),
+        }
+
+    def summary(self) -> str:
+        stats = self.stats()
+        frame_ms = stats["stages"].get("frame", {})
+        return (f"{stats['fps']:.1f} fps, frame {frame_ms.get('mean', 0.0):.1f} ms "
+                f"(p99 {frame_ms.get('p99', 0.0):.1f}), {stats['skipped']} skipped, {stats['dropped']} dropped")
 
 def reset():
     global img
     img = Image.new("RGB", (128,128))
 
-def run(f, *args, **kwargs):
+def run(f, *args, fps : float = None, **kwargs):
+    """ Connect, then run f. With fps, f is update(t, dt) for a RenderLoop
+    that draws on frame; without, f is called once and does everything
+    itself. The rest of the arguments go to connect(). """
     connect(*args, **kwargs)
-    is_pygame = isinstance(api.matrix_driver, PygameDriver)
-    print(is_pygame)
-    func_thread = threading.Thread(target = f)
+    window = api.matrix_driver if isinstance(api.matrix_driver, simdriver.WindowDriver) else None
+    render_loop = None
+    if fps is None:
+        func_thread = threading.Thread(target = f)
+    else:
+        render_loop = RenderLoop(f, fps, frame, _live_sender.send)
+        func_thread = threading.Thread(target = render_loop.run)
     func_thread.start()
-    if is_pygame:
-        done = False
-        while not done:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    done = True
-            pygame.display.flip()
+    if window is not None:
+        # The window has to be looked after by this thread.
+        while func_thread.is_alive() and window.pump():
+            time.sleep(1 / CONFIG['simulatorRefreshHz'])
+        if render_loop is not None:
+            render_loop.stop()
     func_thread.join()
+    if isinstance(api.matrix_driver, simdriver.PNGDriver):
+        api.matrix_driver.close()
+    if render_loop is not None:
+        print(render_loop.summary())
 
 def connect(hostname = CONFIG["connectToIP4Addr"], port = CONFIG["port"]):
     global api
@@ -62,17 +259,25 @@ def connect(hostname = CONFIG["connectToIP4Addr"], port = CONFIG["port"]):
     if success:
         print("Connected to raspberry pi!")
     else:
-        print("Simulating matrix")
-        api = deviceapi.DeviceAPI(PygameDriver())
+        driver = simdriver.create_simulator()
+        print(f"Simulating matrix with a {type(driver).__name__}")
+        # Simulated slots are thrown away afterwards.
+        global _slot_data_dir
+        _slot_data_dir = tempfile.TemporaryDirectory(prefix="matrix-slots-")
+        api = deviceapi.DeviceAPI(driver, slot_data_dir=_slot_data_dir.name)
+    global _live_sender
+    _live_sender = LiveSender(api)
 
 def set_pixel(x, y, color):
     img.putpixel((x,y), color)
 
 def send_to_matrix():
     arr = io.BytesIO()
+    quantizer = quantize.Quantizer()
     if isinstance(img, list):
-        img[0].save(arr, format="gif", append_images=img[1:], save_all=True, optimize=False, loop=0)
+        frames = [quantizer.quantize(frame) for frame in img]
+        frames[0].save(arr, format="gif", append_images=frames[1:], save_all=True, optimize=False, loop=0)
     else:
-        img.save(arr, format="gif")
+        quantizer.quantize(img).save(arr, format="gif")
     
     api.set_slot(0, arr.getvalue())
\ No newline at end of file
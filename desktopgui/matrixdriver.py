@@ -1,60 +1,158 @@
 #!/usr/bin/env python
+import collections
 import json
 import pathlib
+import threading
+import time
+import traceback
 
 from PIL import Image
 from rgbmatrix import RGBMatrix, RGBMatrixOptions
 
+import metrics
+import paneltransform
+
 with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
     CONFIG = json.load(f)
 
 class MatrixDriver:
     def __init__(self):
+        # The render thread draws on one canvas while another is displayed.
+        if CONFIG['renderCanvasPoolSize'] < 2:
+            raise RuntimeError(f"renderCanvasPoolSize must be at least 2, not {CONFIG['renderCanvasPoolSize']}")
 
         options = RGBMatrixOptions()
-        # TODO: Push some of these options into config.json.
-        options.rows                = 64 # Pretend its a 4x1 panel config.
-        options.cols                = 64 # Pretend its a 4x1 panel config.
-        options.chain_length        = 4  # Pretend its a 4x1 panel config.
-        options.parallel            = 1
+        options.rows                = CONFIG['panelRows']
+        options.cols                = CONFIG['panelCols']
+        options.chain_length        = CONFIG['panelChainLength']
+        options.parallel            = CONFIG['panelParallel']
         options.row_address_type    = 0
         options.multiplexing        = 0
-        # TODO: Change back to higher number for better image.
-        options.pwm_bits            = 11 #11
+        options.pwm_bits            = CONFIG['panelPwmBits']
         #options.pwm_dither_bits     = 1 # not defined initially.
-        options.brightness          = 75 # 100
-        options.pwm_lsb_nanoseconds = 130 # 130
-        options.led_rgb_sequence    = "RGB"
+        options.brightness          = CONFIG['panelBrightness']
+        options.pwm_lsb_nanoseconds = CONFIG['panelPwmLsbNanoseconds']
+        options.led_rgb_sequence    = CONFIG['panelRgbSequence']
 
-        # This is a custom pixel mapper for our set-up, see https://github.com/mxklabs/rpi-rgb-led-matrix/tree/MorkPixelMapper
-        options.pixel_mapper_config = "Mork" 
+        # Our set-up uses a custom pixel mapper, "Mork", see https://github.com/mxklabs/rpi-rgb-led-matrix/tree/MorkPixelMapper
+        # It can be swapped for panelLayout (see paneltransform.py).
+        options.pixel_mapper_config = CONFIG['panelPixelMapper']
         options.panel_type          = ""
         options.show_refresh_rate   = 1
-        options.gpio_slowdown       = 2
+        options.gpio_slowdown       = CONFIG['panelGpioSlowdown']
         options.drop_priv_user      = CONFIG['user']
         options.drop_priv_group     = CONFIG['group']
 
         # Testing
         #options.disable_hardware_pulsing = False
-        options.limit_refresh_rate_hz = 60
+        options.limit_refresh_rate_hz = CONFIG['panelRefreshLimitHz']
+
+        # Colour correction and remapping, applied to every image before
+        # it is drawn onto a canvas.
+        self._transform = paneltransform.PanelTransform()
 
         self._matrix = RGBMatrix(options = options)
 
+        # Approximate memory used by one canvas: the library keeps a bit
+        # plane of 32-bit GPIO words per PWM bit for every double row of
+        # every column.
+        self.canvas_nbytes = (options.rows // 2) * options.cols * options.chain_length * options.pwm_bits * 4
+
+        # Frames waiting for the render thread. The deque drops the oldest
+        # frame when full, so the newest frame always wins.
+        self._frames = collections.deque(maxlen=CONFIG['renderQueueDepth'])
+        self._frames_cv = threading.Condition()
+        self.num_dropped_frames = 0
+        self.metrics = metrics.Metrics()
+
+        # Offscreen canvases the render thread draws images into. SwapOnVSync
+        # hands back the previously displayed canvas, which is then free.
+        self._pool = [self._matrix.CreateFrameCanvas() for _ in range(CONFIG['renderCanvasPoolSize'])]
+        self._pool_index = 0
+        self._displayed = None
+        # The frame the render thread has taken off the queue but not yet
+        # swapped onto the panel.
+        self._showing = None
+
+        self.render_thread = threading.Thread(target=self._render, daemon=True)
+        self.render_thread.start()
+
     def set_image(self, img : Image) -> None:
+        """ Queue an image to be shown on the next vsync. """
         assert img.mode == "RGB", \
           f"Expected mode 'RGB' but got {img.mode}"
 
         assert img.width == CONFIG['matrixWidth'] and img.height == CONFIG['matrixHeight'], \
           f"Expected size {CONFIG['matrixWidth']}x{CONFIG['matrixHeight']} but got {img.width}x{img.height}"
-        self._matrix.SetImage(img)
+        self._queue_frame(img)
     
-    def get_canvas(self, image: Image):
-        canvas = self._matrix.CreateFrameCanvas()
-        canvas.SetImage(image.convert("RGB"))
+    def get_canvas(self, image: Image, canvas=None):
+        """ Render an image onto a new canvas, or onto the given one to reuse it. """
+        if canvas is None:
+            canvas = self._matrix.CreateFrameCanvas()
+        canvas.SetImage(self._transform.apply(image.convert("RGB")))
         return canvas
 
     def display_canvas(self, canvas):
-        self._matrix.SwapOnVSync(canvas, framerate_fraction=1)
+        """ Queue a canvas from get_canvas to be shown on the next vsync. """
+        self._queue_frame(canvas)
+
+    def canvas_in_use(self, canvas) -> bool:
+        """ Whether a canvas from get_canvas is on the panel or waiting to
+        be, so mustn't be drawn over. """
+        with self._frames_cv:
+            return canvas is self._displayed or canvas is self._showing or \
+              any(frame is canvas for frame in self._frames)
+
+    def _queue_frame(self, frame) -> None:
+        with self._frames_cv:
+            if len(self._frames) == self._frames.maxlen:
+                self.num_dropped_frames += 1
+            self._frames.append(frame)
+            self._frames_cv.notify()
+
+    def _next_free_canvas(self):
+        """ Pick a pool canvas that isn't on the display. """
+        for _ in range(len(self._pool)):
+            canvas = self._pool[self._pool_index]
+            self._pool_index = (self._pool_index + 1) % len(self._pool)
+            if canvas is not self._displayed:
+                return canvas
+        raise RuntimeError("No free canvas in the render pool")
+
+    def _render(self):
+        """ Code for the render thread. """
+        while True:
+            with self._frames_cv:
+                while not self._frames:
+                    self._frames_cv.wait()
+                frame = self._frames.popleft()
+                self._showing = frame
+            # One bad frame mustn't stop the panel updating.
+            try:
+                self._show_frame(frame)
+            except Exception:
+                traceback.print_exc()
+            with self._frames_cv:
+                self._showing = None
+
+    def _show_frame(self, frame):
+        """ Draw a queued image or canvas and swap it onto the panel. """
+        capture_time = None
+        if isinstance(frame, Image.Image):
+            canvas = self._next_free_canvas()
+            with self.metrics.time("set_image"):
+                canvas.SetImage(self._transform.apply(frame))
+            capture_time = frame.info.get("capture_time")
+        else:
+            canvas = frame
+        with self.metrics.time("swap"):
+            self._matrix.SwapOnVSync(canvas, framerate_fraction=1)
+        with self._frames_cv:
+            self._displayed = canvas
+        if capture_time is not None:
+            # On the client's clock, see metrics.estimate_clock_offset.
+            self.metrics.record("capture_to_display", 1000 * (time.time() - capture_time))
 
     # def run(self):
 
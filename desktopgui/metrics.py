@@ -0,0 +1,114 @@
+"""Timing metrics shared by the client and the device.
+
+Each stage (capture, encode, decode, swap, ...) keeps its most recent
+samples in a fixed-size ring buffer, so recording is a couple of stores and
+memory never grows. Percentiles are only worked out when someone asks for a
+snapshot.
+
+Capture-to-display latency is measured on the device against the client's
+capture timestamps, so it is off by however far apart the two clocks are.
+estimate_clock_offset works that out from ping round trips.
+"""
+import array
+import contextlib
+import json
+import pathlib
+import threading
+import time
+
+with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
+    CONFIG = json.load(f)
+
+PERCENTILES = (50, 90, 99)
+
+class Histogram:
+    """ The last size samples of one measurement, plus running totals. """
+
+    def __init__(self, size : int):
+        self._samples = array.array("d", bytes(8 * size))
+        self._index = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, value : float):
+        self._samples[self._index] = value
+        self._index = (self._index + 1) % len(self._samples)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.last = value
+
+    def summary(self) -> dict:
+        """ Count, mean, max and last over every sample; percentiles over
+        the recent ones. """
+        recent = sorted(self._samples[:min(self.count, len(self._samples))])
+        summary = {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "last": self.last,
+        }
+        for percentile in PERCENTILES:
+            summary[f"p{percentile}"] = recent[round((len(recent) - 1) * percentile / 100)] if recent else 0.0
+        return summary
+
+class Metrics:
+    """ A histogram of timings, in ms, for each stage. Safe to record into
+    from any thread. """
+
+    def __init__(self, window : int | None = None):
+        self._window = CONFIG['metricsWindow'] if window is None else window
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    @contextlib.contextmanager
+    def time(self, stage : str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, 1000 * (time.perf_counter() - start))
+
+    def record(self, stage : str, ms : float):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram(self._window)
+            histogram.record(ms)
+
+    def snapshot(self) -> {str: dict}:
+        with self._lock:
+            return {stage: histogram.summary() for stage, histogram in self._stages.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+def estimate_clock_offset(ping, samples : int = 5) -> (float, float):
+    """ Estimate how far the device's clock is ahead of ours, in seconds.
+
+    ping() returns the device's time.time(). The device read its clock
+    somewhere within the round trip, so the fastest trip bounds the error
+    best; we assume it was half way. Returns (offset, round trip).
+    """
+    best = None
+    for _ in range(samples):
+        sent = time.time()
+        device_time = ping()
+        received = time.time()
+        round_trip = received - sent
+        if best is None or round_trip < best[1]:
+            best = (device_time - (sent + received) / 2, round_trip)
+    return best
+
+def format_snapshot(snapshot : {str: dict}) -> str:
+    """ One line per stage, for showing to people. """
+    lines = []
+    for stage, summary in snapshot.items():
+        lines.append(
+            f"{stage:<20} n={summary['count']:<7} mean {summary['mean']:7.1f}  "
+            + "  ".join(f"p{percentile} {summary[f'p{percentile}']:7.1f}" for percentile in PERCENTILES)
+            + f"  max {summary['max']:7.1f} ms")
+    return "\n".join(lines)
@@ -0,0 +1,95 @@
+"""Colour correction and pixel remapping for frames on their way to the panel.
+
+Everything is worked out once, when the driver starts:
+
+* a table per channel combining gamma, white balance and brightness, so
+  correcting a frame is one table lookup per pixel (Image.point), and
+* optionally, an index saying which source pixel each pixel of the panel
+  chain shows, so the panels can be laid out in any order and rotation
+  from config.json instead of in a pixel mapper compiled into the library.
+
+panelLayout lists the panels in the order they are chained, each as
+{"x": ..., "y": ..., "rotate": ...}: where the panel's top left corner is in
+the image, in pixels, and how far it is turned clockwise (0, 90, 180 or
+270). When it is used the library's own pixel mapper (panelPixelMapper)
+should be turned off by setting it to "".
+
+The client's quantizer (quantize.py) reads colourGamma too, so it can tell
+which colours end up looking the same on the panel.
+"""
+import json
+import pathlib
+
+import numpy as np
+from PIL import Image
+
+with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
+    CONFIG = json.load(f)
+
+def channel_tables(gamma : float, white_balance : (float, float, float), brightness : float) -> np.ndarray:
+    """ A (3, 256) table of the 8-bit value to show for each input value,
+    per channel. """
+    values = np.arange(256, dtype=np.float64) / 255
+    scale = np.asarray(white_balance, dtype=np.float64)[:, None] * brightness
+    return np.clip(np.round(255 * values[None, :] ** gamma * scale), 0, 255).astype(np.uint8)
+
+def remap_index(size : (int, int), layout : [dict], panel_size : (int, int), chain_length : int) -> np.ndarray:
+    """ For each pixel of the panel chain, the index of the source image
+    pixel it shows (in an image of size flattened row by row). """
+    width, height = size
+    cols, rows = panel_size
+    num_chains = -(-len(layout) // chain_length)
+    index = np.zeros((num_chains * rows, chain_length * cols), dtype=np.intp)
+    source = np.arange(width * height, dtype=np.intp).reshape(height, width)
+    for position, panel in enumerate(layout):
+        x, y = panel["x"], panel["y"]
+        rotate = panel.get("rotate", 0)
+        if rotate not in (0, 90, 180, 270):
+            raise RuntimeError(f"Panel {position} can't be turned {rotate} degrees")
+        # A panel on its side covers a tall area of the image.
+        area_width, area_height = (rows, cols) if rotate in (90, 270) else (cols, rows)
+        if x < 0 or y < 0 or x + area_width > width or y + area_height > height:
+            raise RuntimeError(f"Panel {position} at ({x}, {y}) doesn't fit in a {width}x{height} image")
+        # np.rot90 turns anticlockwise; undo the panel's clockwise turn.
+        block = np.rot90(source[y:y + area_height, x:x + area_width], k=rotate // 90)
+        top = (position // chain_length) * rows
+        left = (position % chain_length) * cols
+        index[top:top + rows, left:left + cols] = block
+    return index
+
+class PanelTransform:
+
+    def __init__(self, size : (int, int) = None, gamma : float = None, white_balance=None, brightness : float = None,
+                 layout : [dict] = None, panel_size : (int, int) = None, chain_length : int = None):
+        """ Constructor. Anything not given comes from config.json. """
+        self.size = (CONFIG['matrixWidth'], CONFIG['matrixHeight']) if size is None else tuple(size)
+        gamma = CONFIG['colourGamma'] if gamma is None else gamma
+        white_balance = CONFIG['colourWhiteBalance'] if white_balance is None else white_balance
+        brightness = CONFIG['colourBrightness'] if brightness is None else brightness
+        layout = CONFIG['panelLayout'] if layout is None else layout
+        panel_size = (CONFIG['panelCols'], CONFIG['panelRows']) if panel_size is None else panel_size
+        chain_length = CONFIG['panelChainLength'] if chain_length is None else chain_length
+
+        tables = channel_tables(gamma, white_balance, brightness)
+        identity = np.arange(256, dtype=np.uint8)
+        # Skip the lookup altogether when it wouldn't change anything.
+        self._table = None if (tables == identity).all() else tables.reshape(-1).tolist()
+        self._index = None
+        self.output_size = self.size
+        if layout:
+            self._index = remap_index(self.size, layout, panel_size, chain_length)
+            self.output_size = (self._index.shape[1], self._index.shape[0])
+
+    @property
+    def is_identity(self) -> bool:
+        return self._table is None and self._index is None
+
+    def apply(self, img : Image.Image) -> Image.Image:
+        """ The RGB image to send to the panel for img. Returns img itself if
+        there is nothing to do. """
+        if self._table is not None:
+            img = img.point(self._table)
+        if self._index is not None:
+            pixels = np.asarray(img).reshape(-1, 3)
+            img = Image.fromarray(pixels[self._index])
+        return img
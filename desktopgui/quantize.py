@@ -0,0 +1,145 @@
+"""Palette quantization for the GIFs the client sends to the matrix.
+
+A Quantizer keeps one palette for a whole stream of images and only adds or
+swaps colours when an image has colours the palette can't get close to, so
+consecutive frames come out with the same colours. Mapping a pixel to its
+palette index is a lookup in a table covering every colour at 5 bits per
+channel, which is kept up to date as the palette changes rather than
+rebuilt.
+
+Colours are compared as the panel shows them: each channel goes through the
+device's colour correction gamma (colourGamma, see paneltransform.py), then
+the panel's own gamma (panelGamma) and PWM depth (panelPwmBits), so colours
+the panel can't tell apart (mostly very dark ones) don't use up palette
+entries. These are the same config.json keys the device reads, so the
+client's copy must match the device's.
+"""
+import json
+import pathlib
+
+import numpy as np
+from PIL import Image
+
+with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
+    CONFIG = json.load(f)
+
+MAX_COLOURS = 256
+LUT_BITS = 5
+# A colour further than this (in 8-bit steps) from every palette entry is
+# added to the palette.
+NEW_COLOUR_DISTANCE = 12
+# How quickly entries that stop being used become candidates for replacing.
+USAGE_DECAY = 0.9
+# Peak to peak size of the ordered dither pattern, in 8-bit steps.
+DITHER_AMPLITUDE = 16
+
+BAYER_4X4 = np.array([
+    [ 0,  8,  2, 10],
+    [12,  4, 14,  6],
+    [ 3, 11,  1,  9],
+    [15,  7, 13,  5],
+], dtype=np.float32)
+
+def panel_levels(pwm_bits : int, gamma : float) -> np.ndarray:
+    """ The 8-bit value the panel actually shows for each 8-bit input. """
+    steps = (1 << pwm_bits) - 1
+    values = np.arange(256, dtype=np.float64) / 255
+    shown = np.round(values ** gamma * steps) / steps
+    return np.round(shown ** (1 / gamma) * 255).astype(np.float32)
+
+class Quantizer:
+
+    def __init__(self, dither : bool = None, pwm_bits : int = None, gamma : float = None, colour_gamma : float = None):
+        """ Constructor. Anything not given comes from config.json. """
+        self.dither = CONFIG['quantizeDither'] if dither is None else dither
+        pwm_bits = CONFIG['panelPwmBits'] if pwm_bits is None else pwm_bits
+        gamma = CONFIG['panelGamma'] if gamma is None else gamma
+        colour_gamma = CONFIG['colourGamma'] if colour_gamma is None else colour_gamma
+        # The device raises each channel to colour_gamma before the panel
+        # applies its own gamma, so together they are one curve.
+        levels = panel_levels(pwm_bits, gamma * colour_gamma)
+
+        # The colour each LUT bin stands for, as the panel shows it. The
+        # values are spread over the whole 0-255 range rather than taken from
+        # the middle of each bin, so black and full brightness can be reached.
+        # Each value still lies inside its own bin.
+        top = (1 << LUT_BITS) - 1
+        values = np.round(np.arange(top + 1) * 255 / top).astype(np.intp)
+        r, g, b = np.meshgrid(values, values, values, indexing="ij")
+        self._bin_colours = levels[np.stack([r, g, b], axis=-1).reshape(-1, 3)]
+
+        self._palette = np.zeros((MAX_COLOURS, 3), dtype=np.float32)
+        self._usage = np.zeros(MAX_COLOURS, dtype=np.float32)
+        self._num_colours = 0
+        self._lut = np.zeros(len(self._bin_colours), dtype=np.uint8)
+        self._lut_dist = np.full(len(self._bin_colours), np.inf, dtype=np.float32)
+        # Bumped whenever the palette changes.
+        self.version = 0
+
+    def palette(self) -> [int]:
+        """ The palette as a flat list for Image.putpalette. """
+        return np.round(self._palette).astype(np.uint8).flatten().tolist()
+
+    def palette_image(self) -> Image.Image:
+        """ A 1x1 "P" image carrying the palette. """
+        im = Image.new("P", (1, 1))
+        im.putpalette(self.palette())
+        return im
+
+    def update(self, img : Image.Image) -> np.ndarray:
+        """ Adjust the palette to fit img. Returns img's LUT bin indices. """
+        bins = self._bins(img)
+        counts = np.bincount(bins.ravel(), minlength=len(self._lut))
+        self._usage *= USAGE_DECAY
+        self._usage += np.bincount(self._lut[bins.ravel()], minlength=MAX_COLOURS)
+
+        # Colours the palette is too far from, most common first.
+        far = np.flatnonzero((counts > 0) & (self._lut_dist > NEW_COLOUR_DISTANCE ** 2))
+        for bin_index in far[np.argsort(-counts[far], kind="stable")]:
+            if self._lut_dist[bin_index] <= NEW_COLOUR_DISTANCE ** 2:
+                # An earlier addition already covers it.
+                continue
+            replace = self._num_colours == MAX_COLOURS
+            if replace:
+                entry = int(np.argmin(self._usage))
+                if self._usage[entry] >= counts[bin_index]:
+                    break
+            else:
+                entry = self._num_colours
+                self._num_colours += 1
+            self._set_entry(entry, self._bin_colours[bin_index], counts[bin_index], replace)
+        return bins
+
+    def quantize(self, img : Image.Image, update : bool = True) -> Image.Image:
+        """ Map img to the palette, adjusting the palette first if update. """
+        bins = self.update(img) if update else self._bins(img)
+        out = Image.fromarray(self._lut[bins], "P")
+        out.putpalette(self.palette())
+        return out
+
+    def _bins(self, img : Image.Image) -> np.ndarray:
+        pixels = np.asarray(img.convert("RGB"))
+        if self.dither:
+            h, w, _ = pixels.shape
+            threshold = np.tile(BAYER_4X4, ((h + 3) // 4, (w + 3) // 4))[:h, :w, np.newaxis]
+            pixels = np.clip(pixels + (threshold / 16 - 0.5) * DITHER_AMPLITUDE, 0, 255).astype(np.uint8)
+        shift = 8 - LUT_BITS
+        q = (pixels >> shift).astype(np.uint16)
+        return (q[..., 0] << (2 * LUT_BITS)) | (q[..., 1] << LUT_BITS) | q[..., 2]
+
+    def _set_entry(self, entry : int, colour : np.ndarray, usage : float, replaced : bool):
+        """ Put colour in the palette and bring the LUT up to date. """
+        self._palette[entry] = colour
+        self._usage[entry] = usage
+        if replaced:
+            # Bins that used the old colour need their nearest entry again.
+            stale = np.flatnonzero(self._lut == entry)
+            if len(stale):
+                dist = ((self._bin_colours[stale, np.newaxis, :] - self._palette[np.newaxis, :self._num_colours, :]) ** 2).sum(axis=-1)
+                self._lut[stale] = np.argmin(dist, axis=1)
+                self._lut_dist[stale] = dist[np.arange(len(stale)), self._lut[stale]]
+        dist = ((self._bin_colours - colour) ** 2).sum(axis=-1)
+        closer = dist < self._lut_dist
+        self._lut[closer] = entry
+        self._lut_dist[closer] = dist[closer]
+        self.version += 1
@@ -1,5 +1,11 @@
+import time
+
 from flask import Flask, request
 
+import frameformat
+import slotbatch
+from deviceapi import Mode
+
 def matrix_server(api):
     app = Flask('server')
 
@@ -48,20 +54,85 @@ def matrix_server(api):
         # gif_data = request.get_data()
         # print(gif_data, flush=True)
         try:
+            info = api.get_slot_info(slot)
+            if info is not None and info["hash"] in slotbatch.parse_etags(request.headers.get("If-None-Match")):
+                return '', 304, {"ETag": slotbatch.etag(info["hash"])}
             res, gif_data = api.get_slot(slot)
         except Exception as e:
             import traceback
             traceback.print_exc()
             return str(e), 500
         if res:
-            return gif_data, 200
+            return gif_data, 200, {"ETag": slotbatch.etag(info["hash"])} if info is not None else {}
         else:
             return '', 204
 
+    @app.route("/slot/<slot_index>/assign", methods=["POST"])
+    def assign_slot(slot_index):
+        try:
+            slot = int(slot_index)
+        except ValueError:
+            return f"{slot_index} provided couldn't be cast to int.", 400
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("hash"), str):
+            return f"{data} isn't a valid assign request.", 400
+        try:
+            res = api.assign_slot(slot, data["hash"])
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return str(e), 500
+        if res:
+            return "", 201
+        else:
+            return f"No GIF with hash {data['hash']}", 404
+
+    @app.route("/slots", methods=["GET"])
+    def get_slots():
+        try:
+            return {"slots": api.get_slots()}, 200
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return str(e), 500
+
+    @app.route("/slots/batch", methods=["POST"])
+    def set_slots_batch():
+        try:
+            entries = slotbatch.decode_batch(request.get_data(), api.num_slots)
+        except Exception as e:
+            return str(e), 400
+        try:
+            # Unchanged slots are left alone; only empty ones are cleared.
+            res = api.set_slots({slot: data for slot, (state, data) in entries.items() if state != slotbatch.SLOT_UNCHANGED})
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return str(e), 500
+        if res:
+            return "", 201
+        else:
+            return "", 500
+
+    @app.route("/slots/batch", methods=["GET"])
+    def get_slots_batch():
+        try:
+            slots = [int(slot) for slot in request.args.get("slots", "").split(",") if slot]
+        except ValueError:
+            return f"{request.args.get('slots')} isn't a list of slots.", 400
+        try:
+            entries = api.get_slots_batch(slots or None,
+                                         slotbatch.parse_etags(request.headers.get("If-None-Match")))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return str(e), 500
+        return slotbatch.encode_batch(entries), 200, {"Content-Type": "application/octet-stream"}
+
     @app.route("/live", methods=["POST"])
     def set_live():
-        gif_data = request.get_data()
-        #print(gif_data, flush=True)
+        with api.metrics.time("receive"):
+            gif_data = request.get_data()
         try:
             res = api.set_live(gif_data)
         except Exception as e:
@@ -73,6 +144,64 @@ def matrix_server(api):
         else:
             return "", 500
         
+    @app.route("/live/frame", methods=["POST"])
+    def set_live_frame():
+        with api.metrics.time("receive"):
+            frame_data = request.get_data()
+        try:
+            res = api.set_live_frame(frame_data)
+        except frameformat.ResyncRequired as e:
+            return str(e), 409
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return str(e), 500
+        if res:
+            return "", 201
+        else:
+            return "", 500
+
+    @app.route("/mode", methods=["POST"])
+    def set_mode():
+        data = request.get_json(silent=True)
+        try:
+            mode = Mode(data["mode"])
+            slot = data.get("slot")
+            slot = None if slot is None else int(slot)
+        except (TypeError, KeyError, ValueError):
+            return f"{data} isn't a valid mode request.", 400
+        try:
+            res = api.set_mode(mode, slot)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return str(e), 500
+        if res:
+            return "", 200
+        else:
+            return "", 500
+
+    @app.route("/slotstats", methods=["GET"])
+    def get_slot_stats():
+        try:
+            return api.get_slot_stats(), 200
+        except Exception as e:
+            return str(e), 500
+
+    @app.route("/livestats", methods=["GET"])
+    def get_live_stats():
+        try:
+            return api.get_live_stats(), 200
+        except Exception as e:
+            return str(e), 500
+
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics():
+        try:
+            return api.get_metrics(), 200
+        except Exception as e:
+            return str(e), 500
+
     @app.route("/ping/<ping_id>", methods=["GET"])
     def ping(ping_id):
         try:
@@ -83,6 +212,7 @@ def matrix_server(api):
             res = api.ping(ping_id_int)
         except Exception as e:
             return str(e), 500
-        return {"check_int":res}
+        # The device's clock, for lining up client and device timings.
+        return {"check_int":res, "device_time":time.time()}
         
     return app.run
@@ -0,0 +1,201 @@
+"""Stand-in matrix drivers for running the device without a panel.
+
+They offer the same interface as matrixdriver.MatrixDriver (set_image,
+get_canvas, display_canvas), so the device, slots and all, runs unchanged on
+them. Frames are "shown" as soon as they are handed over, there is no vsync
+to wait for.
+
+  NullDriver       only counts frames
+  RecordingDriver  keeps the most recent frames in memory
+  PNGDriver        writes every frame to a numbered PNG file
+  WindowDriver     shows frames in a pygame window
+
+create_simulator picks one from config.json.
+"""
+import collections
+import json
+import os
+import pathlib
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+import metrics
+
+with open(pathlib.Path(__file__).parents[0] / "config.json", "r") as f:
+    CONFIG = json.load(f)
+
+class NullDriver:
+
+    def __init__(self, size : tuple[int, int] | None = None, history : int = 4096):
+        """ Constructor. The times of the last history frames shown are kept
+        in frame_times, on the perf_counter clock. """
+        self.size = (CONFIG['matrixWidth'], CONFIG['matrixHeight']) if size is None else size
+        # Canvases are plain RGB images.
+        self.canvas_nbytes = self.size[0] * self.size[1] * 3
+        self.metrics = metrics.Metrics()
+        self.num_dropped_frames = 0
+        self._lock = threading.Lock()
+        self.num_frames = 0
+        self.frame_times = collections.deque(maxlen=history)
+
+    def set_image(self, img : Image) -> None:
+        """ Show an image. """
+        assert img.mode == "RGB", \
+          f"Expected mode 'RGB' but got {img.mode}"
+        assert img.size == self.size, \
+          f"Expected size {self.size[0]}x{self.size[1]} but got {img.width}x{img.height}"
+        self._show(img, img.info.get("capture_time"))
+
+    def get_canvas(self, image : Image, canvas=None):
+        """ Render an image onto a new canvas, or onto the given one to reuse it. """
+        if canvas is None:
+            return image.convert("RGB")
+        canvas.paste(image.convert("RGB"))
+        return canvas
+
+    def display_canvas(self, canvas) -> None:
+        """ Show a canvas from get_canvas. """
+        self._show(canvas, None)
+
+    def canvas_in_use(self, canvas) -> bool:
+        """ Whether a canvas mustn't be drawn over yet. Never, as canvases
+        are shown (or copied) as soon as they are handed over. """
+        return False
+
+    def wait_for_frames(self, num_frames : int, timeout : float) -> bool:
+        """ Wait until num_frames frames have been shown in all. Returns False
+        on timeout. """
+        deadline = time.monotonic() + timeout
+        while self.num_frames < num_frames:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.0005)
+        return True
+
+    def _show(self, frame : Image, capture_time : float | None) -> None:
+        now = time.perf_counter()
+        with self._lock:
+            self.num_frames += 1
+            self.frame_times.append(now)
+            self._record(now, frame)
+        if capture_time is not None:
+            self.metrics.record("capture_to_display", 1000 * (time.time() - capture_time))
+
+    def _record(self, now : float, frame : Image) -> None:
+        pass
+
+class RecordingDriver(NullDriver):
+    """ Keeps the last max_frames frames shown, with when they were shown. """
+
+    def __init__(self, size : tuple[int, int] | None = None, max_frames : int = 256, history : int = 4096):
+        super().__init__(size, history)
+        self.frames = collections.deque(maxlen=max_frames)
+
+    def _record(self, now : float, frame : Image) -> None:
+        # Canvases get drawn over when reused, so keep a copy.
+        self.frames.append((now, frame.copy()))
+
+class PNGDriver(NullDriver):
+    """ Writes every frame shown to directory as frame_000000.png and on.
+    Files are written on a thread of their own. """
+
+    def __init__(self, directory, size : tuple[int, int] | None = None, history : int = 4096):
+        super().__init__(size, history)
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._frames = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_frames, daemon=True)
+        self._writer.start()
+
+    def close(self) -> None:
+        """ Finish writing the frames shown so far. """
+        self._frames.put(None)
+        self._writer.join()
+
+    def _record(self, now : float, frame : Image) -> None:
+        self._frames.put((self.num_frames - 1, frame.copy()))
+
+    def _write_frames(self):
+        """ Code for the writer thread. """
+        while True:
+            item = self._frames.get()
+            if item is None:
+                return
+            index, frame = item
+            frame.save(self.directory / f"frame_{index:06d}.png")
+
+class WindowDriver(NullDriver):
+    """ Shows frames in a pygame window, scale times the matrix size.
+
+    pygame wants its window looked after by the thread that opened it, so
+    frames only go as far as a buffer here; that thread calls pump() to put
+    the latest one on screen. The window's surfaces are made once and drawn
+    into, nothing is allocated per frame on the pygame side.
+    """
+
+    def __init__(self, size : tuple[int, int] | None = None, scale : int = None, history : int = 4096):
+        super().__init__(size, history)
+        import pygame
+        self._pygame = pygame
+        scale = CONFIG['simulatorScale'] if scale is None else scale
+        pygame.display.init()
+        pygame.display.set_caption("Matrix simulator")
+        self._window = pygame.display.set_mode((self.size[0] * scale, self.size[1] * scale))
+        # Same pixel format as the window, so scaling can draw straight into it.
+        self._surface = pygame.Surface(self.size, 0, self._window)
+        self._latest = None
+        self._latest_lock = threading.Lock()
+
+    def _record(self, now : float, frame : Image) -> None:
+        # Canvases get drawn over when reused, so take the pixels now.
+        pixels = np.asarray(frame)
+        with self._latest_lock:
+            self._latest = pixels
+
+    def pump(self) -> bool:
+        """ Handle window events and show the latest frame. Call from the
+        thread that made the driver. Returns False once the window is
+        closed. """
+        pygame = self._pygame
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.display.quit()
+                return False
+        with self._latest_lock:
+            pixels, self._latest = self._latest, None
+        if pixels is not None:
+            # pygame indexes surfaces by x then y.
+            pygame.surfarray.blit_array(self._surface, pixels.swapaxes(0, 1))
+            pygame.transform.scale(self._surface, self._window.get_size(), self._window)
+            pygame.display.flip()
+        return True
+
+def has_display() -> bool:
+    """ Whether a window could be opened here. """
+    if sys.platform in ("win32", "darwin"):
+        return True
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+def create_simulator(mode : str = None, size : tuple[int, int] | None = None) -> NullDriver:
+    """ A simulated driver, by mode: "window", "headless" or "auto" (a
+    window if there is a display and pygame, else headless). Headless
+    drivers write PNGs to simulatorRecordDir if it is set and otherwise
+    keep the last simulatorRecordFrames frames in memory. """
+    mode = CONFIG['simulatorMode'] if mode is None else mode
+    if mode not in ("auto", "window", "headless"):
+        raise RuntimeError(f"Unknown simulator mode {mode}")
+    if mode == "window" or (mode == "auto" and has_display()):
+        try:
+            return WindowDriver(size)
+        except Exception as e:
+            if mode == "window":
+                raise
+            print(f"Can't open a simulator window, running headless: {e}")
+    if CONFIG['simulatorRecordDir']:
+        return PNGDriver(CONFIG['simulatorRecordDir'], size)
+    return RecordingDriver(size, max_frames=CONFIG['simulatorRecordFrames'])
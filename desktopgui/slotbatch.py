@@ -0,0 +1,65 @@
+"""Moving many slots in one request.
+
+A batch is a small archive of slot entries (little-endian):
+  header  magic "MXSB", version, entry count
+  entry   slot index, state, data length, then that many bytes of GIF
+
+An entry's state says whether it carries data, the slot is empty, or the
+slot is unchanged from what the client said it already had, in which case
+no data is sent.
+"""
+import struct
+
+BATCH_MAGIC = b"MXSB"
+BATCH_VERSION = 1
+BATCH_HEADER = struct.Struct("<4sBH")
+BATCH_ENTRY = struct.Struct("<HBI")
+
+SLOT_DATA = 0
+SLOT_EMPTY = 1
+SLOT_UNCHANGED = 2
+
+def encode_batch(entries : {int: (int, bytes | None)}) -> bytes:
+    """ Pack {slot index: (state, data)} into a batch. """
+    parts = [BATCH_HEADER.pack(BATCH_MAGIC, BATCH_VERSION, len(entries))]
+    for slot_index, (state, data) in sorted(entries.items()):
+        data = data if state == SLOT_DATA else b""
+        parts.append(BATCH_ENTRY.pack(slot_index, state, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+SLOT_STATES = (SLOT_DATA, SLOT_EMPTY, SLOT_UNCHANGED)
+
+def decode_batch(data : bytes, num_slots : int | None = None) -> {int: (int, bytes | None)}:
+    """ Unpack a batch into {slot index: (state, data)}.
+
+    Raises ValueError for an entry with an unknown state, or a slot index
+    outside range(num_slots) if num_slots is given.
+    """
+    magic, version, count = BATCH_HEADER.unpack_from(data)
+    if magic != BATCH_MAGIC or version != BATCH_VERSION:
+        raise RuntimeError(f"Not a version {BATCH_VERSION} slot batch")
+    entries = {}
+    offset = BATCH_HEADER.size
+    view = memoryview(data)
+    for _ in range(count):
+        slot_index, state, length = BATCH_ENTRY.unpack_from(data, offset)
+        offset += BATCH_ENTRY.size
+        if state not in SLOT_STATES:
+            raise ValueError(f"Slot batch entry for slot {slot_index} has unknown state {state}")
+        if num_slots is not None and slot_index >= num_slots:
+            raise ValueError(f"Slot batch has slot {slot_index}, there are only {num_slots}")
+        if offset + length > len(data):
+            raise RuntimeError(f"Slot batch is truncated at slot {slot_index}")
+        entries[slot_index] = (state, bytes(view[offset:offset + length]) if state == SLOT_DATA else None)
+        offset += length
+    return entries
+
+def etag(content_hash : str) -> str:
+    return f'"{content_hash}"'
+
+def parse_etags(header : str | None) -> set:
+    """ The content hashes listed in an If-None-Match header. """
+    if not header:
+        return set()
+    return {tag.strip().removeprefix("W/").strip('"') for tag in header.split(",")}
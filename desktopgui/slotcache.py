@@ -0,0 +1,159 @@
+"""LRU cache of decoded slot frames.
+
+Decoding an animated GIF frame by frame during playback is too slow on the
+Pi, so slots are decoded once, rendered onto canvases and kept here, keyed by
+the content hash of the slot data, so slots showing the same GIF share one
+entry. The cache stays within a memory budget by evicting the least
+recently used entries.
+
+The rgbmatrix library never frees a canvas once created, so evicted canvases
+are kept as spares and drawn over when the next slot is decoded, rather than
+being dropped. A spare isn't drawn over while the driver still has it on the
+panel or queued for it.
+"""
+import collections
+import queue
+import threading
+import traceback
+
+import slots
+
+class _Entry:
+    def __init__(self, frames, nbytes : int):
+        self.frames = frames
+        self.nbytes = nbytes
+        self.users = 0
+        self.evicted = False
+
+class SlotCache:
+
+    def __init__(self, driver, budget_bytes : int, load_frames=None):
+        """ Constructor.
+
+        load_frames(content_hash, data, spare_canvases) decodes a slot, by
+        default with slots.decode_frames.
+        """
+        self._driver = driver
+        self._load_frames = load_frames or \
+            (lambda content_hash, data, spare_canvases: slots.decode_frames(data, driver, spare_canvases=spare_canvases))
+        self._budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._loading = {}
+        self._spare_canvases = []
+        self._nbytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+        self._warm_queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._warm, daemon=True)
+        self.thread.start()
+
+    def get(self, content_hash : str, data : bytes):
+        """ Get the decoded frames of slot data, decoding them if needed.
+
+        The frames stay pinned in the cache until the returned release
+        function is called. Returns (frames, release).
+        """
+        key = content_hash
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self.num_hits += 1
+                    self._entries.move_to_end(key)
+                    entry.users += 1
+                    return entry.frames, lambda: self._release(entry)
+                loading = self._loading.get(key)
+                if loading is None:
+                    self.num_misses += 1
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # Someone else is decoding it, wait for them and look again.
+            loading.wait()
+
+        try:
+            entry = self._decode(data, key)
+            return entry.frames, lambda: self._release(entry)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def warm(self, content_hash : str, data : bytes) -> None:
+        """ Decode slot data in the background so it is ready when shown. """
+        self._warm_queue.put((content_hash, data))
+
+    def discard(self, content_hash : str) -> None:
+        """ Forget decoded slot data that no slot uses any more. """
+        with self._lock:
+            if content_hash in self._entries:
+                self._evict(content_hash)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "slots": len(self._entries),
+                "bytes": self._nbytes,
+                "budget_bytes": self._budget_bytes,
+                "spare_canvases": len(self._spare_canvases),
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "evictions": self.num_evictions,
+            }
+
+    def _decode(self, data : bytes, key) -> _Entry:
+        """ Decode a slot into a new entry, pinned once for the caller. """
+        with self._lock:
+            spare_canvases = []
+            in_use = []
+            for canvas in self._spare_canvases:
+                (in_use if self._driver.canvas_in_use(canvas) else spare_canvases).append(canvas)
+            self._spare_canvases = in_use
+        try:
+            frames = self._load_frames(key, data, spare_canvases)
+        finally:
+            with self._lock:
+                self._spare_canvases.extend(spare_canvases)
+
+        entry = _Entry(frames, len(frames.canvases) * self._driver.canvas_nbytes)
+        entry.users = 1
+        with self._lock:
+            self._entries[key] = entry
+            self._nbytes += entry.nbytes
+            self._shrink()
+        return entry
+
+    def _release(self, entry : _Entry):
+        with self._lock:
+            entry.users -= 1
+            if entry.evicted and entry.users == 0:
+                self._spare_canvases.extend(entry.frames.canvases)
+            self._shrink()
+
+    def _shrink(self):
+        """ Evict unused slots until within budget. Call with _lock held. """
+        for key in list(self._entries):
+            if self._nbytes <= self._budget_bytes:
+                return
+            if self._entries[key].users == 0:
+                self._evict(key)
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        self._nbytes -= entry.nbytes
+        self.num_evictions += 1
+        entry.evicted = True
+        if entry.users == 0:
+            self._spare_canvases.extend(entry.frames.canvases)
+
+    def _warm(self):
+        """ Code for the cache warming thread. """
+        while True:
+            content_hash, data = self._warm_queue.get()
+            try:
+                _, release = self.get(content_hash, data)
+                release()
+            except Exception:
+                traceback.print_exc()
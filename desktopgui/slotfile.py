@@ -0,0 +1,103 @@
+"""Compact on-disk slot format.
+
+Uploaded GIFs are converted once into a file that holds every frame as raw
+RGB, so showing a slot needs no GIF decoding. The file is memory-mapped and
+each frame is copied out of the mapping as it is needed (Pillow can't share
+memory with an RGB image), so only the frames in use take up memory.
+
+Layout (little-endian):
+  header  magic "MXSF", version, width, height, frame count, SHA-1 of the
+          GIF the file was made from
+  index   per frame: offset of its pixels in the file, duration in ms
+  frames  width * height * 3 bytes of RGB per frame, back to back
+"""
+import hashlib
+import io
+import mmap
+import os
+import struct
+
+from PIL import Image, ImageSequence
+
+SLOT_FILE_MAGIC = b"MXSF"
+SLOT_FILE_VERSION = 1
+SLOT_FILE_HEADER = struct.Struct("<4sHHHI20s")
+SLOT_FILE_INDEX = struct.Struct("<QI")
+
+def source_hash(data : bytes) -> bytes:
+    """ Hash identifying the GIF a slot file was made from. """
+    return hashlib.sha1(data).digest()
+
+def write_slot_file(path, data : bytes) -> None:
+    """ Convert GIF data into a slot file, replacing path atomically. """
+    frames = []
+    durations = []
+    with Image.open(io.BytesIO(data)) as image:
+        size = image.size
+        for frame in ImageSequence.Iterator(image):
+            frames.append(frame.convert("RGB").tobytes())
+            durations.append(max(frame.info.get("duration", 100), 1))
+
+    offset = SLOT_FILE_HEADER.size + len(frames) * SLOT_FILE_INDEX.size
+    frame_size = size[0] * size[1] * 3
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SLOT_FILE_HEADER.pack(SLOT_FILE_MAGIC, SLOT_FILE_VERSION, size[0], size[1], len(frames), source_hash(data)))
+        for i, duration in enumerate(durations):
+            f.write(SLOT_FILE_INDEX.pack(offset + i * frame_size, duration))
+        for frame in frames:
+            f.write(frame)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # Make the rename itself durable, as slotstore.write_atomically does.
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class SlotFile:
+    """ A memory-mapped slot file. """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, width, height, n_frames, self.source_hash = SLOT_FILE_HEADER.unpack_from(self._map)
+            if magic != SLOT_FILE_MAGIC or version != SLOT_FILE_VERSION:
+                raise RuntimeError(f"{path} isn't a version {SLOT_FILE_VERSION} slot file")
+            self.size = (width, height)
+            self.offsets = []
+            self.durations = []
+            for i in range(n_frames):
+                offset, duration = SLOT_FILE_INDEX.unpack_from(self._map, SLOT_FILE_HEADER.size + i * SLOT_FILE_INDEX.size)
+                self.offsets.append(offset)
+                self.durations.append(duration)
+            if n_frames and self.offsets[-1] + width * height * 3 > len(self._map):
+                raise RuntimeError(f"{path} is truncated")
+        except:
+            self._map.close()
+            raise
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def frame(self, index : int) -> Image.Image:
+        """ Get a frame as an RGB image, copied from the mapping. """
+        offset = self.offsets[index]
+        pixels = memoryview(self._map)[offset:offset + self.size[0] * self.size[1] * 3]
+        try:
+            return Image.frombuffer("RGB", self.size, pixels, "raw", "RGB", 0, 1)
+        finally:
+            pixels.release()
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
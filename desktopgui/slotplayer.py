@@ -0,0 +1,230 @@
+"""Device-side slot playback.
+
+The slot player owns a thread that shows slots on the matrix, either one
+slot or all slots in round robin. Slots are scheduled against deadlines on
+the monotonic clock measured from when the slot started, so late wake-ups
+are caught up on rather than accumulating drift.
+"""
+import threading
+import time
+import traceback
+
+import slots
+
+class SlotStats:
+    """ Timing statistics for one slot. """
+    def __init__(self):
+        self.num_starts = 0
+        self.num_runs = 0
+        self.num_late_runs = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_run_time = 0.0
+        self.max_run_time = 0.0
+        self.load_time = 0.0
+
+    def record_run(self, lateness : float, run_time : float, late_threshold : float):
+        self.num_runs += 1
+        if lateness > late_threshold:
+            self.num_late_runs += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.total_run_time += run_time
+        self.max_run_time = max(self.max_run_time, run_time)
+
+    def as_dict(self) -> dict:
+        """ Stats in ms, for sending as json. """
+        runs = max(self.num_runs, 1)
+        return {
+            "starts": self.num_starts,
+            "runs": self.num_runs,
+            "late_runs": self.num_late_runs,
+            "mean_lateness_ms": 1000 * self.total_lateness / runs,
+            "max_lateness_ms": 1000 * self.max_lateness,
+            "mean_run_ms": 1000 * self.total_run_time / runs,
+            "max_run_ms": 1000 * self.max_run_time,
+            "load_ms": 1000 * self.load_time,
+        }
+
+class SlotPlayer:
+    STOPPED = "stopped"
+    SHOW_SLOT = "show_slot"
+    ROUND_ROBIN = "round_robin"
+
+    def __init__(self, driver, get_slot_data, num_slots : int, minimum_slot_time : float, late_threshold : float, cache=None, has_slot=None):
+        """ Constructor.
+
+        get_slot_data(index) returns the slot's (content hash, data), or
+        None if it is empty. has_slot(index) says whether a slot has data
+        without reading it, and is how round robin skips empty slots; it
+        falls back to get_slot_data.
+        minimum_slot_time is how long each slot is shown in round robin and
+        late_threshold is how late a run can be before it counts as late, both
+        in seconds. Slots are decoded through cache (a SlotCache) if given.
+        """
+        self._driver = driver
+        self._cache = cache
+        self._get_slot_data = get_slot_data
+        self._has_slot = has_slot if has_slot is not None else lambda index: get_slot_data(index) is not None
+        self._num_slots = num_slots
+        self._minimum_slot_time = minimum_slot_time
+        self._late_threshold = late_threshold
+
+        # Requests from other threads, guarded by _cv.
+        self._cv = threading.Condition()
+        self._state = SlotPlayer.STOPPED
+        self._show_index = None
+        self._changed = False
+        self._changed_slots = set()
+
+        # Playback state, only touched by the playback thread.
+        self._index = None
+        self._last_index = None
+        self._slot = None
+        self._slot_start = None
+        self._run_deadline = None
+        self._switch_deadline = None
+        self._stats = {}
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def show_slot(self, slot_index : int) -> None:
+        """ Show one slot until told otherwise. """
+        self._request(SlotPlayer.SHOW_SLOT, slot_index)
+
+    def round_robin(self) -> None:
+        """ Cycle through all slots that have data. """
+        self._request(SlotPlayer.ROUND_ROBIN, None)
+
+    def stop(self) -> None:
+        """ Stop playing slots, e.g. because live images are being shown. """
+        self._request(SlotPlayer.STOPPED, None)
+
+    def slot_changed(self, slot_index : int) -> None:
+        """ Tell the player that a slot's data has changed. """
+        with self._cv:
+            self._changed_slots.add(slot_index)
+            self._cv.notify()
+
+    def stats(self) -> dict:
+        """ Timing stats per slot, plus what is playing now. """
+        with self._cv:
+            stats = {
+                "state": self._state,
+                "playing": self._index,
+                "slots": {index: stats.as_dict() for index, stats in list(self._stats.items())},
+            }
+        if self._cache is not None:
+            stats["cache"] = self._cache.stats()
+        return stats
+
+    def _request(self, state : str, slot_index : int | None):
+        with self._cv:
+            self._state = state
+            self._show_index = slot_index
+            self._changed = True
+            self._cv.notify()
+
+    def _run(self):
+        """ Code for the playback thread. """
+        while True:
+            with self._cv:
+                while not self._has_changed():
+                    deadline = self._next_deadline()
+                    now = time.monotonic()
+                    if deadline is not None and now >= deadline:
+                        break
+                    self._cv.wait(None if deadline is None else deadline - now)
+                changed = self._has_changed()
+                self._changed = False
+                self._changed_slots.clear()
+                state = self._state
+                show_index = self._show_index
+
+            try:
+                self._step(changed, state, show_index)
+            except Exception:
+                traceback.print_exc()
+                self._end_slot()
+
+    def _has_changed(self) -> bool:
+        """ Whether playback needs restarting. Call with _cv held. """
+        if self._changed or self._index in self._changed_slots:
+            return True
+        # A slot that was empty may now have data to show.
+        return self._index is None and self._state != SlotPlayer.STOPPED and bool(self._changed_slots)
+
+    def _next_deadline(self) -> float | None:
+        deadlines = [d for d in (self._run_deadline, self._switch_deadline) if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def _step(self, changed : bool, state : str, show_index : int | None):
+        if changed:
+            self._end_slot()
+            if state == SlotPlayer.SHOW_SLOT:
+                self._start_slot(show_index, state)
+            elif state == SlotPlayer.ROUND_ROBIN:
+                self._start_slot(self._next_round_robin_index(), state)
+        elif self._switch_deadline is not None and time.monotonic() >= self._switch_deadline:
+            self._end_slot()
+            self._start_slot(self._next_round_robin_index(), state)
+
+        if self._run_deadline is not None and time.monotonic() >= self._run_deadline:
+            self._run_slot()
+
+    def _next_round_robin_index(self) -> int | None:
+        """ Find the next slot after the last one shown that has data. """
+        first = -1 if self._last_index is None else self._last_index
+        for offset in range(1, self._num_slots + 1):
+            index = (first + offset) % self._num_slots
+            if self._has_slot(index):
+                return index
+        return None
+
+    def _start_slot(self, index : int | None, state : str):
+        if index is None:
+            return
+        slot_data = self._get_slot_data(index)
+        if slot_data is None:
+            return
+        content_hash, data = slot_data
+        stats = self._stats.setdefault(index, SlotStats())
+        load_start = time.monotonic()
+        if self._cache is not None:
+            frames, release = self._cache.get(content_hash, data)
+            self._slot = slots.load_slot(data, self._driver, frames=frames, release=release)
+        else:
+            self._slot = slots.load_slot(data, self._driver)
+        stats.load_time = time.monotonic() - load_start
+        stats.num_starts += 1
+
+        self._slot.start()
+        self._index = index
+        self._slot_start = time.monotonic()
+        self._run_deadline = self._slot_start
+        if state == SlotPlayer.ROUND_ROBIN:
+            self._switch_deadline = self._slot_start + self._minimum_slot_time
+
+    def _run_slot(self):
+        deadline = self._run_deadline
+        run_start = time.monotonic()
+        deltatime = int(1000 * (run_start - self._slot_start))
+        next_time = self._slot.run(self._slot_start, deltatime)
+        run_end = time.monotonic()
+        self._stats[self._index].record_run(run_start - deadline, run_end - run_start, self._late_threshold)
+        if next_time is None:
+            self._run_deadline = None
+        else:
+            self._run_deadline = self._slot_start + next_time / 1000
+
+    def _end_slot(self):
+        slot = self._slot
+        if self._index is not None:
+            self._last_index = self._index
+        self._index = None
+        self._slot = None
+        self._run_deadline = None
+        self._switch_deadline = None
+        if slot is not None:
+            slot.end()
@@ -0,0 +1,12 @@
+from .slot_interface import Slot
+from .image_slot import ImageSlot
+from .animated_slot import AnimatedSlot, DecodedFrames, decode_frames, render_frames
+
+def load_slot(data: bytes, driver, frames: DecodedFrames | None = None, release=None) -> Slot:
+    """ Create the slot that shows the given slot data.
+
+    frames are the data's already decoded frames, e.g. from a SlotCache.
+    """
+    if frames is not None:
+        return AnimatedSlot(data, driver, frames=frames, release=release)
+    return ImageSlot(data, driver)
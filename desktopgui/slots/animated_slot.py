@@ -0,0 +1,73 @@
+import bisect
+import io
+
+from PIL import Image, ImageSequence
+
+class DecodedFrames:
+    """ A slot's frames, pre-rendered onto canvases, with their end times in ms. """
+    def __init__(self, canvases, frame_ends: [int]):
+        self.canvases = canvases
+        self.frame_ends = frame_ends
+
+def decode_frames(data: bytes, driver, spare_canvases=None) -> DecodedFrames:
+    """ Decode every frame of an image and render each onto a canvas.
+
+    Canvases are taken from spare_canvases (a list) before new ones are made.
+    """
+    canvases = []
+    frame_ends = []
+    end = 0
+    with Image.open(io.BytesIO(data)) as image:
+        for frame in ImageSequence.Iterator(image):
+            end += max(frame.info.get("duration", 100), 1)
+            frame_ends.append(end)
+            canvas = spare_canvases.pop() if spare_canvases else None
+            canvases.append(driver.get_canvas(frame, canvas=canvas))
+    return DecodedFrames(canvases, frame_ends)
+
+def render_frames(slot_file, driver, spare_canvases=None) -> DecodedFrames:
+    """ Render every frame of a SlotFile onto a canvas, without decoding. """
+    canvases = []
+    frame_ends = []
+    end = 0
+    for i in range(len(slot_file)):
+        end += slot_file.durations[i]
+        frame_ends.append(end)
+        canvas = spare_canvases.pop() if spare_canvases else None
+        canvases.append(driver.get_canvas(slot_file.frame(i), canvas=canvas))
+    return DecodedFrames(canvases, frame_ends)
+
+class AnimatedSlot:
+    def __init__(self, data: bytes, driver, frames: DecodedFrames | None = None, release=None):
+        """ Constructor. Decodes data unless already decoded frames are given.
+
+        release is called when the slot ends, to hand the frames back to the
+        cache they came from.
+        """
+        self.driver = driver
+        self.frames = frames if frames is not None else decode_frames(data, driver)
+        self.release = release
+        self.frame_index = 0
+
+    def start(self):
+        self.frame_index = 0
+        self.driver.display_canvas(self.frames.canvases[0])
+
+    def run(self, start, deltatime: int):
+        frame_ends = self.frames.frame_ends
+        if len(frame_ends) < 2:
+            return None
+        # Work out the frame from the time since start rather than counting
+        # frames, so late calls skip frames instead of drifting.
+        loop_time = frame_ends[-1]
+        loop, offset = divmod(deltatime, loop_time)
+        frame_index = bisect.bisect_right(frame_ends, offset)
+        if frame_index != self.frame_index:
+            self.frame_index = frame_index
+            self.driver.display_canvas(self.frames.canvases[frame_index])
+        return loop * loop_time + frame_ends[frame_index]
+
+    def end(self):
+        if self.release is not None:
+            self.release()
+            self.release = None
@@ -1,15 +1,48 @@
+import bisect
+import io
+
 from PIL import Image
 
 class ImageSlot:
     def __init__(self, data: bytes, driver):
         self.driver = driver
-        self.canvas = self.driver.get_canvas(Image.open(data))
+        self.image = Image.open(io.BytesIO(data))
+        # Each frame is rendered once, when first shown, and its canvas
+        # reused on later loops; the driver never frees canvases.
+        self.canvases = [self.driver.get_canvas(self.image)]
+
+        # Frame end times in ms, for animated images.
+        self.frame_ends = []
+        n_frames = getattr(self.image, "n_frames", 1)
+        if n_frames > 1:
+            end = 0
+            for i in range(n_frames):
+                self.image.seek(i)
+                end += max(self.image.info.get("duration", 100), 1)
+                self.frame_ends.append(end)
+            self.image.seek(0)
+            self.canvases += [None] * (n_frames - 1)
+        self.frame_index = 0
     
     def start(self):
-        self.driver.display_canvas(self.canvas)
+        self.frame_index = 0
+        self.driver.display_canvas(self.canvases[0])
     
     def run(self, start, deltatime: int):
-        pass
+        if not self.frame_ends:
+            return None
+        # Work out the frame from the time since start rather than counting
+        # frames, so late calls skip frames instead of drifting.
+        loop_time = self.frame_ends[-1]
+        loop, offset = divmod(deltatime, loop_time)
+        frame_index = bisect.bisect_right(self.frame_ends, offset)
+        if frame_index != self.frame_index:
+            self.frame_index = frame_index
+            if self.canvases[frame_index] is None:
+                self.image.seek(frame_index)
+                self.canvases[frame_index] = self.driver.get_canvas(self.image)
+            self.driver.display_canvas(self.canvases[frame_index])
+        return loop * loop_time + self.frame_ends[frame_index]
     
     def end(self):
-        pass
\ No newline at end of file
+        pass
@@ -1,4 +1,9 @@
 class Slot:
+    """ Something the slot player can show on the matrix.
+
+    The player calls start() when the slot is shown, run() whenever the time
+    it last asked for has come, and end() when it switches away.
+    """
     def __init__(self, data: bytes, driver):
         ...
     
@@ -6,7 +11,12 @@ class Slot:
         ...
     
     def run(self, start, deltatime: int):
+        """ Update the display for deltatime ms after start (a monotonic time).
+
+        Returns the time in ms after start at which run should next be called,
+        or None if the slot has nothing more to show.
+        """
         ...
     
     def end(self):
-        ...
\ No newline at end of file
+        ...
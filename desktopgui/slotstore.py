@@ -0,0 +1,188 @@
+"""Content-addressed storage for slot GIFs.
+
+Every GIF is stored once as a blob named after its SHA-1, however many
+slots show it. A slot is a small pointer record naming its blob, so giving
+a slot a GIF the device already has only rewrites the record. Files are
+written to a temporary name and renamed into place, so a crash never leaves
+a half-written slot, and blobs no slot points at are garbage collected.
+
+Layout under the store's root:
+  blobs/<hash>.gif        the GIFs
+  frames/<hash>.frames    compact versions of them (see slotfile.py)
+  slots/<n>.json          {"hash": ..., "size": ...} for each set slot
+"""
+import hashlib
+import json
+import os
+import pathlib
+import threading
+
+def content_hash(data : bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+def write_atomically(files : dict) -> None:
+    """ Write {path: bytes}, each replacing its path atomically.
+
+    Everything is written to temporary files and each is synced to disk
+    before any of them is renamed into place.
+    """
+    tmp_paths = {}
+    try:
+        for path, data in files.items():
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                tmp_paths[path] = tmp_path
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        for path, tmp_path in tmp_paths.items():
+            os.replace(tmp_path, path)
+    except:
+        for tmp_path in tmp_paths.values():
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        raise
+    # Make the renames themselves durable.
+    if hasattr(os, "O_DIRECTORY"):
+        for directory in {os.path.dirname(os.path.abspath(path)) for path in files}:
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+class SlotStore:
+
+    def __init__(self, root, num_slots : int):
+        self._root = pathlib.Path(root)
+        self._num_slots = num_slots
+        self._blob_dir = self._root / "blobs"
+        self._frames_dir = self._root / "frames"
+        self._slot_dir = self._root / "slots"
+        for directory in (self._blob_dir, self._frames_dir, self._slot_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._records = {}
+        for slot_index in range(num_slots):
+            try:
+                with open(self._record_path(slot_index), "r") as f:
+                    self._records[slot_index] = json.load(f)
+            except FileNotFoundError:
+                pass
+        self._import_legacy_slots()
+
+    def blob_path(self, content_hash : str) -> pathlib.Path:
+        return self._blob_dir / f"{content_hash}.gif"
+
+    def frames_path(self, content_hash : str) -> pathlib.Path:
+        return self._frames_dir / f"{content_hash}.frames"
+
+    def _record_path(self, slot_index : int) -> pathlib.Path:
+        return self._slot_dir / f"{slot_index}.json"
+
+    def _check_slot(self, slot_index : int):
+        if not 0 <= slot_index < self._num_slots:
+            raise RuntimeError(f"No slot {slot_index}")
+
+    def info(self, slot_index : int) -> dict | None:
+        """ The slot's pointer record, {"hash": ..., "size": ...}, or None if empty. """
+        with self._lock:
+            return self._records.get(slot_index)
+
+    def get(self, slot_index : int) -> tuple[str, bytes] | None:
+        """ Get a slot's (hash, GIF data), or None if it is empty. """
+        record = self.info(slot_index)
+        if record is None:
+            return None
+        try:
+            with open(self.blob_path(record["hash"]), "rb") as f:
+                return record["hash"], f.read()
+        except FileNotFoundError:
+            # Cleared or replaced (and collected) since we looked.
+            return None
+
+    def has_blob(self, content_hash : str) -> bool:
+        return self.blob_path(content_hash).exists()
+
+    def set_slots(self, slot_data : {int: bytes | None}) -> {int: str | None}:
+        """ Point slots at new GIFs, None clears a slot. New blobs are on
+        disk before any record points at them. Returns the hash each slot
+        now has. """
+        for slot_index in slot_data:
+            self._check_slot(slot_index)
+        hashes = {slot_index: None if data is None else content_hash(data) for slot_index, data in slot_data.items()}
+        with self._lock:
+            blobs = {}
+            for slot_index, data in slot_data.items():
+                if data is not None and not self.has_blob(hashes[slot_index]):
+                    blobs[self.blob_path(hashes[slot_index])] = data
+            write_atomically(blobs)
+            self._write_records({
+                slot_index: None if data is None else {"hash": hashes[slot_index], "size": len(data)}
+                for slot_index, data in slot_data.items()})
+        return hashes
+
+    def assign(self, slot_index : int, content_hash : str) -> bool:
+        """ Point a slot at a blob the store already has. Returns False if it
+        doesn't have it. """
+        self._check_slot(slot_index)
+        with self._lock:
+            path = self.blob_path(content_hash)
+            if not path.exists():
+                return False
+            self._write_records({slot_index: {"hash": content_hash, "size": path.stat().st_size}})
+        return True
+
+    def clear(self, slot_index : int) -> bool:
+        """ Empty a slot. Returns False if it was already empty. """
+        self._check_slot(slot_index)
+        with self._lock:
+            if slot_index not in self._records:
+                return False
+            self._write_records({slot_index: None})
+        return True
+
+    def referenced_hashes(self) -> set:
+        with self._lock:
+            return {record["hash"] for record in self._records.values()}
+
+    def gc(self) -> [str]:
+        """ Delete blobs and compact files no slot points at. Returns their hashes. """
+        removed = []
+        with self._lock:
+            referenced = {record["hash"] for record in self._records.values()}
+            for path in list(self._blob_dir.glob("*.gif")) + list(self._frames_dir.glob("*.frames")):
+                if path.stem not in referenced:
+                    path.unlink(missing_ok=True)
+                    removed.append(path.stem)
+            for path in list(self._blob_dir.glob("*.tmp")) + list(self._frames_dir.glob("*.tmp")):
+                path.unlink(missing_ok=True)
+        return sorted(set(removed))
+
+    def _write_records(self, records : {int: dict | None}):
+        """ Write or delete pointer records. Call with _lock held. """
+        write_atomically({
+            self._record_path(slot_index): json.dumps(record).encode("utf-8")
+            for slot_index, record in records.items() if record is not None})
+        for slot_index, record in records.items():
+            if record is None:
+                self._record_path(slot_index).unlink(missing_ok=True)
+                self._records.pop(slot_index, None)
+            else:
+                self._records[slot_index] = record
+
+    def _import_legacy_slots(self):
+        """ Move slots stored as <n>.gif, from before the store, into it. """
+        legacy = {}
+        for slot_index in range(self._num_slots):
+            path = self._root / f"{slot_index}.gif"
+            if path.exists() and slot_index not in self._records:
+                legacy[slot_index] = path.read_bytes()
+        if legacy:
+            print(f"Importing slots {sorted(legacy)} into the slot store")
+            self.set_slots(legacy)
+        for slot_index in range(self._num_slots):
+            (self._root / f"{slot_index}.gif").unlink(missing_ok=True)
+            (self._root / f"{slot_index}.frames").unlink(missing_ok=True)
@@ -0,0 +1,88 @@
+"""Persistent TCP stream for live frames.
+
+Clients keep one connection open and push raw frames (see frameformat.py)
+back-to-back, each prefixed by its length. The device acknowledges every
+frame with its sequence number and a status from a separate thread, so the
+client never waits on an ack before sending the next frame.
+"""
+import queue
+import socket
+import socketserver
+import threading
+import traceback
+
+import frameformat
+
+def _recv_exactly(sock, size : int) -> bytearray | None:
+    """ Read exactly size bytes, or return None if the peer closed. """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            return None
+        received += n
+    return buffer
+
+def _send_acks(sock, acks : queue.SimpleQueue):
+    """ Write acks to the socket until a None is queued. """
+    while True:
+        ack = acks.get()
+        if ack is None:
+            return
+        try:
+            sock.sendall(ack)
+        except OSError:
+            return
+
+def matrix_stream_server(api):
+
+    class StreamHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            sock = self.request
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print(f"Live stream connected from {self.client_address}")
+            acks = queue.SimpleQueue()
+            ack_thread = threading.Thread(target=_send_acks, args=(sock, acks), daemon=True)
+            ack_thread.start()
+            try:
+                while True:
+                    length_data = _recv_exactly(sock, frameformat.STREAM_LENGTH.size)
+                    if length_data is None:
+                        break
+                    (length,) = frameformat.STREAM_LENGTH.unpack(length_data)
+                    if length > frameformat.STREAM_MAX_FRAME_BYTES:
+                        print(f"Dropping live stream, frame of {length} bytes is too big")
+                        break
+                    with api.metrics.time("receive"):
+                        frame_data = _recv_exactly(sock, length)
+                    if frame_data is None:
+                        break
+                    seq = 0
+                    try:
+                        seq = frameformat.decode_header(frame_data).seq
+                        res = api.set_live_frame(frame_data)
+                        status = frameformat.ACK_OK if res else frameformat.ACK_ERROR
+                    except frameformat.ResyncRequired:
+                        status = frameformat.ACK_RESYNC
+                    except Exception:
+                        traceback.print_exc()
+                        status = frameformat.ACK_ERROR
+                    acks.put(frameformat.STREAM_ACK.pack(seq, status))
+            except OSError as e:
+                print(f"Live stream from {self.client_address} failed: {e}")
+            finally:
+                acks.put(None)
+                ack_thread.join()
+                print(f"Live stream from {self.client_address} closed")
+
+    class StreamServer(socketserver.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    def run(host, port):
+        with StreamServer((host, port), StreamHandler) as stream_server:
+            stream_server.serve_forever()
+
+    return run
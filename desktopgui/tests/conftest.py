@@ -0,0 +1,6 @@
+import pathlib
+import sys
+
+# The modules under test import each other by bare name, as they do when the
+# client and device are run from desktopgui/.
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1]))
@@ -0,0 +1,53 @@
+"""How the asyncio server gates live frames under load."""
+import asyncio
+import concurrent.futures
+import threading
+
+import asyncserver
+import frameformat
+
+def run_gate(coalesce : bool, frames : [(str, bool)]) -> ([str], list):
+    """ Submit frames (name, keyframe) while the first one is still being
+    applied. Returns the names applied, in order, and each submit's result. """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    gate = asyncserver._LiveGate(executor, coalesce)
+    release = threading.Event()
+    applied = []
+
+    def apply(name):
+        release.wait()
+        applied.append(name)
+        return True
+
+    async def submit(name, keyframe):
+        try:
+            return await gate.submit(apply, name, keyframe)
+        except frameformat.ResyncRequired:
+            return "resync"
+
+    async def main():
+        tasks = []
+        for name, keyframe in frames:
+            tasks.append(asyncio.create_task(submit(name, keyframe)))
+            await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(main())
+    executor.shutdown()
+    return applied, results
+
+def test_a_keyframe_replaces_the_waiting_frame():
+    applied, results = run_gate(True, [("a", True), ("b", False), ("c", True)])
+    assert applied == ["a", "c"]
+    assert results == [True, asyncserver._SUPERSEDED, True]
+
+def test_a_delta_never_replaces_the_waiting_frame():
+    applied, results = run_gate(True, [("a", True), ("b", True), ("c", False)])
+    assert applied == ["a", "b"]
+    assert results == [True, True, "resync"]
+
+def test_without_coalescing_frames_arriving_while_busy_are_dropped():
+    applied, results = run_gate(False, [("a", True), ("b", True)])
+    assert applied == ["a"]
+    assert results == [True, asyncserver._SUPERSEDED]
@@ -0,0 +1,139 @@
+"""Round trips and error paths of the raw live frame format."""
+import numpy as np
+import pytest
+from PIL import Image
+
+import deviceapi
+import frameformat
+import simdriver
+from frameformat import FrameFormat
+
+SIZE = (128, 128)
+
+def random_image(seed : int, size=SIZE) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, size=(size[1], size[0], 3), dtype=np.uint8))
+
+def pixels(img : Image.Image) -> np.ndarray:
+    return np.asarray(img, dtype=np.int16)
+
+def test_keyframe_round_trip_rgb888():
+    img = random_image(0)
+    header, decoded = frameformat.decode_frame(frameformat.encode_frame(img, FrameFormat.RGB888, 7))
+    assert header == frameformat.FrameHeader(FrameFormat.RGB888, 0, SIZE[0], SIZE[1], 7)
+    assert decoded.tobytes() == img.tobytes()
+
+def test_keyframe_round_trip_rgb565_keeps_top_bits():
+    img = random_image(1)
+    _, decoded = frameformat.decode_frame(frameformat.encode_frame(img, FrameFormat.RGB565, 0))
+    shifts = np.array([3, 2, 3])
+    assert (pixels(decoded) >> shifts == pixels(img) >> shifts).all()
+
+def test_timestamp_round_trip():
+    img = random_image(2)
+    data = frameformat.encode_frame(img, FrameFormat.RGB888, 1, timestamp=1234.5)
+    header = frameformat.decode_header(data)
+    assert header.flags & frameformat.FLAG_TIMESTAMP
+    assert frameformat.decode_timestamp(data, header) == 1234.5
+    assert frameformat.decode_frame(data)[1].tobytes() == img.tobytes()
+    plain = frameformat.encode_frame(img, FrameFormat.RGB888, 1)
+    assert frameformat.decode_timestamp(plain, frameformat.decode_header(plain)) is None
+
+def test_seq_wraps_to_32_bits():
+    data = frameformat.encode_frame(random_image(3), FrameFormat.RGB888, 0xFFFFFFFF + 1)
+    assert frameformat.decode_header(data).seq == 0
+
+@pytest.mark.parametrize("fmt", list(FrameFormat))
+@pytest.mark.parametrize("timestamp", [None, 99.25])
+def test_delta_round_trip(fmt, timestamp):
+    old = random_image(4)
+    new = old.copy()
+    new.paste((255, 0, 0), (3, 5, 40, 9))
+    new.paste((0, 255, 0), (100, 100, 128, 128))
+    boxes = frameformat.find_dirty_boxes(old, new, 16)
+    assert boxes
+    data = frameformat.encode_delta_frame(new, boxes, fmt, 8, timestamp=timestamp)
+    header = frameformat.decode_header(data)
+    assert header.flags & frameformat.FLAG_DELTA
+    assert frameformat.decode_timestamp(data, header) == timestamp
+
+    # Patching the image the device already has gives the new one, as far
+    # as the pixel format can tell.
+    base = frameformat.decode_frame(frameformat.encode_frame(old, fmt, 7))[1]
+    expected = frameformat.decode_frame(frameformat.encode_frame(new, fmt, 8))[1]
+    for position, patch in frameformat.decode_delta_rects(data, header):
+        base.paste(patch, position)
+    assert base.tobytes() == expected.tobytes()
+
+def test_unchanged_images_have_no_dirty_boxes():
+    img = random_image(5)
+    assert frameformat.find_dirty_boxes(img, img.copy(), 16) == []
+
+def test_empty_delta_round_trip():
+    data = frameformat.encode_delta_frame(random_image(6), [], FrameFormat.RGB888, 3)
+    assert frameformat.decode_delta_rects(data, frameformat.decode_header(data)) == []
+
+def test_dirty_boxes_cover_a_change_across_a_tile_edge():
+    old = Image.new("RGB", SIZE)
+    new = old.copy()
+    new.putpixel((15, 15), (1, 2, 3))
+    new.putpixel((16, 16), (4, 5, 6))
+    boxes = frameformat.find_dirty_boxes(old, new, 16)
+    covered = np.zeros((SIZE[1], SIZE[0]), dtype=bool)
+    for left, top, right, bottom in boxes:
+        covered[top:bottom, left:right] = True
+    assert covered[15, 15] and covered[16, 16]
+    # Only the two tiles that changed.
+    assert covered.sum() == 2 * 16 * 16
+
+@pytest.mark.parametrize("data, message", [
+    (b"MF\x00", "too short for a header"),
+    (b"XX" + bytes(frameformat.FRAME_HEADER.size - 2), "Bad frame magic"),
+    (frameformat.FRAME_HEADER.pack(b"MF", 9, 0, 1, 1, 0), "Unsupported frame format"),
+    (frameformat.FRAME_HEADER.pack(b"MF", 0, frameformat.FLAG_TIMESTAMP, 1, 1, 0), "too short for a timestamp"),
+])
+def test_bad_headers_are_rejected(data, message):
+    with pytest.raises(RuntimeError, match=message):
+        frameformat.decode_header(data)
+
+def test_wrong_pixel_count_is_rejected():
+    data = frameformat.encode_frame(random_image(7), FrameFormat.RGB888, 0)
+    with pytest.raises(RuntimeError, match="bytes of pixel data"):
+        frameformat.decode_frame(data[:-1])
+
+def test_delta_rect_outside_frame_is_rejected():
+    img = random_image(8, size=(8, 8))
+    data = frameformat.encode_delta_frame(img, [(4, 4, 8, 8)], FrameFormat.RGB888, 1)
+    # Move the rectangle so it hangs off the right edge.
+    offset = frameformat.payload_offset(frameformat.decode_header(data)) + frameformat.DELTA_COUNT.size
+    data = data[:offset] + frameformat.DELTA_RECT.pack(6, 4, 4, 4) + data[offset + frameformat.DELTA_RECT.size:]
+    with pytest.raises(RuntimeError, match="outside the frame"):
+        frameformat.decode_delta_rects(data, frameformat.decode_header(data))
+
+def test_delta_trailing_bytes_are_rejected():
+    data = frameformat.encode_delta_frame(random_image(9), [(0, 0, 4, 4)], FrameFormat.RGB888, 1) + b"\x00"
+    with pytest.raises(RuntimeError, match="trailing bytes"):
+        frameformat.decode_delta_rects(data, frameformat.decode_header(data))
+
+@pytest.fixture
+def device(tmp_path):
+    return deviceapi.DeviceAPI(simdriver.RecordingDriver(), slot_data_dir=tmp_path)
+
+def test_device_applies_delta_across_seq_wraparound(device):
+    old = random_image(10)
+    new = old.copy()
+    new.paste((9, 9, 9), (0, 0, 16, 16))
+    device.set_live_frame(frameformat.encode_frame(old, FrameFormat.RGB888, 0xFFFFFFFF))
+    boxes = frameformat.find_dirty_boxes(old, new, 16)
+    device.set_live_frame(frameformat.encode_delta_frame(new, boxes, FrameFormat.RGB888, 0))
+    assert device.matrix_driver.frames[-1][1].tobytes() == new.tobytes()
+
+def test_device_wants_a_keyframe_after_a_gap(device):
+    img = random_image(11)
+    device.set_live_frame(frameformat.encode_frame(img, FrameFormat.RGB888, 5))
+    with pytest.raises(frameformat.ResyncRequired):
+        device.set_live_frame(frameformat.encode_delta_frame(img, [(0, 0, 16, 16)], FrameFormat.RGB888, 7))
+
+def test_device_wants_a_keyframe_first(device):
+    with pytest.raises(frameformat.ResyncRequired):
+        device.set_live_frame(frameformat.encode_delta_frame(random_image(12), [(0, 0, 16, 16)], FrameFormat.RGB888, 1))
@@ -0,0 +1,71 @@
+"""Ordering, pacing and dropping of frames in the jitter buffer."""
+import threading
+import time
+
+import jitterbuffer
+
+class Presented:
+    """ Records what the buffer shows. """
+    def __init__(self):
+        self.frames = []
+        self.event = threading.Event()
+
+    def __call__(self, img):
+        self.frames.append(img)
+        self.event.set()
+
+    def wait_for(self, count : int, timeout : float = 5) -> bool:
+        deadline = time.monotonic() + timeout
+        while len(self.frames) < count and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return len(self.frames) >= count
+
+def test_frames_are_shown_in_capture_order():
+    presented = Presented()
+    buffer = jitterbuffer.JitterBuffer(presented, tick_hz=200, min_delay=0.1, max_delay=0.5)
+    now = time.time()
+    # Arrive out of order, as if the network reordered them.
+    for name, offset in (("c", 0.10), ("a", 0.0), ("b", 0.05)):
+        assert buffer.put(name, now + offset)
+    assert presented.wait_for(3)
+    assert presented.frames == ["a", "b", "c"]
+    assert buffer.stats()["presented"] == 3
+
+def test_frames_are_held_for_the_delay():
+    presented = Presented()
+    buffer = jitterbuffer.JitterBuffer(presented, tick_hz=200, min_delay=0.2, max_delay=0.5)
+    start = time.monotonic()
+    assert buffer.put("a", time.time())
+    assert presented.event.wait(5)
+    assert time.monotonic() - start >= 0.15
+
+def test_late_frames_are_dropped():
+    presented = Presented()
+    buffer = jitterbuffer.JitterBuffer(presented, tick_hz=200, min_delay=0.05, max_delay=0.1)
+    assert buffer.put("on time", time.time())
+    # Captured a second before the fastest transit seen allows.
+    assert not buffer.put("late", time.time() - 1)
+    assert presented.wait_for(1)
+    time.sleep(0.2)
+    assert presented.frames == ["on time"]
+    assert buffer.stats()["dropped_late"] == 1
+
+def test_only_the_newest_due_frame_is_shown_on_a_tick():
+    presented = Presented()
+    buffer = jitterbuffer.JitterBuffer(presented, tick_hz=5, min_delay=0.05, max_delay=0.1)
+    now = time.time()
+    assert buffer.put("older", now)
+    assert buffer.put("newer", now + 0.001)
+    assert presented.wait_for(1)
+    time.sleep(0.3)
+    assert presented.frames == ["newer"]
+    assert buffer.stats()["dropped_skipped"] == 1
+
+def test_clear_drops_waiting_frames():
+    presented = Presented()
+    buffer = jitterbuffer.JitterBuffer(presented, tick_hz=200, min_delay=0.3, max_delay=0.5)
+    assert buffer.put("a", time.time())
+    buffer.clear()
+    assert buffer.stats()["depth"] == 0
+    time.sleep(0.5)
+    assert presented.frames == []
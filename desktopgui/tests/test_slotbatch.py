@@ -0,0 +1,85 @@
+"""Round trips and error paths of the slot batch format."""
+import io
+
+import pytest
+import requests
+from PIL import Image
+
+import benchmark
+import slotbatch
+from slotbatch import SLOT_DATA, SLOT_EMPTY, SLOT_UNCHANGED
+
+def gif_data(colour) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (128, 128), colour).save(buffer, format="gif")
+    return buffer.getvalue()
+
+def test_round_trip_of_every_state():
+    entries = {
+        0: (SLOT_DATA, b"GIF89a first"),
+        3: (SLOT_EMPTY, None),
+        7: (SLOT_UNCHANGED, None),
+        19: (SLOT_DATA, b""),
+    }
+    assert slotbatch.decode_batch(slotbatch.encode_batch(entries)) == entries
+
+def test_only_data_entries_carry_bytes():
+    # Data given with another state is dropped, not sent.
+    batch = slotbatch.encode_batch({0: (SLOT_EMPTY, b"stale"), 1: (SLOT_UNCHANGED, b"stale")})
+    assert len(batch) == slotbatch.BATCH_HEADER.size + 2 * slotbatch.BATCH_ENTRY.size
+    assert slotbatch.decode_batch(batch) == {0: (SLOT_EMPTY, None), 1: (SLOT_UNCHANGED, None)}
+
+def test_empty_batch():
+    assert slotbatch.decode_batch(slotbatch.encode_batch({})) == {}
+
+def test_bad_magic_is_rejected():
+    batch = b"XXXX" + slotbatch.encode_batch({})[4:]
+    with pytest.raises(RuntimeError, match="slot batch"):
+        slotbatch.decode_batch(batch)
+
+def test_unknown_version_is_rejected():
+    batch = slotbatch.BATCH_HEADER.pack(slotbatch.BATCH_MAGIC, slotbatch.BATCH_VERSION + 1, 0)
+    with pytest.raises(RuntimeError, match="slot batch"):
+        slotbatch.decode_batch(batch)
+
+def test_truncated_data_is_rejected():
+    batch = slotbatch.encode_batch({2: (SLOT_DATA, b"0123456789")})
+    with pytest.raises(RuntimeError, match="truncated at slot 2"):
+        slotbatch.decode_batch(batch[:-1])
+
+def test_unknown_state_is_rejected():
+    batch = slotbatch.encode_batch({4: (SLOT_UNCHANGED + 1, None)})
+    with pytest.raises(ValueError, match="slot 4 has unknown state"):
+        slotbatch.decode_batch(batch)
+
+def test_slot_out_of_range_is_rejected():
+    batch = slotbatch.encode_batch({20: (SLOT_EMPTY, None)})
+    assert slotbatch.decode_batch(batch) == {20: (SLOT_EMPTY, None)}
+    with pytest.raises(ValueError, match="slot 20"):
+        slotbatch.decode_batch(batch, num_slots=20)
+
+def test_parse_etags():
+    assert slotbatch.parse_etags(None) == set()
+    assert slotbatch.parse_etags('"abc", W/"def"') == {"abc", "def"}
+    assert slotbatch.parse_etags(slotbatch.etag("123")) == {"123"}
+
+@pytest.mark.parametrize("server_backend", ["flask", "asyncio"])
+def test_posting_a_batch_leaves_unchanged_slots_alone(server_backend, tmp_path):
+    bench = benchmark.Bench(server_backend, tmp_path)
+    bench.logic.process_set_slot(0, Image.new("RGB", (128, 128), (255, 0, 0)))
+    bench.logic.process_set_slot(1, Image.new("RGB", (128, 128), (0, 255, 0)))
+    batch = slotbatch.encode_batch({
+        0: (SLOT_UNCHANGED, None),
+        1: (SLOT_EMPTY, None),
+        2: (SLOT_DATA, gif_data((0, 0, 255))),
+    })
+    res = requests.post(f"{bench.client_api.base_url}/slots/batch", data=batch)
+    assert res.status_code == 201
+    assert [slot is not None for slot in bench.client_api.get_slots()[:3]] == [True, False, True]
+
+@pytest.mark.parametrize("server_backend", ["flask", "asyncio"])
+@pytest.mark.parametrize("entries", [{0: (SLOT_UNCHANGED + 1, None)}, {1000: (SLOT_EMPTY, None)}])
+def test_posting_a_bad_batch_is_a_bad_request(server_backend, entries, tmp_path):
+    bench = benchmark.Bench(server_backend, tmp_path)
+    res = requests.post(f"{bench.client_api.base_url}/slots/batch", data=slotbatch.encode_batch(entries))
+    assert res.status_code == 400
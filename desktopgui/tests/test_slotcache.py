@@ -0,0 +1,51 @@
+"""Reuse of evicted canvases by the slot cache."""
+import io
+
+from PIL import Image
+
+import simdriver
+import slotcache
+
+class PinningDriver(simdriver.NullDriver):
+    """ A driver that reports chosen canvases as still on the panel. """
+
+    def __init__(self):
+        super().__init__()
+        self.pinned = []
+
+    def canvas_in_use(self, canvas) -> bool:
+        return any(canvas is pinned for pinned in self.pinned)
+
+def gif_data(*colours) -> bytes:
+    frames = [Image.new("RGB", (128, 128), colour) for colour in colours]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="gif", save_all=True, append_images=frames[1:], duration=50, loop=0)
+    return buffer.getvalue()
+
+def test_evicted_canvases_are_reused():
+    driver = simdriver.NullDriver()
+    cache = slotcache.SlotCache(driver, budget_bytes=2 * driver.canvas_nbytes)
+    frames_a, release = cache.get("a", gif_data((255, 0, 0), (0, 255, 0)))
+    release()
+    _, release = cache.get("b", gif_data((0, 0, 255), (255, 255, 0)))
+    release()
+    frames_c, release = cache.get("c", gif_data((0, 255, 255), (255, 0, 255)))
+    release()
+    assert {id(canvas) for canvas in frames_c.canvases} == {id(canvas) for canvas in frames_a.canvases}
+
+def test_canvases_still_on_the_panel_are_not_drawn_over():
+    driver = PinningDriver()
+    cache = slotcache.SlotCache(driver, budget_bytes=2 * driver.canvas_nbytes)
+    frames_a, release = cache.get("a", gif_data((255, 0, 0), (0, 255, 0)))
+    # Slot a ended on its last frame, which is still displayed.
+    driver.pinned.append(frames_a.canvases[-1])
+    release()
+    _, release = cache.get("b", gif_data((0, 0, 255), (255, 255, 0)))
+    release()
+    frames_c, release = cache.get("c", gif_data((0, 255, 255), (255, 0, 255)))
+    release()
+    assert all(canvas is not frames_a.canvases[-1] for canvas in frames_c.canvases)
+    assert frames_a.canvases[-1].getpixel((0, 0)) == (0, 255, 0)
+
+    # It is kept as a spare for when the panel has moved on, not lost.
+    assert cache.stats()["spare_canvases"] == 3
@@ -0,0 +1,78 @@
+"""Round trips and error paths of the memory-mapped slot file format."""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+
+import slotfile
+
+def make_gif(colours, durations) -> bytes:
+    frames = [Image.new("RGB", (16, 8), colour) for colour in colours]
+    frames[0].paste((1, 2, 3), (0, 0, 4, 4))
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="gif", save_all=True, append_images=frames[1:], duration=durations, loop=0)
+    return buffer.getvalue()
+
+def test_round_trip(tmp_path):
+    data = make_gif([(255, 0, 0), (0, 255, 0), (0, 0, 255)], [40, 60, 80])
+    path = tmp_path / "slot.frames"
+    slotfile.write_slot_file(path, data)
+    assert not (tmp_path / "slot.frames.tmp").exists()
+
+    with slotfile.SlotFile(path) as slot, Image.open(io.BytesIO(data)) as gif:
+        assert slot.size == (16, 8)
+        assert len(slot) == 3
+        assert slot.durations == [40, 60, 80]
+        assert slot.source_hash == slotfile.source_hash(data)
+        for index, frame in enumerate(ImageSequence.Iterator(gif)):
+            assert slot.frame(index).tobytes() == frame.convert("RGB").tobytes()
+
+def test_offsets_point_at_back_to_back_frames(tmp_path):
+    path = tmp_path / "slot.frames"
+    slotfile.write_slot_file(path, make_gif([(255, 0, 0), (0, 255, 0)], [50, 50]))
+    with slotfile.SlotFile(path) as slot:
+        first = slotfile.SLOT_FILE_HEADER.size + len(slot) * slotfile.SLOT_FILE_INDEX.size
+        frame_size = 16 * 8 * 3
+        assert slot.offsets == [first, first + frame_size]
+        assert path.stat().st_size == first + 2 * frame_size
+
+def test_still_image_has_one_frame(tmp_path):
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4), (9, 9, 9)).save(buffer, format="gif")
+    path = tmp_path / "slot.frames"
+    slotfile.write_slot_file(path, buffer.getvalue())
+    with slotfile.SlotFile(path) as slot:
+        assert len(slot) == 1
+        assert (np.asarray(slot.frame(0)) == 9).all()
+
+def test_rewriting_replaces_the_file(tmp_path):
+    path = tmp_path / "slot.frames"
+    slotfile.write_slot_file(path, make_gif([(255, 0, 0), (0, 255, 0)], [50, 50]))
+    data = make_gif([(0, 0, 255), (255, 255, 0), (0, 255, 255)], [20, 30, 40])
+    slotfile.write_slot_file(path, data)
+    with slotfile.SlotFile(path) as slot:
+        assert len(slot) == 3
+        assert slot.source_hash == slotfile.source_hash(data)
+
+def test_bad_magic_is_rejected(tmp_path):
+    path = tmp_path / "slot.frames"
+    slotfile.write_slot_file(path, make_gif([(255, 0, 0)], [50]))
+    contents = path.read_bytes()
+    path.write_bytes(b"XXXX" + contents[4:])
+    with pytest.raises(RuntimeError, match="isn't a version"):
+        slotfile.SlotFile(path)
+
+def test_unknown_version_is_rejected(tmp_path):
+    path = tmp_path / "slot.frames"
+    path.write_bytes(slotfile.SLOT_FILE_HEADER.pack(slotfile.SLOT_FILE_MAGIC, slotfile.SLOT_FILE_VERSION + 1, 1, 1, 0, bytes(20)))
+    with pytest.raises(RuntimeError, match="isn't a version"):
+        slotfile.SlotFile(path)
+
+def test_truncated_file_is_rejected(tmp_path):
+    path = tmp_path / "slot.frames"
+    slotfile.write_slot_file(path, make_gif([(255, 0, 0), (0, 255, 0)], [50, 50]))
+    contents = path.read_bytes()
+    path.write_bytes(contents[:-1])
+    with pytest.raises(RuntimeError, match="truncated"):
+        slotfile.SlotFile(path)
@@ -0,0 +1,102 @@
+"""Scheduling of slots by the slot player."""
+import io
+import threading
+import time
+
+from PIL import Image
+
+import simdriver
+import slotplayer
+import slotstore
+
+RED, GREEN, BLUE = (255, 0, 0), (0, 255, 0), (0, 0, 255)
+
+class ShownDriver(simdriver.NullDriver):
+    """ Records the colour of every canvas shown, with when it was shown. """
+    def __init__(self):
+        super().__init__()
+        self.shown = []
+        self._shown_lock = threading.Lock()
+
+    def display_canvas(self, canvas) -> None:
+        with self._shown_lock:
+            self.shown.append((time.monotonic(), canvas.getpixel((0, 0))))
+        super().display_canvas(canvas)
+
+    def colours(self) -> list:
+        with self._shown_lock:
+            return [colour for _, colour in self.shown]
+
+    def wait_for(self, condition, timeout : float = 5) -> bool:
+        deadline = time.monotonic() + timeout
+        while not condition(self.colours()) and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return condition(self.colours())
+
+def gif_data(*frames : ((int, int, int), int)) -> bytes:
+    """ A GIF with one frame per (colour, duration in ms). """
+    images = [Image.new("RGB", (128, 128), colour) for colour, _ in frames]
+    buffer = io.BytesIO()
+    images[0].save(buffer, format="gif", save_all=True, append_images=images[1:],
+                   duration=[duration for _, duration in frames], loop=0)
+    return buffer.getvalue()
+
+def make_player(tmp_path, slots : {int: bytes}, num_slots : int = 4, minimum_slot_time : float = 0.1):
+    store = slotstore.SlotStore(tmp_path, num_slots)
+    store.set_slots(slots)
+    reads = []
+    def get_slot_data(index):
+        reads.append(index)
+        return store.get(index)
+    driver = ShownDriver()
+    player = slotplayer.SlotPlayer(driver, get_slot_data, num_slots=num_slots,
+                                   minimum_slot_time=minimum_slot_time, late_threshold=0.005,
+                                   has_slot=lambda index: store.info(index) is not None)
+    return store, driver, player, reads
+
+def test_show_slot_plays_its_frames_in_order(tmp_path):
+    _, driver, player, _ = make_player(tmp_path, {1: gif_data((RED, 50), (GREEN, 50), (BLUE, 50))})
+    player.show_slot(1)
+    assert driver.wait_for(lambda colours: len(colours) >= 7)
+    player.stop()
+    assert driver.colours()[:7] == [RED, GREEN, BLUE, RED, GREEN, BLUE, RED]
+    stats = player.stats()["slots"][1]
+    assert stats["starts"] == 1 and stats["runs"] >= 6
+
+def test_frames_follow_their_durations(tmp_path):
+    _, driver, player, _ = make_player(tmp_path, {0: gif_data((RED, 100), (GREEN, 200))})
+    player.show_slot(0)
+    assert driver.wait_for(lambda colours: len(colours) >= 3)
+    player.stop()
+    times = [shown_at for shown_at, _ in driver.shown[:3]]
+    # Scheduled from the slot's start, so the gaps match the durations.
+    assert abs(times[1] - times[0] - 0.1) < 0.05
+    assert abs(times[2] - times[1] - 0.2) < 0.05
+
+def test_round_robin_skips_empty_slots_without_reading_them(tmp_path):
+    _, driver, player, reads = make_player(tmp_path, {0: gif_data((RED, 100)), 2: gif_data((GREEN, 100))})
+    player.round_robin()
+    assert driver.wait_for(lambda colours: len(colours) >= 4)
+    player.stop()
+    assert driver.colours()[:4] == [RED, GREEN, RED, GREEN]
+    assert set(reads) == {0, 2}
+
+def test_round_robin_picks_up_a_slot_set_while_it_waits(tmp_path):
+    store, driver, player, _ = make_player(tmp_path, {})
+    player.round_robin()
+    time.sleep(0.05)
+    assert driver.colours() == []
+    store.set_slots({3: gif_data((BLUE, 100))})
+    player.slot_changed(3)
+    assert driver.wait_for(lambda colours: colours[:1] == [BLUE])
+
+def test_stop_ends_playback(tmp_path):
+    _, driver, player, _ = make_player(tmp_path, {0: gif_data((RED, 20), (GREEN, 20))})
+    player.show_slot(0)
+    assert driver.wait_for(lambda colours: len(colours) >= 2)
+    player.stop()
+    time.sleep(0.05)
+    count = len(driver.colours())
+    time.sleep(0.1)
+    assert len(driver.colours()) == count
+    assert player.stats()["playing"] is None
@@ -0,0 +1,81 @@
+"""Round trips, garbage collection and legacy import of the slot store."""
+import json
+
+import pytest
+
+import slotstore
+
+NUM_SLOTS = 4
+
+def test_round_trip_survives_reopening(tmp_path):
+    store = slotstore.SlotStore(tmp_path, NUM_SLOTS)
+    hashes = store.set_slots({0: b"GIF89a zero", 2: b"GIF89a two"})
+    assert hashes == {0: slotstore.content_hash(b"GIF89a zero"), 2: slotstore.content_hash(b"GIF89a two")}
+    assert store.get(0) == (hashes[0], b"GIF89a zero")
+    assert store.get(1) is None
+    assert store.info(2) == {"hash": hashes[2], "size": len(b"GIF89a two")}
+
+    reopened = slotstore.SlotStore(tmp_path, NUM_SLOTS)
+    assert reopened.get(0) == (hashes[0], b"GIF89a zero")
+    assert reopened.get(2) == (hashes[2], b"GIF89a two")
+    assert reopened.get(1) is None
+
+def test_slots_with_the_same_gif_share_a_blob(tmp_path):
+    store = slotstore.SlotStore(tmp_path, NUM_SLOTS)
+    hashes = store.set_slots({0: b"GIF89a same", 1: b"GIF89a same"})
+    assert hashes[0] == hashes[1]
+    assert len(list((tmp_path / "blobs").glob("*.gif"))) == 1
+    assert store.assign(3, hashes[0])
+    assert store.get(3) == (hashes[0], b"GIF89a same")
+    assert not store.assign(2, slotstore.content_hash(b"never stored"))
+    assert store.get(2) is None
+
+def test_clearing(tmp_path):
+    store = slotstore.SlotStore(tmp_path, NUM_SLOTS)
+    store.set_slots({1: b"GIF89a one"})
+    assert store.clear(1)
+    assert not store.clear(1)
+    assert store.get(1) is None
+    store.set_slots({2: b"GIF89a two"})
+    store.set_slots({2: None})
+    assert store.info(2) is None
+    assert slotstore.SlotStore(tmp_path, NUM_SLOTS).info(2) is None
+
+def test_slots_out_of_range_are_refused(tmp_path):
+    store = slotstore.SlotStore(tmp_path, NUM_SLOTS)
+    with pytest.raises(RuntimeError, match="No slot 4"):
+        store.set_slots({NUM_SLOTS: b"GIF89a"})
+
+def test_gc_removes_only_unreferenced_files(tmp_path):
+    store = slotstore.SlotStore(tmp_path, NUM_SLOTS)
+    hashes = store.set_slots({0: b"GIF89a kept", 1: b"GIF89a dropped"})
+    for content_hash in hashes.values():
+        store.frames_path(content_hash).write_bytes(b"frames")
+    (tmp_path / "blobs" / "leftover.gif.tmp").write_bytes(b"partial")
+    store.set_slots({1: b"GIF89a replacement"})
+
+    assert store.gc() == [hashes[1]]
+    assert store.has_blob(hashes[0]) and store.frames_path(hashes[0]).exists()
+    assert not store.has_blob(hashes[1]) and not store.frames_path(hashes[1]).exists()
+    assert not (tmp_path / "blobs" / "leftover.gif.tmp").exists()
+    assert store.get(1) == (slotstore.content_hash(b"GIF89a replacement"), b"GIF89a replacement")
+    assert store.gc() == []
+
+def test_legacy_slots_are_imported(tmp_path):
+    (tmp_path / "0.gif").write_bytes(b"GIF89a legacy zero")
+    (tmp_path / "0.frames").write_bytes(b"old compact file")
+    (tmp_path / "3.gif").write_bytes(b"GIF89a legacy three")
+    store = slotstore.SlotStore(tmp_path, NUM_SLOTS)
+    assert store.get(0) == (slotstore.content_hash(b"GIF89a legacy zero"), b"GIF89a legacy zero")
+    assert store.get(3) == (slotstore.content_hash(b"GIF89a legacy three"), b"GIF89a legacy three")
+    assert not any(tmp_path.glob("*.gif")) and not any(tmp_path.glob("*.frames"))
+    record = json.loads((tmp_path / "slots" / "3.json").read_text())
+    assert record == {"hash": slotstore.content_hash(b"GIF89a legacy three"), "size": len(b"GIF89a legacy three")}
+
+def test_a_legacy_file_never_overrides_a_record(tmp_path):
+    store = slotstore.SlotStore(tmp_path, NUM_SLOTS)
+    store.set_slots({0: b"GIF89a current"})
+    (tmp_path / "0.gif").write_bytes(b"GIF89a stale")
+    reopened = slotstore.SlotStore(tmp_path, NUM_SLOTS)
+    assert reopened.get(0)[1] == b"GIF89a current"
+    assert not (tmp_path / "0.gif").exists()